@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+"""
+Compare how long it takes to run an App cold versus through a warm daemon
+
+Usage::
+
+    $ python benchmarks/bench_daemon.py [number_of_runs]
+"""
+from __future__ import print_function
+
+from delfick_app import App
+
+import subprocess
+import tempfile
+import shutil
+import signal
+import time
+import sys
+import os
+
+this_file = os.path.abspath(__file__)
+
+class BenchApp(App):
+    daemon_idle_timeout = 60
+    daemon_socket = os.environ.get("DELFICK_APP_BENCH_SOCKET")
+
+    def specify_other_args(self, parser, defaults):
+        parser.add_argument("--name", default="world")
+
+    def execute(self, args, extra_args, cli_args, handler):
+        print("hello {0}".format(args.name))
+
+def timed(command, runs):
+    """Return the average number of seconds it takes to run this command"""
+    with open(os.devnull, "w") as devnull:
+        start = time.time()
+        for _ in range(runs):
+            subprocess.check_call(command, stdout=devnull)
+        return (time.time() - start) / runs
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    runs = int(argv[0]) if argv else 20
+
+    directory = tempfile.mkdtemp()
+    socket_path = os.path.join(directory, "bench.sock")
+    environment = dict(os.environ, DELFICK_APP_BENCH_SOCKET=socket_path)
+    daemon = subprocess.Popen([sys.executable, this_file, "--daemon"], env=environment)
+    try:
+        while not os.path.exists(socket_path):
+            time.sleep(0.01)
+
+        cold = timed([sys.executable, this_file, "--cold", "--name", "bench"], runs)
+        client = "from delfick_app import client_main; client_main({0!r})".format(socket_path)
+        warm = timed([sys.executable, "-c", client, "--name", "bench"], runs)
+    finally:
+        daemon.send_signal(signal.SIGTERM)
+        daemon.wait()
+        shutil.rmtree(directory)
+
+    print("cold {0:>8.1f}ms".format(cold * 1000))
+    print("warm {0:>8.1f}ms".format(warm * 1000))
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--daemon"]:
+        BenchApp.daemon_main()
+    elif sys.argv[1:2] == ["--cold"]:
+        BenchApp().mainline(sys.argv[2:])
+    else:
+        main()
@@ -0,0 +1,53 @@
+#!/usr/bin/env python
+"""
+Compare how many records per second each of the logging formats can write
+
+Usage::
+
+    $ python benchmarks/bench_formatters.py [number_of_records]
+"""
+from __future__ import print_function
+
+from delfick_app import App
+
+import logging
+import time
+import sys
+import os
+
+class TTY(object):
+    """Pretend to be a terminal so the rainbow handler adds its colours"""
+    def __init__(self, fle):
+        self.fle = fle
+
+    def isatty(self):
+        return True
+
+    def write(self, data):
+        self.fle.write(data)
+
+    def flush(self):
+        self.fle.flush()
+
+def records_per_second(logging_format, count):
+    with open(os.devnull, "w") as fle:
+        class BenchApp(App):
+            logging_handler_file = TTY(fle)
+        BenchApp.logging_format = logging_format
+        handler = BenchApp().make_logging_handler()
+
+        record = logging.LogRecord("benchmark", logging.INFO, __file__, 1, "a message with %s in it", ("args", ), None)
+        start = time.time()
+        for _ in range(count):
+            handler.handle(record)
+        handler.flush()
+        return count / (time.time() - start)
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    count = int(argv[0]) if argv else 50000
+    for logging_format in ("rainbow", "plain", "json"):
+        print("{0:<8} {1:>12,.0f} records/sec".format(logging_format, records_per_second(logging_format, count)))
+
+if __name__ == "__main__":
+    main()
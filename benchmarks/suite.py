@@ -0,0 +1,196 @@
+#!/usr/bin/env python
+"""
+Benchmarks for the hot paths of CliParser and App.mainline
+
+Each benchmark reports the best seconds per operation out of a few repeats.
+Results are written as json and compared against a baseline, and we exit with
+a failure if anything is slower than the baseline by more than the tolerance.
+Not having a baseline is also a failure unless ``--allow-missing-baseline`` is given.
+
+Usage::
+
+    # Record a baseline on the machine that gates releases
+    $ python benchmarks/suite.py --save-baseline
+
+    # Later, compare against it
+    $ python benchmarks/suite.py --output results.json --tolerance 0.25
+"""
+from __future__ import print_function
+
+from delfick_app import App, CliParser
+
+import bench_formatters
+
+import subprocess
+import argparse
+import logging
+import json
+import time
+import sys
+import os
+
+this_dir = os.path.dirname(os.path.abspath(__file__))
+this_file = os.path.join(this_dir, "suite.py")
+clock = getattr(time, "perf_counter", time.time)
+
+class BenchApp(App):
+    cli_categories = ["app", "app_db"]
+    cli_positional_replacements = [("--task", "list_tasks"), "--environment"]
+    cli_environment_defaults = dict(("BENCH_OPTION_{0}".format(i), ("--app-option-{0}".format(i), str(i))) for i in range(50))
+
+    def specify_other_args(self, parser, defaults):
+        parser.add_argument("--task", **defaults["--task"])
+        parser.add_argument("--environment", **defaults["--environment"])
+        for i in range(50):
+            parser.add_argument("--app-option-{0}".format(i), **defaults["--app-option-{0}".format(i)])
+            parser.add_argument("--app-db-option-{0}".format(i))
+
+    def execute(self, args, extra_args, cli_args, handler):
+        pass
+
+def best_of(func, repeat=5, number=1):
+    """Return the best seconds per call of func"""
+    best = None
+    for _ in range(repeat):
+        start = clock()
+        for _ in range(number):
+            func()
+        took = (clock() - start) / number
+        if best is None or took < best:
+            best = took
+    return best
+
+def bench_split_args():
+    parser = CliParser("")
+    argv = ["--thing-{0}".format(i) for i in range(10000)] + ["--"] + ["file_{0}".format(i) for i in range(10000)]
+    return best_of(lambda: parser.split_args(argv))
+
+def bench_make_defaults():
+    environment_defaults = dict(("BENCH_ENV_{0}".format(i), ("--option-{0}".format(i), str(i))) for i in range(5000))
+    parser = CliParser("")
+    return best_of(lambda: parser.make_defaults(["task", "env"], ["--task", "--environment"], environment_defaults))
+
+def bench_interpret_args():
+    class Parser(CliParser):
+        def specify_other_args(slf, parser, defaults):
+            for category in categories:
+                for i in range(20):
+                    parser.add_argument("--{0}-option-{1}".format(category, i), dest="{0}_option_{1}".format(category, i))
+
+    categories = ["category{0}".format(i) for i in range(50)]
+    parser = Parser("")
+    return best_of(lambda: parser.interpret_args([], categories))
+
+def bench_make_cli_args(args_per_category, category_count):
+    def bench():
+        categories = ["area{0}.section{0}".format(i) for i in range(category_count)]
+        namespace = argparse.Namespace(**dict(
+              ("area{0}_section{0}_option_{1}".format(i, j), j)
+              for i in range(category_count) for j in range(args_per_category)
+            ))
+        parser = CliParser("")
+        return best_of(lambda: parser.make_cli_args(namespace, categories))
+    return bench
+
+def bench_mainline_warm():
+    app = BenchApp()
+    return best_of(lambda: app.mainline(["a_task", "dev", "--silent"], exit_on_error=False), number=20)
+
+def bench_mainline_cold():
+    command = [sys.executable, this_file, "--mainline", "a_task", "dev", "--silent"]
+    return best_of(lambda: subprocess.check_call(command), repeat=5)
+
+def bench_logging():
+    with open(os.devnull, "w") as devnull:
+        class LoggingApp(App):
+            logging_format = "plain"
+            logging_handler_file = devnull
+
+        log = logging.getLogger("delfick_app_benchmark")
+        log.propagate = False
+        handler = LoggingApp().setup_logging(None, logging_name="delfick_app_benchmark")
+        try:
+            return best_of(lambda: log.info("a message with %s in it", "args"), number=10000)
+        finally:
+            log.removeHandler(handler)
+            handler.close()
+
+def bench_formatter(logging_format):
+    return lambda: 1.0 / bench_formatters.records_per_second(logging_format, 10000)
+
+benchmarks = [
+      ("split_args_10k", bench_split_args)
+    , ("make_defaults_5k_environment", bench_make_defaults)
+    , ("interpret_args_1k_args_50_categories", bench_interpret_args)
+    , ("make_cli_args_10_categories_x_10_args", bench_make_cli_args(10, 10))
+    , ("make_cli_args_100_categories_x_10_args", bench_make_cli_args(10, 100))
+    , ("make_cli_args_1000_categories_x_10_args", bench_make_cli_args(10, 1000))
+    , ("mainline_warm", bench_mainline_warm)
+    , ("mainline_cold", bench_mainline_cold)
+    , ("logging_record", bench_logging)
+    , ("format_rainbow_record", bench_formatter("rainbow"))
+    , ("format_plain_record", bench_formatter("plain"))
+    , ("format_json_record", bench_formatter("json"))
+    ]
+
+def compare(results, baseline, tolerance):
+    """Print how results compare to the baseline and return the names of the ones that regressed"""
+    regressed = []
+    print("{0:<40} {1:>14} {2:>14} {3:>8}".format("benchmark", "seconds", "baseline", "change"))
+    for name, seconds in results.items():
+        expected = baseline.get(name)
+        if expected is None:
+            print("{0:<40} {1:>14.9f} {2:>14} {3:>8}".format(name, seconds, "-", "-"))
+            continue
+
+        change = (seconds - expected) / expected
+        print("{0:<40} {1:>14.9f} {2:>14.9f} {3:>+7.1f}%".format(name, seconds, expected, change * 100))
+        if change > tolerance:
+            regressed.append(name)
+    return regressed
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark delfick_app")
+    parser.add_argument("--output", default=os.path.join(this_dir, "results.json"))
+    parser.add_argument("--baseline", default=os.path.join(this_dir, "baseline.json"))
+    parser.add_argument("--tolerance", type=float, default=0.25, help="How much slower than the baseline is allowed, as a fraction")
+    parser.add_argument("--save-baseline", action="store_true", help="Write the results as the new baseline")
+    parser.add_argument("--allow-missing-baseline", action="store_true", help="Don't fail when there is no baseline to compare against")
+    parser.add_argument("--only", nargs="*", help="Only run these benchmarks")
+    args = parser.parse_args(argv)
+
+    results = {}
+    for name, func in benchmarks:
+        if not args.only or name in args.only:
+            results[name] = func()
+
+    with open(args.output, "w") as fle:
+        json.dump(results, fle, indent=2, sort_keys=True)
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as fle:
+            json.dump(results, fle, indent=2, sort_keys=True)
+        print("Saved baseline to {0}".format(args.baseline))
+        return 0
+
+    baseline = {}
+    if os.path.exists(args.baseline):
+        with open(args.baseline) as fle:
+            baseline = json.load(fle)
+    else:
+        print("No baseline at {0}, use --save-baseline to make one".format(args.baseline))
+        if not args.allow_missing_baseline:
+            return 1
+
+    regressed = compare(results, baseline, args.tolerance)
+    if regressed:
+        print("")
+        print("Slower than the baseline by more than {0:.0f}%: {1}".format(args.tolerance * 100, ", ".join(regressed)))
+        return 1
+    return 0
+
+if __name__ == "__main__":
+    if sys.argv[1:2] == ["--mainline"]:
+        BenchApp().mainline(sys.argv[2:])
+    else:
+        sys.exit(main())
@@ -1,9 +1,14 @@
 from __future__ import print_function
 
-from rainbow_logging_handler import RainbowLoggingHandler
-from delfick_error import DelfickError, UserQuit
-import argparse
+from collections import OrderedDict, namedtuple
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
+from contextlib import contextmanager
+import threading
 import logging
+import time
 import sys
 import os
 
@@ -12,8 +17,153 @@ log = logging.getLogger("delfick_app")
 class Ignore(object):
     pass
 
-class BadOption(DelfickError):
-    desc = "Bad option"
+BatchItem = namedtuple("BatchItem", ["argv", "status", "seconds"])
+
+########################
+###   LAZY IMPORTS
+########################
+
+# rainbow_logging_handler, delfick_error and argparse are only imported when
+# something actually needs them so that ``import delfick_app`` stays cheap
+
+def _make_error(name, desc):
+    def make():
+        from delfick_error import DelfickError
+        error = type(name, (DelfickError, ), {"desc": desc})
+        error.__module__ = __name__
+        return error
+    return make
+
+def _import_from(module, name):
+    return lambda: getattr(__import__(module, fromlist=[name]), name)
+
+_lazy_attributes = {
+      "BadOption": _make_error("BadOption", "Bad option")
+    , "FanOutError": _make_error("FanOutError", "Fan out failed")
+    , "DaemonError": _make_error("DaemonError", "Daemon problem")
+    , "UserQuit": _import_from("delfick_error", "UserQuit")
+    , "DelfickError": _import_from("delfick_error", "DelfickError")
+    , "RainbowLoggingHandler": _import_from("rainbow_logging_handler", "RainbowLoggingHandler")
+    }
+
+def lazy(name):
+    """Return the module level attribute called name, importing it if we haven't already"""
+    if name not in globals():
+        if name not in _lazy_attributes:
+            raise AttributeError("module '{0}' has no attribute '{1}'".format(__name__, name))
+        globals()[name] = _lazy_attributes[name]()
+    return globals()[name]
+
+def __getattr__(name):
+    """Support ``from delfick_app import BadOption`` without importing delfick_error up front"""
+    return lazy(name)
+
+if sys.version_info < (3, 7):
+    # Module level __getattr__ doesn't exist yet, so we can't be lazy
+    for name in _lazy_attributes:
+        lazy(name)
+
+########################
+###   IMPORT HOOKS
+########################
+
+_post_import_hooks = {}
+
+class _PostImportLoader(object):
+    """Wrap a loader so the hooks for a module are called once it has been executed"""
+    def __init__(self, loader):
+        self.loader = loader
+
+    def create_module(self, spec):
+        return self.loader.create_module(spec)
+
+    def exec_module(self, module):
+        self.loader.exec_module(module)
+        _call_post_import_hooks(module)
+
+    def __getattr__(self, key):
+        return getattr(self.loader, key)
+
+class _PostImportFinder(object):
+    """A sys.meta_path finder that gives the modules in _post_import_hooks a _PostImportLoader"""
+    def __init__(self):
+        self.finding = set()
+
+    def find_spec(self, fullname, path=None, target=None):
+        if fullname not in _post_import_hooks or fullname in self.finding:
+            return None
+
+        from importlib.util import find_spec
+        self.finding.add(fullname)
+        try:
+            spec = find_spec(fullname)
+        finally:
+            self.finding.discard(fullname)
+
+        if spec is None or spec.loader is None or not hasattr(spec.loader, "exec_module"):
+            return None
+        spec.loader = _PostImportLoader(spec.loader)
+        return spec
+
+_post_import_finder = _PostImportFinder()
+
+def _call_post_import_hooks(module):
+    for hook in _post_import_hooks.pop(module.__name__, []):
+        try:
+            hook(module)
+        except Exception as error:
+            log.error("Failed to run post import hook\tmodule=%s\terror=%s", module.__name__, error)
+
+    if not _post_import_hooks and _post_import_finder in sys.meta_path:
+        sys.meta_path.remove(_post_import_finder)
+
+def when_imported(name, hook):
+    """
+    Call hook with the module called name as soon as it's imported, or now if it already has been
+
+    This doesn't import the module itself, except before python3.4 where it has to.
+    Registering the same hook for a module more than once only calls it once.
+    """
+    if name in sys.modules:
+        hook(sys.modules[name])
+        return
+
+    try:
+        from importlib.util import find_spec
+    except ImportError:
+        __import__(name)
+        hook(sys.modules[name])
+        return
+
+    hooks = _post_import_hooks.setdefault(name, [])
+    if hook not in hooks:
+        hooks.append(hook)
+    if _post_import_finder not in sys.meta_path:
+        sys.meta_path.insert(0, _post_import_finder)
+
+# {name: "name/version"} for App.set_boto_useragent
+_useragent_extras = OrderedDict()
+
+def _patch_boto_useragent(connection):
+    for name, extra in _useragent_extras.items():
+        if name not in connection.UserAgent:
+            connection.UserAgent = "{0} {1}".format(connection.UserAgent, extra)
+
+def _patch_botocore_useragent(session):
+    original = session.Session.__init__
+    if getattr(original, "delfick_app_useragent", False):
+        return
+
+    def __init__(slf, *args, **kwargs):
+        original(slf, *args, **kwargs)
+        current = getattr(slf, "user_agent_extra", None) or ""
+        for name, extra in _useragent_extras.items():
+            if name not in current:
+                current = "{0} {1}".format(current, extra).strip()
+        slf.user_agent_extra = current
+
+    __init__.delfick_app_useragent = True
+    session.Session.__init__ = __init__
 
 ########################
 ###   APP
@@ -37,10 +187,95 @@ class App(object):
 
             The file to log output to (default is stderr)
 
+        .. autoattribute:: logging_format
+
+            How to format the logs, one of ``rainbow``, ``plain`` or ``json``.
+
+            The default of None means ``rainbow`` if logging_handler_file is a tty
+            and ``plain`` otherwise. ``plain`` is the same as ``rainbow`` without
+            the colours and ``json`` is a json object per line.
+
+        .. autoattribute:: logging_buffer_size
+
+            If this is set, logs are collected in memory and written to logging_handler_file
+            in one go once there are at least this many characters of them.
+
+        .. autoattribute:: logging_buffer_interval
+
+            The most number of seconds buffered logs will wait before being written
+
+        .. autoattribute:: logging_buffer_flush_level
+
+            Buffered logs are written straight away when we get a record at or above this level.
+
+            Buffered logs are also written when mainline finishes, including when it fails.
+
+        .. autoattribute:: logging_async
+
+            Send log records through a queue to a background thread that does the
+            formatting and writing, so logging doesn't block the thread doing the logging.
+
+        .. autoattribute:: logging_async_queue_size
+
+            How many records the queue for logging_async may hold
+
+        .. autoattribute:: logging_async_overflow
+
+            What to do with a record when the logging_async queue is full.
+
+            ``block``
+                Wait for there to be room
+
+            ``drop_oldest``
+                Throw away the oldest record in the queue to make room
+
+            ``count_and_drop``
+                Throw away the new record
+
+            Either way we log how many records were dropped when the handler is closed.
+
         .. autoattribute:: boto_useragent_name
 
             The name to append to your boto useragent if that's a thing you want to happen
 
+            This is also added to the ``user_agent_extra`` of botocore (and so boto3) sessions.
+            Neither is imported just for this, they are changed when something else imports them.
+
+        .. autoattribute:: daemon_socket
+
+            Where ``daemon_main`` listens for clients. See ``daemon_main``.
+
+        .. autoattribute:: daemon_idle_timeout
+
+            How many seconds the daemon waits for a client before it stops
+
+        .. autoattribute:: completion_dynamic
+
+            A list of --arguments whose values for shell completion come from completion_values
+            rather than being in the script from completion_main.
+
+        .. autoattribute:: completion_ttl
+
+            How many seconds the shell caches the values from completion_values for
+
+        .. autoattribute:: async_executor_size
+
+            When execute is an ``async def``, the number of threads in the default executor
+            of the event loop it's run on. None means asyncio's own default.
+
+        .. autoattribute:: cli_parser_cache
+
+            An optional ParserCache to reuse the generated CliParser class and the
+            ArgumentParser it builds between calls to mainline.
+
+            For example:
+
+            ``cli_parser_cache = ParserCache(size=16)``
+
+            Note that specify_other_args is then only called when the parser isn't already
+            in the cache, so it shouldn't depend on anything other than the defaults it is given.
+            Use ``cli_parser_cache.invalidate(MyApp)`` to forget what was cached for an App.
+
         .. autoattribute:: cli_categories
 
             self.execute is passed a dictionary cli_args which is from looking at the args object returned by argparse
@@ -51,224 +286,2553 @@ class App(object):
 
             ``cli_categories = ['app']``
 
-            and we have arguments for ``[silent, verbose, debug, app_config, app_option1, app_option2]``
+            and we have arguments for ``[silent, verbose, debug, app_config, app_option1, app_option2]``
+
+            Then cli_args will be ``{"app": {"config": value, "option1": value, "option2": value}, "silent": value, "verbose": value, "debug": value}``
+
+            Categories may be nested with a dot. So with ``cli_categories = ['app', 'app.db']``
+            an argument for ``app_db_timeout`` ends up in ``cli_args["app"]["db"]["timeout"]``.
+            When an argument matches more than one category the longest one wins.
+
+        .. autoattribute:: cli_args_as_view
+
+            Give execute a read only ``delfick_app.CliArgs`` for cli_args instead of nested dictionaries.
+
+            This reads values from the argparse namespace rather than copying them, may be
+            accessed as ``cli_args.app.config`` as well as ``cli_args["app"]["config"]``,
+            can be used as a dictionary key and is cheap to pickle.
+
+        .. autoattribute:: profile_mainline
+
+            Make ``--profile`` profile the whole mainline rather than only execute
+
+        .. autoattribute:: profile_top
+
+            How many functions to log from a profile, sorted by cumulative time
+
+        .. autoattribute:: profile_sample_env
+
+            The name of an environment variable that may be set to a number N so that
+            roughly one in every N runs is profiled as if ``--profile`` was given.
+
+        .. autoattribute:: memprofile_top
+
+            How many allocation sites to log for ``--memprofile``
+
+        .. autoattribute:: metrics_file
+
+            Where to write ``self.metrics`` when mainline is done. A file ending in
+            ``.prom`` is written in the prometheus text format (for the node exporter's
+            textfile collector) and anything else is written as json.
+
+            ``self.metrics`` is a new Metrics for every mainline and already has
+            ``phase_seconds`` for each phase before execute when execute is called.
+            It also gets ``exit_status`` and ``last_run_timestamp_seconds`` at the end.
+
+            ``batch`` makes one Metrics that is shared by all of its lines.
+
+        .. autoattribute:: metrics_prefix
+
+            What to put in front of the name of every metric. Defaults to the name of the class in lowercase.
+
+        .. autoattribute:: cli_fan_out
+
+            A list of --arguments that may be given a comma separated list of values.
+
+            For example:
+
+            ``cli_fan_out = ['--environment', '--stack']``
+                Means ``./app.py deploy dev,stg web,db`` runs execute once for each
+                combination of environment and stack. These runs share a pool of
+                ``--jobs`` workers and each of their log lines is prefixed with the
+                combination it's for. The DelfickErrors from all of them are displayed
+                together once they are all finished.
+
+                Each of the comma separated values is converted with the ``type`` of
+                the option and checked against its ``choices``.
+
+        .. autoattribute:: fan_out_pool
+
+            Either ``thread`` or ``process`` for the kind of pool used by cli_fan_out.
+            With ``process`` the App must be something that can be pickled.
+
+        .. autoattribute:: fan_out_jobs
+
+            The default for ``--jobs`` when cli_fan_out is being used
+
+        .. autoattribute:: cli_description
+
+            The description to give at the top of --help output
+
+        .. autoattribute:: cli_response_files
+
+            Whether ``@file`` arguments are replaced with the arguments in that file.
+
+            Response files have one argument per line and are read a line at a time,
+            which is useful for passing more arguments than the command line allows.
+
+        .. autoattribute:: cli_extra_args_as_list
+
+            Whether execute gets the arguments after a ``--`` as a list rather than
+            as a string with all of them joined by spaces.
+
+        .. autoattribute:: cli_environment_defaults
+
+            A map of environment variables to --argument that you want to map
+
+            For example:
+
+            ``cli_environment_defaults = {"APP_CONFIG": "--config"}``
+
+            Items may also be a tuple of ``(replacement, default)``
+
+            For example, ``{"APP_CONFIG": ("--config", "./config.yml")}``
+
+            Which means ``defaults["--config"] == {'default': "./config.yml"}`` if APP_CONFIG isn't in the environment.
+
+        .. autoattribute:: cli_environment_prefixes
+
+            A map of environment variable prefixes to the start of --arguments they provide values for
+
+            For example:
+
+            ``cli_environment_prefixes = {"APP_": "--"}``
+                Means APP_CONFIG_LOCATION is the value for --config-location unless that
+                is given on the command line, as a positional or from cli_environment_defaults.
+
+            Values are converted with the ``type`` of the argparse action, options that
+            take several values are split on whitespace and flags like ``store_true``
+            are turned on by ``1``, ``true``, ``yes`` or ``on``.
+
+        .. autoattribute:: cli_config_defaults
+
+            The location, or list of locations, of json, ini or yaml files with defaults for --arguments
+
+            For example:
+
+            ``cli_config_defaults = ["/etc/my_app.yml", "~/.my_app.yml"]``
+                With ``{"config": "c.yml", "app": {"pool_size": 3}}`` in ~/.my_app.yml
+                means the defaults for --config and --app-pool-size are ``c.yml`` and ``3``.
+
+            These are below positional arguments and above environment variables, later
+            locations override earlier ones and locations that don't exist are ignored.
+            Yaml needs PyYAML installed. What is parsed is cached in ~/.cache/delfick_app
+            so an unchanged file isn't parsed again.
+
+            This may also be a ``delfick_app.ConfigDefaults``.
+
+        .. autoattribute:: cli_subcommands
+
+            A map of subcommand name to where it can be imported from, so that only the chosen one is imported
+
+            For example:
+
+            ``cli_subcommands = {"deploy": "my_app.tasks.deploy:Deploy", "list": "my_app.tasks.listing:List"}``
+                With ``cli_positional_replacements = ["--task"]`` means ``./app.py deploy`` imports
+                my_app.tasks.deploy and execute can find Deploy at ``self.subcommand``.
+
+            If specify_other_args doesn't add cli_subcommand_option then it's added with the
+            subcommands as its choices. If the subcommand has a ``specify_other_args(parser, defaults)``
+            then that is called as well.
+
+            --help lists each subcommand with the first line of its ``description`` or docstring.
+            These are cached in ~/.cache/delfick_app so only subcommands whose module has changed
+            are imported to make that list.
+
+            This may also be a ``delfick_app.SubcommandRegistry``.
+
+        .. autoattribute:: cli_subcommand_option
+
+            The --argument that chooses from cli_subcommands, found in argv or from a positional argument
+
+        .. autoattribute:: cli_help_cache
+
+            Set to True, or a ``delfick_app.HelpCache``, to keep what --help says in ~/.cache/delfick_app/help
+
+            So that --help is answered without making the parser. This is keyed by the
+            app class, its VERSION, the terminal width, the defaults, the chosen subcommand
+            and the files that define the app, so it's made again when any of those change.
+            ``HelpCache().invalidate()`` forgets everything that is cached.
+
+        .. autoattribute:: environment
+
+            An ``EnvironmentSnapshot`` to read environment variables from instead of
+            taking a copy of os.environ at the start of mainline. For example, when the
+            environment is coming from another process.
+
+        .. autoattribute:: cli_positional_replacements
+
+            A list mapping positional arguments to --arguments
+
+            For example:
+
+            ``cli_positional_replacements = ['--environment', '--stack']``
+                Will mean the first positional argument becomes the value for --environment and the second positional becomes the value for '--stack'
+
+                Note for this to work, you must do something like:
+
+                .. code-block:: python
+
+                    def setup_other_args(self, parser, defaults):
+                        parser.add_argument('--environment'
+                            , help = "the environment!"
+                            , **defaults['--environment']
+                            )
+
+            Items in positional_replacements may also be a tuple of ``(replacement, default)``
+
+            For example:
+
+            ``cli_positional_replacements = [('--task', 'list_tasks')]``
+                will mean the first positional argument becomes the value for --task
+
+                But if it's not specified, then ``defaults['--task'] == {"default": "list_tasks"}``
+
+    ``Hooks``
+
+        .. automethod:: execute
+
+        .. automethod:: setup_other_logging
+
+        .. automethod:: specify_other_args
+
+        .. automethod:: timings_recorded
+    """
+
+    ########################
+    ###   SETTABLE PROPERTIES
+    ########################
+
+    VERSION = Ignore
+    boto_useragent_name = Ignore
+    async_executor_size = None
+
+    daemon_socket = None
+    daemon_idle_timeout = 600
+
+    completion_dynamic = None
+    completion_ttl = 300
+
+    CliParserKls = property(lambda s: CliParser)
+    logging_handler_file = property(lambda s: sys.stderr)
+
+    logging_format = None
+
+    logging_buffer_size = None
+    logging_buffer_interval = 1.0
+    logging_buffer_flush_level = logging.ERROR
+
+    logging_async = False
+    logging_async_queue_size = 10000
+    logging_async_overflow = "block"
+
+    cli_categories = None
+    cli_args_as_view = False
+    cli_parser_cache = None
+    profile_top = 20
+    profile_mainline = False
+    profile_sample_env = "DELFICK_APP_PROFILE_EVERY"
+
+    memprofile_top = 10
+
+    metrics_file = None
+    metrics_prefix = None
+
+    cli_fan_out = None
+    fan_out_pool = "thread"
+    fan_out_jobs = 4
+    cli_description = "My amazing app"
+    cli_response_files = False
+    cli_extra_args_as_list = False
+    cli_environment_defaults = None
+    cli_environment_prefixes = None
+    cli_config_defaults = None
+    cli_subcommands = None
+    cli_subcommand_option = "--task"
+    cli_help_cache = None
+    cli_positional_replacements = None
+
+    environment = None
+    subcommand = None
+
+    ########################
+    ###   USAGE
+    ########################
+
+    @classmethod
+    def main(kls):
+        """
+        Instantiates this class and calls the mainline
+
+        Usage is intended to be:
+
+        .. code-block:: python
+
+            from delfick_app import App
+
+            class MyApp(App):
+                [..]
+
+            main = MyApp.main
+        """
+        app = kls()
+        option = os.environ.get("DELFICK_APP_COMPLETE")
+        if option:
+            app.print_completion_values(option)
+        else:
+            app.mainline()
+
+    @classmethod
+    def batch_main(kls):
+        """
+        Instantiates this class and runs each line of argv from a file through it
+
+        The file is the first argument, or stdin if there isn't one or it is ``-``.
+        Each line is shell quoted and the exit code is 1 if any of the lines failed.
+
+        .. code-block:: python
+
+            main = MyApp.main
+            batch = MyApp.batch_main
+        """
+        source = sys.argv[1] if len(sys.argv) > 1 else "-"
+        app = kls()
+        if source == "-":
+            results = app.batch(sys.stdin)
+        else:
+            with open(source) as lines:
+                results = app.batch(lines)
+
+        if any(result.status != "ok" for result in results):
+            sys.exit(1)
+
+    @classmethod
+    def daemon_main(kls):
+        """
+        Instantiates this class and serves mainline over daemon_socket
+
+        The daemon keeps everything imported, and each client gets a forked
+        copy of it that runs mainline with the client's argv, cwd, stdio and
+        the environment variables from cli_environment_defaults and
+        cli_environment_prefixes. So a client
+        gets the same output and exit code as if it ran main itself, without
+        starting python and importing everything first.
+
+        Usage is intended to be:
+
+        .. code-block:: python
+
+            # In your app
+            class MyApp(App):
+                daemon_socket = "/tmp/my_app.sock"
+                [..]
+
+            main = MyApp.main
+            daemon = MyApp.daemon_main
+
+        .. code-block:: python
+
+            # A script that only imports delfick_app
+            from delfick_app import client_main
+            client_main("/tmp/my_app.sock")
+        """
+        app = kls()
+        app.serve()
+
+    @classmethod
+    def completion_main(kls):
+        """
+        Instantiates this class and prints a bash completion script for it
+
+        The first argument is the name of the command to complete. The script
+        has all the options and choices in it, so completing doesn't start python,
+        apart from refreshing the values for the options in completion_dynamic.
+        It works in zsh after ``autoload -U +X bashcompinit && bashcompinit``.
+
+        .. code-block:: python
+
+            main = MyApp.main
+            completion = MyApp.completion_main
+
+        .. code-block:: bash
+
+            $ my-app-completion my-app > /etc/bash_completion.d/my-app
+        """
+        prog = sys.argv[1] if len(sys.argv) > 1 else os.path.basename(sys.argv[0])
+        print(kls().completion_script(prog))
+
+    def execute(self, args, extra_args, cli_args, logging_handler):
+        """
+        Hook for executing the application itself
+
+        This may be an ``async def``, in which case mainline runs it on a new event loop.
+        Other tasks still running when it finishes, or when the user quits, are cancelled.
+        """
+        raise NotImplementedError()
+
+    def setup_other_logging(self, args, verbose=False, silent=False, debug=False):
+        """
+        Hook for setting up any other logging configuration
+
+        For example:
+
+        .. code-block:: python
+
+            def setup_other_logging(self, args, verbose, silent, debug):
+                logging.getLogger("boto").setLevel([logging.CRITICAL, logging.ERROR][verbose or debug])
+                logging.getLogger("requests").setLevel([logging.CRITICAL, logging.ERROR][verbose or debug])
+                logging.getLogger("paramiko.transport").setLevel([logging.CRITICAL, logging.ERROR][verbose or debug])
+        """
+
+    def warm_up(self):
+        """
+        Hook for importing and preparing anything before daemon_main waits for clients
+
+        By default this imports what mainline will need
+        """
+        for name in _lazy_attributes:
+            lazy(name)
+        __import__("argparse")
+
+    def timings_recorded(self, timings):
+        """
+        Hook for doing something with how long each part of the mainline took
+
+        timings is a Timings object and ``timings.phases`` is an OrderedDict of
+        phase name to seconds for the phases we got to.
+
+        For example:
+
+        .. code-block:: python
+
+            def timings_recorded(self, timings):
+                for phase, seconds in timings.phases.items():
+                    statsd.timing("my_app.startup.{0}".format(phase), seconds * 1000)
+        """
+
+    def completion_values(self, option):
+        """
+        Hook for returning the values to complete for an option in completion_dynamic
+
+        For example:
+
+        .. code-block:: python
+
+            completion_dynamic = ["--stack"]
+
+            def completion_values(self, option):
+                if option == "--stack":
+                    return sorted(os.listdir("stacks"))
+        """
+        return []
+
+    def specify_other_args(self, parser, defaults):
+        """
+        Hook for adding more arguments to the argparse Parser
+
+        For example:
+
+        .. code-block:: python
+
+            def specify_other_args(self, parser, defaults):
+                parser.add_argument("--special"
+                    , help = "taste the rainbow"
+                    , action = "store_true"
+                    )
+        """
+
+    ########################
+    ###   INTERNALS
+    ########################
+
+    def serve(self):
+        """
+        Accept clients on daemon_socket and give each to a forked handle_client
+
+        We stop when daemon_idle_timeout seconds pass without any clients
+        """
+        import socket
+        import signal
+
+        if not self.daemon_socket:
+            raise lazy("DaemonError")("No daemon_socket specified", app=self.__class__.__name__)
+
+        if os.path.exists(self.daemon_socket):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.daemon_socket)
+            except socket.error:
+                os.remove(self.daemon_socket)
+            else:
+                raise lazy("DaemonError")("Daemon already running", socket=self.daemon_socket)
+            finally:
+                probe.close()
+
+        self.warm_up()
+
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        original_umask = os.umask(0o177)
+        try:
+            listener.bind(self.daemon_socket)
+        finally:
+            os.umask(original_umask)
+        listener.listen(16)
+        listener.settimeout(min(1, self.daemon_idle_timeout))
+
+        workers = set()
+        last_activity = time.time()
+        signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+        try:
+            while workers or time.time() - last_activity < self.daemon_idle_timeout:
+                for pid in list(workers):
+                    if os.waitpid(pid, os.WNOHANG)[0] == pid:
+                        workers.discard(pid)
+
+                try:
+                    connection, _ = listener.accept()
+                except socket.timeout:
+                    continue
+
+                last_activity = time.time()
+                sys.stdout.flush()
+                sys.stderr.flush()
+                pid = os.fork()
+                if pid == 0:
+                    listener.close()
+                    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+                    code = 1
+                    try:
+                        code = self.handle_client(connection)
+                    finally:
+                        os._exit(code)
+
+                workers.add(pid)
+                connection.close()
+        finally:
+            listener.close()
+            if os.path.exists(self.daemon_socket):
+                os.remove(self.daemon_socket)
+
+    def handle_client(self, connection):
+        """
+        Run mainline for this client as if it was run by the client itself
+
+        This is run in a forked worker and we tell the client our pid (so it can
+        pass on Ctrl-c) and the exit code the mainline would have had.
+        """
+        import traceback
+
+        environment = sorted(self.cli_environment_defaults or {})
+        prefixes = sorted(self.cli_environment_prefixes or {})
+        _send_message(connection, {"environment": environment, "environment_prefixes": prefixes})
+        request, fds = _receive_message(connection, fds=3)
+
+        for fd, std in zip(fds, (0, 1, 2)):
+            os.dup2(fd, std)
+            os.close(fd)
+
+        # Make sure python's idea of stdio is the client's stdio
+        sys.stdin = os.fdopen(0, "r", closefd=False)
+        sys.stdout = os.fdopen(1, "w", closefd=False)
+        sys.stderr = os.fdopen(2, "w", closefd=False)
+
+        os.chdir(request["cwd"])
+        environment.extend(name for name in os.environ if name.startswith(tuple(prefixes)))
+        environment.extend(request["environment"])
+        for name in environment:
+            if name in request["environment"]:
+                os.environ[name] = request["environment"][name]
+            elif name in os.environ:
+                del os.environ[name]
+
+        _send_message(connection, {"pid": os.getpid()})
+
+        try:
+            self.mainline(request["argv"], print_errors_to=sys.stdout)
+            code = 0
+        except SystemExit as error:
+            code = error.code
+            if code is None:
+                code = 0
+            elif not isinstance(code, int):
+                print(code, file=sys.stderr)
+                code = 1
+        except BaseException:
+            traceback.print_exc()
+            code = 1
+
+        sys.stdout.flush()
+        sys.stderr.flush()
+        _send_message(connection, {"exit": code})
+        connection.close()
+        return code
+
+    def set_boto_useragent(self):
+        """
+        Make boto and botocore report this application in their user agent
+
+        This happens when boto.connection or botocore.session are first imported,
+        so we don't import them ourselves if nothing else wants them.
+        """
+        if self.boto_useragent_name is not Ignore and self.VERSION is not Ignore:
+            _useragent_extras[self.boto_useragent_name] = "{0}/{1}".format(self.boto_useragent_name, self.VERSION)
+            when_imported("boto.connection", _patch_boto_useragent)
+            when_imported("botocore.session", _patch_botocore_useragent)
+
+    def mainline(self, argv=None, print_errors_to=sys.stdout, exit_on_error=True):
+        """
+        The mainline for the application
+
+        * Initialize parser and parse argv
+        * Initialize the logging
+        * run self.execute()
+        * Catch and display DelfickError
+        * Display traceback if we catch an error and args.debug
+        * Give how long each part took to timings_recorded, and display them if args.timings
+
+        The logging is put back how we found it before we return, so it's safe to
+        call this many times in the one process.
+
+        If exit_on_error is False then we return an exit code instead of calling
+        sys.exit: 0 if execute finished and 1 if we displayed a DelfickError.
+        """
+        DelfickError = lazy("DelfickError")
+        cli_parser = None
+        handler = None
+        timings = Timings()
+        self.metrics = Metrics(self.metrics_prefix or self.__class__.__name__.lower())
+        mainline_profile = self.profile_path(self.profile_option_in(argv)) if self.profile_mainline else None
+        with self.logging_restored():
+            status = 1
+            try:
+                with self.profiled(mainline_profile):
+                    try:
+                        with timings.timing("make_cli_parser"):
+                            cli_parser = self.make_cli_parser()
+                        cli_parser.timings = timings
+
+                        try:
+                            args, extra_args, cli_args = cli_parser.interpret_args(argv, self.cli_categories)
+                            self.subcommand = cli_parser.subcommand
+                            with timings.timing("setup_logging"):
+                                handler = self.setup_logging(args, verbose=args.verbose, silent=args.silent, debug=args.debug)
+                            with timings.timing("set_boto_useragent"):
+                                self.set_boto_useragent()
+
+                            execute_profile = None if self.profile_mainline else self.profile_path(getattr(args, "profile", None))
+                            self.record_timings(timings)
+                            memprofile = getattr(args, "memprofile", None)
+                            with timings.timing("execute"), self.profiled(execute_profile), self.memory_profiled(memprofile):
+                                targets = self.fan_out_targets(args)
+                                if len(targets) > 1:
+                                    self.fan_out(cli_parser, targets, args, extra_args, handler)
+                                else:
+                                    self.run_execute(args, extra_args, cli_args, handler)
+                        except KeyboardInterrupt:
+                            if self.debug_requested(cli_parser):
+                                raise
+                            raise lazy("UserQuit")()
+                    except DelfickError as error:
+                        self.print_error(error, handler, print_errors_to)
+                        if self.debug_requested(cli_parser):
+                            raise
+                        if exit_on_error:
+                            sys.exit(1)
+                        return 1
+                status = 0
+            except SystemExit as error:
+                status = error.code if isinstance(error.code, int) else int(error.code is not None)
+                raise
+            finally:
+                args = self.parsed_args(cli_parser)
+                if args is not None and getattr(args, "timings", False):
+                    timings.report(sys.stderr)
+                self.timings_recorded(timings)
+                self.record_timings(timings)
+                self.metrics.gauge("exit_status", help="The exit status of the last run").set(status)
+                self.metrics.gauge("last_run_timestamp_seconds", help="When the last run finished").set(time.time())
+                if self.metrics_file:
+                    self.metrics.write(self.metrics_file)
+        return 0
+
+    def batch(self, lines, print_errors_to=sys.stdout, summary_to=sys.stderr):
+        """
+        Run execute for each line of shell quoted argv in lines
+
+        The CliParser, the ArgumentParser (using a ParserCache if we don't have one)
+        and the logging are made once and shared by all the lines. Logging is only setup
+        again if a line asks for a different --verbose, --silent or --debug.
+
+        A DelfickError from one line is displayed like mainline would and we move on
+        to the next line. A summary of how each line went is printed to summary_to
+        and we return a list of BatchItem.
+
+        All the lines share one ``self.metrics``, which is written to metrics_file at the end.
+        """
+        import shlex
+
+        DelfickError = lazy("DelfickError")
+        original_cache = self.cli_parser_cache
+        if original_cache is None:
+            self.cli_parser_cache = ParserCache()
+
+        results = []
+        handler = None
+        logging_options = None
+        self.metrics = Metrics(self.metrics_prefix or self.__class__.__name__.lower())
+        try:
+            with self.logging_restored():
+                cli_parser = self.make_cli_parser()
+                self.set_boto_useragent()
+                for line in lines:
+                    argv = shlex.split(line, comments=True)
+                    if not argv:
+                        continue
+
+                    status = "ok"
+                    start = time.time()
+                    cli_parser.parsed = None
+                    try:
+                        args, extra_args, cli_args = cli_parser.interpret_args(argv, self.cli_categories)
+                        self.subcommand = cli_parser.subcommand
+                        if (args.verbose, args.silent, args.debug) != logging_options:
+                            logging_options = (args.verbose, args.silent, args.debug)
+                            handler = self.setup_logging(args, verbose=args.verbose, silent=args.silent, debug=args.debug)
+                        self.run_execute(args, extra_args, cli_args, handler)
+                    except KeyboardInterrupt:
+                        if self.debug_requested(cli_parser):
+                            raise
+                        self.print_error(lazy("UserQuit")(), handler, print_errors_to)
+                        results.append(BatchItem(argv, "quit", time.time() - start))
+                        break
+                    except SystemExit as error:
+                        status = "exit {0}".format(error.code)
+                    except DelfickError as error:
+                        self.print_error(error, handler, print_errors_to)
+                        if self.debug_requested(cli_parser):
+                            raise
+                        status = "failed"
+
+                    results.append(BatchItem(argv, status, time.time() - start))
+        finally:
+            self.cli_parser_cache = original_cache
+            status = int(any(result.status != "ok" for result in results))
+            self.metrics.gauge("exit_status", help="The exit status of the last run").set(status)
+            self.metrics.gauge("last_run_timestamp_seconds", help="When the last run finished").set(time.time())
+            if self.metrics_file:
+                self.metrics.write(self.metrics_file)
+
+        self.print_batch_summary(results, summary_to)
+        return results
+
+    def print_batch_summary(self, results, summary_to):
+        """Print a table saying how each line in the batch went and how long it took"""
+        failed = len([result for result in results if result.status != "ok"])
+        total = sum(result.seconds for result in results)
+        print("", file=summary_to)
+        print("=" * 80, file=summary_to)
+        print("Batch summary: {0} items, {1} failed, {2:.3f}s".format(len(results), failed, total), file=summary_to)
+        print("{0:>5}  {1:<10} {2:>9}  {3}".format("#", "status", "seconds", "argv"), file=summary_to)
+        for index, result in enumerate(results):
+            print("{0:>5}  {1:<10} {2:>9.3f}  {3}".format(index + 1, result.status, result.seconds, " ".join(result.argv)), file=summary_to)
+
+    def run_execute(self, args, extra_args, cli_args, handler):
+        """Call execute and run what it returns on an event loop if it's a coroutine"""
+        result = self.execute(args, extra_args, cli_args, handler)
+        if hasattr(result, "__await__"):
+            self.run_until_complete(result)
+
+    def fan_out_targets(self, args):
+        """
+        Return a list of (name, {dest: value}) for each combination of values for cli_fan_out
+
+        There is only one target if none of the cli_fan_out arguments have more than one value
+        """
+        import itertools
+
+        options = []
+        for flag in self.cli_fan_out or []:
+            dest = flag.lstrip("-").replace("-", "_")
+            value = getattr(args, dest, None)
+            if isinstance(value, FanOutValues):
+                options.append([(flag, dest, part) for part in value])
+
+        targets = []
+        for combination in itertools.product(*options):
+            name = " ".join("{0}={1}".format(flag.lstrip("-"), val) for flag, _, val in combination)
+            targets.append((name, dict((dest, val) for _, dest, val in combination)))
+        return targets
+
+    def fan_out(self, cli_parser, targets, args, extra_args, handler):
+        """
+        Run execute for each target in a pool of args.jobs workers
+
+        Raise a FanOutError with all the DelfickErrors once all the targets are done
+        """
+        import argparse
+        from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+        if self.fan_out_pool not in ("thread", "process"):
+            raise ValueError("Unknown fan_out_pool {0}, expected thread or process".format(self.fan_out_pool))
+
+        if args.jobs < 1:
+            raise lazy("BadOption")("Need at least one job to fan out with", got=args.jobs)
+
+        in_process = self.fan_out_pool == "process"
+        if in_process:
+            pool = ProcessPoolExecutor(max_workers=args.jobs)
+        else:
+            pool = ThreadPoolExecutor(max_workers=args.jobs)
+
+        failed = []
+        try:
+            futures = []
+            for name, values in targets:
+                target_args = argparse.Namespace(**vars(args))
+                for dest, val in values.items():
+                    setattr(target_args, dest, val)
+                cli_args = cli_parser.make_cli_args(target_args, self.cli_categories)
+                futures.append((name, pool.submit(_fan_out_execute, self, name, target_args, extra_args, cli_args, None if in_process else handler)))
+
+            for name, future in futures:
+                error, metrics = future.result()
+                if metrics is not None:
+                    self.metrics.merge(metrics)
+                if error is not None:
+                    failed.append((name, error))
+        except BaseException:
+            # shutdown only takes cancel_futures from python3.9
+            for _, future in futures:
+                future.cancel()
+            pool.shutdown(wait=False)
+            raise
+        else:
+            pool.shutdown()
+
+        if failed:
+            raise lazy("FanOutError")("{0} of {1} targets failed".format(len(failed), len(targets))
+                , failed = ", ".join(name for name, _ in failed)
+                , _errors = [error for _, error in failed]
+                )
+
+    def print_error(self, error, handler, print_errors_to):
+        """Display this DelfickError"""
+        if handler is not None:
+            # Make sure the logs come out before the error
+            handler.flush()
+        print("", file=print_errors_to)
+        print("!" * 80, file=print_errors_to)
+        print("Something went wrong! -- {0}".format(error.__class__.__name__), file=print_errors_to)
+        print("\t{0}".format(error), file=print_errors_to)
+
+    @contextmanager
+    def logging_restored(self, logging_name=""):
+        """
+        Put the level and handlers of this logger back how they were when we're done
+
+        Handlers that were added by setup_logging in the meantime are closed
+        """
+        log = logging.getLogger(logging_name)
+        level, handlers = log.level, list(log.handlers)
+        try:
+            yield
+        finally:
+            for handler in list(log.handlers):
+                if handler not in handlers:
+                    log.removeHandler(handler)
+                    if getattr(handler, "delfick_app_handler", False):
+                        handler.close()
+            for handler in handlers:
+                if handler not in log.handlers:
+                    log.addHandler(handler)
+            log.setLevel(level)
+
+    def run_until_complete(self, coroutine):
+        """
+        Run this coroutine on a new event loop and return what it returns
+
+        Any other tasks left on the loop are cancelled and waited for before the loop is closed.
+        """
+        import asyncio
+        from concurrent.futures import ThreadPoolExecutor
+
+        loop = asyncio.new_event_loop()
+        executor = ThreadPoolExecutor(max_workers=self.async_executor_size)
+        loop.set_default_executor(executor)
+        try:
+            return loop.run_until_complete(coroutine)
+        finally:
+            try:
+                tasks = [task for task in asyncio.all_tasks(loop) if not task.done()]
+                for task in tasks:
+                    task.cancel()
+                if tasks:
+                    loop.run_until_complete(asyncio.gather(*tasks, return_exceptions=True))
+                loop.run_until_complete(loop.shutdown_asyncgens())
+            finally:
+                executor.shutdown(wait=False)
+                loop.close()
+
+    def profile_option_in(self, argv):
+        """
+        Find what --profile is in argv without parsing it
+
+        This is so profile_mainline can start profiling before we have parsed argv
+        """
+        if argv is None:
+            argv = sys.argv[1:]
+
+        argv = list(argv)
+        for index, arg in enumerate(argv):
+            if arg == "--":
+                break
+            if arg.startswith("--profile="):
+                return arg[len("--profile="):]
+            if arg == "--profile":
+                if index + 1 < len(argv) and not argv[index + 1].startswith("-"):
+                    return argv[index + 1]
+                return True
+
+    def profile_path(self, option):
+        """
+        Return where to write a profile, or None if we shouldn't profile
+
+        option is the value of --profile, which is True if no path was given.
+        If there is no --profile we profile roughly one in every N runs, where N is
+        the value of the environment variable named by profile_sample_env.
+        """
+        import random
+
+        if isinstance(option, str):
+            return option
+
+        if option is not True:
+            every = os.environ.get(self.profile_sample_env) if self.profile_sample_env else None
+            if not every:
+                return None
+
+            try:
+                every = int(every)
+            except ValueError:
+                log.warning("Ignoring %s because it isn't a number\tgot=%s", self.profile_sample_env, every)
+                return None
+
+            if every < 1 or random.randrange(every) != 0:
+                return None
+
+        return "{0}-{1}-{2}.pstats".format(self.__class__.__name__.lower(), int(time.time()), os.getpid())
+
+    @contextmanager
+    def profiled(self, path):
+        """
+        Profile this block with cProfile if we have a path to write the stats to
+
+        The stats are written and the top profile_top functions by cumulative time
+        are logged even if the block raises an exception
+        """
+        if path is None:
+            yield
+            return
+
+        import cProfile
+        import pstats
+
+        profiler = cProfile.Profile()
+        profiler.enable()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            profiler.dump_stats(path)
+
+            try:
+                from StringIO import StringIO
+            except ImportError:
+                from io import StringIO
+
+            out = StringIO()
+            pstats.Stats(profiler, stream=out).sort_stats("cumulative").print_stats(self.profile_top)
+            log.info("Wrote profile to %s\n%s", path, out.getvalue())
+
+    @contextmanager
+    def memory_profiled(self, option):
+        """
+        Trace memory allocations with tracemalloc during this block if option is a path or True
+
+        When the block is done we log the peak traced memory, the peak RSS of the process,
+        the top memprofile_top allocation sites, and how each snapshot taken with
+        ``memory_snapshot`` differs from the one before it. If option is a path, the final
+        snapshot is dumped there so it can be compared with other runs.
+        """
+        if option is not True and not isinstance(option, str):
+            yield
+            return
+
+        import tracemalloc
+
+        started = not tracemalloc.is_tracing()
+        if started:
+            tracemalloc.start()
+
+        self.memory_snapshots = []
+        try:
+            yield
+        finally:
+            snapshots = self.memory_snapshots + [("end", tracemalloc.take_snapshot())]
+            _, peak = tracemalloc.get_traced_memory()
+            self.memory_snapshots = None
+            if started:
+                tracemalloc.stop()
+
+            report = ["Peak traced memory: {0:.1f} KiB".format(peak / 1024.0)]
+            try:
+                import resource
+            except ImportError:
+                pass
+            else:
+                # ru_maxrss is in bytes on OSX and kilobytes everywhere else
+                rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+                report.append("Peak RSS: {0:.1f} KiB".format(rss / 1024.0 if sys.platform == "darwin" else rss))
+
+            report.append("Top allocations:")
+            report.extend("\t{0}".format(stat) for stat in snapshots[-1][1].statistics("lineno")[:self.memprofile_top])
+
+            for (_, previous), (name, snapshot) in zip(snapshots, snapshots[1:]):
+                report.append("Growth up to {0}:".format(name))
+                report.extend("\t{0}".format(stat) for stat in snapshot.compare_to(previous, "lineno")[:self.memprofile_top])
+
+            if isinstance(option, str):
+                snapshots[-1][1].dump(option)
+                report.append("Wrote snapshot to {0}".format(option))
+
+            log.info("Memory profile\n%s", "\n".join(report))
+
+    def memory_snapshot(self, name):
+        """
+        Take a snapshot of memory allocations to be reported at the end of --memprofile
+
+        This does nothing if we aren't in a --memprofile
+        """
+        if getattr(self, "memory_snapshots", None) is not None:
+            import tracemalloc
+            self.memory_snapshots.append((name, tracemalloc.take_snapshot()))
+
+    def record_timings(self, timings):
+        """Put the timings we have so far into self.metrics"""
+        for phase, seconds in timings.phases.items():
+            self.metrics.gauge("phase_seconds", help="How long each phase of the mainline took", phase=phase).set(seconds)
+
+    def debug_requested(self, cli_parser):
+        """
+        Say whether argv asked for --debug
+
+        This looks at what the cli_parser already parsed rather than parsing argv again
+        """
+        args = self.parsed_args(cli_parser)
+        return args is not None and args.debug
+
+    def parsed_args(self, cli_parser):
+        """Return the args object the cli_parser last parsed, or None if it hasn't parsed anything"""
+        parsed = getattr(cli_parser, "parsed", None)
+        if isinstance(parsed, tuple):
+            return parsed[0]
+
+    def setup_logging(self, args, verbose=False, silent=False, debug=False, logging_name=""):
+        """
+        Setup the RainbowLoggingHandler for the logs and call setup_other_logging
+
+        Any handler a previous call to setup_logging put on this logger is replaced
+        rather than having another one added next to it.
+        """
+        log = logging.getLogger(logging_name)
+        for existing in list(log.handlers):
+            if getattr(existing, "delfick_app_handler", False):
+                existing.flush()
+                log.removeHandler(existing)
+                existing.close()
+
+        handler = self.make_logging_handler()
+        if self.logging_async:
+            handler = QueueLoggingHandler(handler, size=self.logging_async_queue_size, overflow=self.logging_async_overflow)
+        handler.delfick_app_handler = True
+        log.addHandler(handler)
+        log.setLevel([logging.INFO, logging.DEBUG][verbose or debug])
+        if silent:
+            log.setLevel(logging.ERROR)
+
+        self.setup_other_logging(args, verbose, silent, debug)
+        return handler
+
+    def make_logging_handler(self):
+        """
+        Return the handler that formats and writes our logs according to logging_format
+
+        And buffers what is written if we have a logging_buffer_size
+        """
+        stream = self.logging_handler_file
+        logging_format = self.logging_format
+        if logging_format is None:
+            isatty = getattr(stream, "isatty", None)
+            logging_format = "rainbow" if isatty and isatty() else "plain"
+
+        if self.logging_buffer_size:
+            stream = BufferedStream(stream, size=self.logging_buffer_size, interval=self.logging_buffer_interval)
+
+        if logging_format == "plain":
+            handler = logging.StreamHandler(stream)
+            handler.setFormatter(PlainFormatter())
+        elif logging_format == "json":
+            handler = logging.StreamHandler(stream)
+            handler.setFormatter(JsonFormatter())
+        elif logging_format == "rainbow":
+            handler = lazy("RainbowLoggingHandler")(stream)
+            handler._column_color['%(asctime)s'] = ('cyan', None, False)
+            handler._column_color['%(levelname)-7s'] = ('green', None, False)
+            handler._column_color['%(message)s'][logging.INFO] = ('blue', None, False)
+            handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)-7s %(name)-15s %(message)s"))
+        else:
+            raise ValueError("Unknown logging format {0}, expected one of rainbow, plain or json".format(logging_format))
+
+        if self.logging_buffer_size:
+            handler = BufferedLoggingHandler(handler, stream, flush_level=self.logging_buffer_flush_level)
+        return handler
+
+    def setup_logging_theme(self, handler, colors="light"):
+        """
+        Setup a logging theme
+
+        Currently there is only ``light`` and ``dark`` which consists of a difference
+        in color for INFO level messages.
+        """
+        if colors not in ("light", "dark"):
+            log.warning("Told to set colors to a theme we don't have\tgot=%s\thave=[light, dark]", colors)
+            return
+
+        # The colours live on the handler that does the writing
+        while getattr(handler, "target", None) is not None:
+            handler = handler.target
+
+        if not hasattr(handler, "_column_color"):
+            # Not a rainbow handler, so there are no colours to change
+            return
+
+        # Haven't put much effort into actually working out more than just the message colour
+        if colors == "light":
+            handler._column_color['%(message)s'][logging.INFO] = ('cyan', None, False)
+        else:
+            handler._column_color['%(message)s'][logging.INFO] = ('blue', None, False)
+
+    def completion_script(self, prog):
+        """Return a bash completion script for the parser made by our CliParser"""
+        cli_parser = self.make_cli_parser()
+        parser = cli_parser.make_parser(cli_parser.split_args([])[2])
+        return completion_script(prog, parser, cli_parser.positional_replacements, self.completion_dynamic or ())
+
+    def print_completion_values(self, option, out=sys.stdout):
+        """Print when these values expire and then the completion_values for this option"""
+        print(int(time.time() + self.completion_ttl), file=out)
+        for value in self.completion_values(option) or []:
+            print(value, file=out)
+
+    def source_files(self):
+        """Return (location, mtime, size) for the files that define this class and delfick_app"""
+        found = []
+        for module_name in [kls.__module__ for kls in self.__class__.__mro__] + [__name__]:
+            location = getattr(sys.modules.get(module_name), "__file__", None)
+            if location is not None:
+                try:
+                    stat = os.stat(location)
+                    found.append((location, getattr(stat, "st_mtime_ns", stat.st_mtime), stat.st_size))
+                except OSError:
+                    pass
+        return sorted(set(found))
+
+    def make_cli_parser(self):
+        """Return a CliParser instance"""
+        if self.cli_parser_cache is None:
+            properties = {"specify_other_args": self.specify_other_args}
+            cli_parser = type("CliParser", (self.CliParserKls, ), properties)(self.cli_description, self.cli_positional_replacements, self.cli_environment_defaults)
+        else:
+            kls = self.cli_parser_cache.cli_parser_kls(self.__class__, self.CliParserKls)
+            cli_parser = kls(self.cli_description, self.cli_positional_replacements, self.cli_environment_defaults)
+            cli_parser.app = self
+            cli_parser.parser_cache = self.cli_parser_cache
+
+        if self.cli_fan_out:
+            cli_parser.fan_out = self.cli_fan_out
+            cli_parser.fan_out_jobs = self.fan_out_jobs
+        cli_parser.response_files = self.cli_response_files
+        cli_parser.extra_args_as_list = self.cli_extra_args_as_list
+        cli_parser.args_as_view = self.cli_args_as_view
+        cli_parser.environment_prefixes = self.cli_environment_prefixes
+        if self.cli_subcommands is not None:
+            subcommands = self.cli_subcommands
+            if not isinstance(subcommands, SubcommandRegistry):
+                subcommands = SubcommandRegistry(subcommands)
+            cli_parser.subcommands = subcommands
+            cli_parser.subcommand_option = self.cli_subcommand_option
+        if self.cli_config_defaults is not None:
+            config = self.cli_config_defaults
+            if not isinstance(config, ConfigDefaults):
+                config = ConfigDefaults(config)
+            cli_parser.config_defaults = config
+        if self.cli_help_cache:
+            help_cache = self.cli_help_cache
+            if not isinstance(help_cache, HelpCache):
+                help_cache = HelpCache()
+            cli_parser.help_cache = help_cache
+            cli_parser.help_key_extra = (self.__class__.__module__, self.__class__.__name__, repr(self.VERSION), self.source_files())
+        cli_parser.environment = self.environment if self.environment is not None else EnvironmentSnapshot()
+        return cli_parser
+
+########################
+###   FAN OUT
+########################
+
+_fan_out_target = threading.local()
+
+class FanOutValues(list):
+    """The values given to a cli_fan_out option that was given more than one comma separated value"""
+
+class FanOutType(object):
+    """
+    Wrap the type of a cli_fan_out option so that it splits comma separated values
+
+    One value is converted with the original type and given back by itself. More than
+    one are each converted and checked against choices, because argparse doesn't check
+    the choices of defaults, and are given back as FanOutValues.
+    """
+    def __init__(self, kind, choices):
+        self.kind = kind
+        self.choices = choices
+        self.__name__ = getattr(kind, "__name__", "value")
+
+    def __call__(self, value):
+        parts = [part.strip() for part in value.split(",") if part.strip()]
+        if len(parts) == 1:
+            value = parts[0]
+        if len(parts) < 2:
+            return value if self.kind is None else self.kind(value)
+
+        values = FanOutValues(part if self.kind is None else self.kind(part) for part in parts)
+        for val in values:
+            if self.choices is not None and val not in self.choices:
+                import argparse
+                raise argparse.ArgumentTypeError("invalid choice: {0!r} (choose from {1})".format(val, ", ".join(map(repr, self.choices))))
+        return values
+
+class FanOutChoices(list):
+    """The choices of a cli_fan_out option, where FanOutValues are valid if each of the values are"""
+    def __contains__(self, value):
+        if isinstance(value, FanOutValues):
+            return all(list.__contains__(self, val) for val in value)
+        return list.__contains__(self, value)
+
+class FanOutPrefixFilter(logging.Filter):
+    """Prefix records logged while running a fan out target with the name of that target"""
+    def filter(self, record):
+        name = getattr(_fan_out_target, "name", None)
+        if name is not None and not getattr(record, "fan_out_prefixed", False):
+            record.msg = "[{0}] {1}".format(name, record.getMessage())
+            record.args = None
+            record.fan_out_prefixed = True
+        return True
+
+def _fan_out_execute(app, name, args, extra_args, cli_args, handler):
+    """
+    Run execute for one fan out target and return (error, metrics)
+
+    error is the DelfickError if it fails.
+
+    handler is None when we're in a separate process, in which case we setup logging
+    ourselves and metrics is what was recorded in this process for the mainline to merge.
+    The logging we setup is flushed before we return so buffered records aren't lost.
+    """
+    import pickle
+
+    metrics = None
+    in_process = handler is None
+    if in_process:
+        handler = app.setup_logging(args, verbose=args.verbose, silent=args.silent, debug=args.debug)
+        metrics = app.metrics = Metrics(app.metrics.prefix)
+
+    if not any(isinstance(f, FanOutPrefixFilter) for f in handler.filters):
+        handler.addFilter(FanOutPrefixFilter())
+
+    _fan_out_target.name = name
+    try:
+        app.run_execute(args, extra_args, cli_args, handler)
+    except lazy("DelfickError") as error:
+        handler.flush()
+        try:
+            pickle.loads(pickle.dumps(error))
+        except Exception:
+            # Make sure the error can get back to the mainline
+            error = lazy("DelfickError")(str(error))
+        return error, metrics
+    finally:
+        _fan_out_target.name = None
+        if in_process:
+            handler.flush()
+    return None, metrics
+
+########################
+###   LOGGING FORMATTERS
+########################
+
+class PlainFormatter(logging.Formatter):
+    """
+    Formats records like the RainbowLoggingHandler does, but without colours
+
+    The level and name part of the line is worked out once per logger and level
+    and the timestamp once per second.
+    """
+    def __init__(self):
+        super(PlainFormatter, self).__init__("%(asctime)s %(levelname)-7s %(name)-15s %(message)s")
+        self.middles = {}
+        self.second = (None, None)
+
+    def formatTime(self, record, datefmt=None):
+        if datefmt is not None:
+            return super(PlainFormatter, self).formatTime(record, datefmt)
+
+        seconds, stamp = self.second
+        if seconds != int(record.created):
+            seconds = int(record.created)
+            stamp = time.strftime("%Y-%m-%d %H:%M:%S", self.converter(record.created))
+            self.second = (seconds, stamp)
+        return "%s,%03d" % (stamp, record.msecs)
+
+    def format(self, record):
+        key = (record.levelname, record.name)
+        middle = self.middles.get(key)
+        if middle is None:
+            middle = self.middles[key] = " {0:<7} {1:<15} ".format(record.levelname, record.name)
+
+        line = "{0}{1}{2}".format(self.formatTime(record), middle, record.getMessage())
+        return self.add_exception(record, line)
+
+    def add_exception(self, record, line):
+        """Add any exception and stack information to the end of this line"""
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            line = "{0}\n{1}".format(line, record.exc_text)
+        if getattr(record, "stack_info", None):
+            line = "{0}\n{1}".format(line, self.formatStack(record.stack_info))
+        return line
+
+class JsonFormatter(PlainFormatter):
+    """
+    Formats records as a json object per line
+
+    Only created, level, name and message are included, plus exception when there is one.
+    The level and name part of the object is worked out once per logger and level.
+    """
+    def __init__(self):
+        super(JsonFormatter, self).__init__()
+        self.dumps = __import__("json").dumps
+        self.prefixes = {}
+
+    def format(self, record):
+        key = (record.levelname, record.name)
+        prefix = self.prefixes.get(key)
+        if prefix is None:
+            prefix = self.prefixes[key] = '{{"level": {0}, "name": {1}, '.format(self.dumps(record.levelname), self.dumps(record.name))
+
+        exception = self.add_exception(record, "")
+        if exception:
+            exception = ', "exception": {0}'.format(self.dumps(exception[1:]))
+
+        return '{0}"created": {1!r}, "message": {2}{3}}}'.format(prefix, record.created, self.dumps(record.getMessage()), exception)
+
+########################
+###   LOGGING HANDLERS
+########################
+
+class BufferedStream(object):
+    """
+    Collect what is written and pass it on to the stream in one write
+
+    We write once there are at least size characters waiting, or when flush is called
+    at least interval seconds after our last write. A timer makes sure nothing waits for
+    longer than interval if nothing else is written.
+
+    Use drain to write what we have regardless.
+    """
+    def __init__(self, stream, size=65536, interval=1.0):
+        self.size = size
+        self.stream = stream
+        self.interval = interval
+
+        self.timer = None
+        self.length = 0
+        self.pending = []
+        self.lock = threading.Lock()
+        self.last_write = time.time()
+
+    def isatty(self):
+        isatty = getattr(self.stream, "isatty", None)
+        return bool(isatty and isatty())
+
+    def write(self, data):
+        with self.lock:
+            self.pending.append(data)
+            self.length += len(data)
+            if self.length >= self.size:
+                self.write_pending()
+            elif self.timer is None:
+                self.timer = threading.Timer(self.interval, self.drain)
+                self.timer.daemon = True
+                self.timer.start()
+
+    def flush(self):
+        """Only write if it's been long enough since the last write"""
+        if time.time() - self.last_write >= self.interval:
+            self.drain()
+
+    def drain(self):
+        """Write everything we have"""
+        with self.lock:
+            self.write_pending()
+
+    def close(self):
+        """Write everything we have and stop the timer"""
+        self.drain()
+
+    def write_pending(self):
+        """Write what we have to the stream, must be called with the lock held"""
+        if self.timer is not None:
+            self.timer.cancel()
+            self.timer = None
+
+        self.last_write = time.time()
+        if self.pending:
+            data = "".join(self.pending)
+            self.length = 0
+            self.pending = []
+            self.stream.write(data)
+            self.stream.flush()
+
+class BufferedLoggingHandler(logging.Handler):
+    """
+    Give records to a target handler that writes to a BufferedStream
+
+    The stream is drained when we get a record at or above flush_level,
+    when we are flushed and when we are closed.
+    """
+    def __init__(self, target, stream, flush_level=logging.ERROR):
+        super(BufferedLoggingHandler, self).__init__()
+        self.target = target
+        self.stream = stream
+        self.flush_level = flush_level
+
+    def emit(self, record):
+        self.target.handle(record)
+        if record.levelno >= self.flush_level:
+            self.stream.drain()
+
+    def flush(self):
+        self.target.flush()
+        self.stream.drain()
+
+    def close(self):
+        self.target.close()
+        self.stream.close()
+        super(BufferedLoggingHandler, self).close()
+
+class QueueLoggingHandler(logging.Handler):
+    """
+    Put records on a bounded queue for a background thread to give to the target handler
+
+    overflow says what to do when the queue is full and is one of ``block``,
+    ``drop_oldest`` or ``count_and_drop``. ``dropped`` is how many records we threw away.
+
+    flush waits for the queue to be empty and close stops the thread after
+    everything in the queue has been handled.
+    """
+    overflow_policies = ("block", "drop_oldest", "count_and_drop")
+
+    def __init__(self, target, size=10000, overflow="block"):
+        if overflow not in self.overflow_policies:
+            raise ValueError("Unknown overflow policy {0}, expected one of {1}".format(overflow, self.overflow_policies))
+
+        try:
+            from queue import Queue, Full, Empty
+        except ImportError:
+            from Queue import Queue, Full, Empty
+
+        super(QueueLoggingHandler, self).__init__()
+        self.target = target
+        self.dropped = 0
+        self.overflow = overflow
+        self.queue = Queue(size)
+        self.Full, self.Empty = Full, Empty
+        self.thread = threading.Thread(target=self.listen, name="delfick_app-logging")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def listen(self):
+        """Give records from the queue to the target until we get a None"""
+        while True:
+            record = self.queue.get()
+            try:
+                if record is None:
+                    return
+                self.target.handle(record)
+            except Exception:
+                self.target.handleError(record)
+            finally:
+                self.queue.task_done()
+
+    def emit(self, record):
+        """Put this record on the queue"""
+        try:
+            # Format the message now in case the args change before the thread gets to it
+            record.msg = record.getMessage()
+            record.args = None
+            self.put(record)
+        except Exception:
+            self.handleError(record)
+
+    def put(self, record):
+        """Put something on the queue according to our overflow policy"""
+        if self.overflow == "block":
+            self.queue.put(record)
+            return
+
+        while True:
+            try:
+                self.queue.put_nowait(record)
+                return
+            except self.Full:
+                with self.lock:
+                    self.dropped += 1
+                if self.overflow == "count_and_drop":
+                    return
+
+            try:
+                self.queue.get_nowait()
+                self.queue.task_done()
+            except self.Empty:
+                pass
+
+    def flush(self):
+        """Wait for everything in the queue to be handled"""
+        if self.thread.is_alive():
+            self.queue.join()
+        self.target.flush()
+
+    def close(self):
+        """Stop the thread once everything has been handled and close the target"""
+        if self.thread.is_alive():
+            self.queue.put(None)
+            self.thread.join()
+
+        if self.dropped:
+            record = logging.LogRecord("delfick_app", logging.WARNING, __file__, 0, "Dropped %s log records because the logging queue was full", (self.dropped, ), None)
+            self.target.handle(record)
+            self.dropped = 0
+
+        self.target.flush()
+        self.target.close()
+        super(QueueLoggingHandler, self).close()
+
+########################
+###   METRICS
+########################
+
+class Counter(object):
+    """A number that only goes up"""
+    kind = "counter"
+
+    def __init__(self, lock):
+        self.lock = lock
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def merge(self, other):
+        self.value += other.value
+
+    def samples(self, name):
+        yield name, {}, self.value
+
+class Gauge(Counter):
+    """A number that can be set to anything"""
+    kind = "gauge"
+
+    def set(self, value):
+        with self.lock:
+            self.value = value
+
+    def dec(self, amount=1):
+        self.inc(-amount)
+
+    def merge(self, other):
+        self.value = other.value
+
+class Histogram(object):
+    """Count observations into fixed buckets"""
+    kind = "histogram"
+    default_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+    def __init__(self, lock, buckets=None):
+        self.lock = lock
+        self.buckets = tuple(sorted(buckets or self.default_buckets))
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        with self.lock:
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    self.counts[index] += 1
+                    break
+            else:
+                self.counts[-1] += 1
+            self.sum += value
+            self.count += 1
+
+    def merge(self, other):
+        self.counts = [mine + theirs for mine, theirs in zip(self.counts, other.counts)]
+        self.sum += other.sum
+        self.count += other.count
+
+    def samples(self, name):
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"), ), self.counts):
+            cumulative += count
+            yield "{0}_bucket".format(name), {"le": "+Inf" if bound == float("inf") else repr(float(bound))}, cumulative
+        yield "{0}_sum".format(name), {}, self.sum
+        yield "{0}_count".format(name), {}, self.count
+
+class Metrics(object):
+    """
+    A registry of counters, gauges and histograms
+
+    Metrics are identified by their name and labels, and asking for the same
+    one again returns what we already have:
+
+    .. code-block:: python
+
+        self.metrics.counter("things_made", help="How many things we made", kind="widget").inc()
+        self.metrics.gauge("queue_size").set(len(queue))
+        self.metrics.histogram("request_seconds", buckets=[0.1, 1, 10]).observe(took)
+
+    Everything is protected by a lock so it can be used from many threads.
+    A Metrics can be pickled and merged into another, which is how metrics from
+    other processes get back to the mainline.
+    """
+    def __init__(self, prefix=""):
+        self.prefix = prefix
+        self.lock = threading.Lock()
+        self.helps = {}
+        self.metrics = OrderedDict()
+
+    def __getstate__(self):
+        metrics = []
+        for key, metric in self.metrics.items():
+            attributes = dict((attr, val) for attr, val in metric.__dict__.items() if attr != "lock")
+            metrics.append((key, metric.__class__, attributes))
+        return {"prefix": self.prefix, "helps": self.helps, "metrics": metrics}
+
+    def __setstate__(self, state):
+        self.__init__(state["prefix"])
+        self.helps = state["helps"]
+        for key, kls, attributes in state["metrics"]:
+            metric = self.metrics[key] = kls.__new__(kls)
+            metric.__dict__.update(attributes)
+            metric.lock = self.lock
+
+    def counter(self, name, help="", **labels):
+        return self.get(Counter, name, help, labels)
+
+    def gauge(self, name, help="", **labels):
+        return self.get(Gauge, name, help, labels)
+
+    def histogram(self, name, help="", buckets=None, **labels):
+        return self.get(Histogram, name, help, labels, buckets=buckets)
+
+    def get(self, kls, name, help, labels, **kwargs):
+        """Return the metric with this name and labels, making it if we don't have it yet"""
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            if key not in self.metrics:
+                self.metrics[key] = kls(self.lock, **kwargs)
+            if help:
+                self.helps[name] = help
+            metric = self.metrics[key]
+
+        if not isinstance(metric, kls):
+            raise ValueError("Metric {0} is already a {1}".format(name, metric.kind))
+        return metric
+
+    def merge(self, other):
+        """Add the metrics from another Metrics into these ones"""
+        for (name, labels), metric in other.metrics.items():
+            mine = self.get(metric.__class__, name, other.helps.get(name, ""), dict(labels), **({"buckets": metric.buckets} if isinstance(metric, Histogram) else {}))
+            with self.lock:
+                mine.merge(metric)
+
+    def full_name(self, name):
+        return "{0}_{1}".format(self.prefix, name) if self.prefix else name
+
+    def as_prometheus(self):
+        """Return our metrics in the prometheus text format"""
+        def escape(val):
+            return str(val).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+        lines = []
+        described = set()
+        with self.lock:
+            for (name, labels), metric in sorted(self.metrics.items(), key=lambda item: item[0]):
+                full_name = self.full_name(name)
+                if name not in described:
+                    described.add(name)
+                    if name in self.helps:
+                        lines.append("# HELP {0} {1}".format(full_name, escape(self.helps[name])))
+                    lines.append("# TYPE {0} {1}".format(full_name, metric.kind))
+
+                for sample, extra, value in metric.samples(full_name):
+                    all_labels = list(labels) + sorted(extra.items())
+                    if all_labels:
+                        sample = "{0}{{{1}}}".format(sample, ",".join('{0}="{1}"'.format(key, escape(val)) for key, val in all_labels))
+                    lines.append("{0} {1}".format(sample, repr(float(value))))
+        return "\n".join(lines) + "\n"
+
+    def as_json(self):
+        """Return our metrics as a list of dictionaries"""
+        result = []
+        with self.lock:
+            for (name, labels), metric in self.metrics.items():
+                info = {"name": self.full_name(name), "type": metric.kind, "labels": dict(labels)}
+                if isinstance(metric, Histogram):
+                    info.update(buckets=list(metric.buckets), counts=list(metric.counts), sum=metric.sum, count=metric.count)
+                else:
+                    info["value"] = metric.value
+                result.append(info)
+        return result
+
+    def write(self, path):
+        """
+        Write our metrics to path, in the prometheus text format if it ends with .prom, otherwise json
+
+        The file is written to a temporary file and moved into place so readers never see half of it
+        """
+        if path.endswith(".prom"):
+            content = self.as_prometheus()
+        else:
+            content = __import__("json").dumps(self.as_json(), indent=2, sort_keys=True)
+
+        temporary = "{0}.{1}.tmp".format(path, os.getpid())
+        with open(temporary, "w") as fle:
+            fle.write(content)
+        os.rename(temporary, path)
+
+########################
+###   TIMINGS
+########################
+
+class Timings(object):
+    """Record how long each phase of the mainline takes, in the order they happened"""
+    clock = staticmethod(getattr(time, "perf_counter", time.time))
+
+    def __init__(self):
+        self.phases = OrderedDict()
+
+    @contextmanager
+    def timing(self, name):
+        """Add how long this block takes to the phase called name"""
+        start = self.clock()
+        try:
+            yield
+        finally:
+            self.add(name, self.clock() - start)
+
+    def add(self, name, seconds):
+        self.phases[name] = self.phases.get(name, 0) + seconds
+
+    @property
+    def total(self):
+        return sum(self.phases.values())
+
+    def report(self, fle):
+        """Display a table of the phases"""
+        print("", file=fle)
+        print("Timings", file=fle)
+        for name, seconds in list(self.phases.items()) + [("total", self.total)]:
+            print("  {0:<20} {1:>10.3f}ms".format(name, seconds * 1000), file=fle)
+
+########################
+###   PARSER CACHE
+########################
+
+class ParserCache(object):
+    """
+    A bounded cache of the CliParser classes generated for an App and the ArgumentParsers they make
+
+    Parsers are keyed by the generated class, the description, the defaults
+    made from positional replacements and the environment, and the parser_key of
+    the CliParser. The least recently used
+    entries are forgotten once there are more than ``size`` of them.
+    """
+    def __init__(self, size=32):
+        self.size = size
+        self.lock = threading.Lock()
+        self.classes = OrderedDict()
+        self.parsers = OrderedDict()
+
+    def cli_parser_kls(self, app_kls, parser_kls):
+        """Return a subclass of parser_kls that asks the app on the instance for specify_other_args"""
+        key = (app_kls, parser_kls)
+        with self.lock:
+            if key in self.classes:
+                self.classes[key] = self.classes.pop(key)
+                return self.classes[key]
+
+        properties = {"app": None, "specify_other_args": lambda slf, parser, defaults: slf.app.specify_other_args(parser, defaults)}
+        kls = type("CliParser", (parser_kls, ), properties)
+
+        with self.lock:
+            self.remember(self.classes, key, kls)
+            return self.classes[key]
+
+    def parser(self, cli_parser, defaults):
+        """Return an ArgumentParser for these defaults, only asking cli_parser to make one if we don't have it"""
+        try:
+            key = (cli_parser.__class__, cli_parser.description, self.freeze(defaults), cli_parser.parser_key())
+            hash(key)
+        except TypeError:
+            # Can't cache what we can't hash
+            return cli_parser.make_parser(defaults)
+
+        with self.lock:
+            if key in self.parsers:
+                self.parsers[key] = self.parsers.pop(key)
+                return self.parsers[key]
+
+        parser = cli_parser.make_parser(defaults)
+        with self.lock:
+            self.remember(self.parsers, key, parser)
+        return parser
+
+    def invalidate(self, app_kls=None):
+        """Forget everything we have cached, or just what we have for app_kls"""
+        with self.lock:
+            if app_kls is None:
+                self.classes.clear()
+                self.parsers.clear()
+                return
+
+            generated = set()
+            for key in list(self.classes):
+                if key[0] is app_kls:
+                    generated.add(self.classes.pop(key))
+
+            for key in list(self.parsers):
+                if key[0] in generated:
+                    del self.parsers[key]
+
+    def remember(self, cache, key, val):
+        """Put val in the cache, forgetting the oldest entries if it's too big"""
+        cache[key] = val
+        while len(cache) > self.size:
+            cache.popitem(last=False)
+
+    def freeze(self, defaults):
+        """Turn defaults into something hashable"""
+        return tuple(sorted((flag, tuple(sorted(options.items()))) for flag, options in defaults.items()))
+
+########################
+###   COMPLETION
+########################
+
+_completion_template = """\
+# bash completion for {prog}, made by delfick_app
+# For zsh, run "autoload -U +X bashcompinit && bashcompinit" before this
+
+_{name}_complete_words() {{
+    COMPREPLY=($(compgen -W "$1" -- "${{COMP_WORDS[COMP_CWORD]}}"))
+}}
+
+_{name}_dynamic() {{
+    local dir="${{XDG_CACHE_HOME:-$HOME/.cache}}/delfick_app/completion"
+    local cache="$dir/{name}$1"
+    local expires=0
+    {{ read -r expires < "$cache"; }} 2>/dev/null
+    if ! [ "$expires" -ge "$(date +%s)" ] 2>/dev/null; then
+        mkdir -p "$dir"
+        if DELFICK_APP_COMPLETE="$1" "${{COMP_WORDS[0]}}" > "$cache.$$" 2>/dev/null; then
+            mv "$cache.$$" "$cache"
+        else
+            rm -f "$cache.$$"
+        fi
+    fi
+    tail -n +2 "$cache" 2>/dev/null
+}}
+
+_{name}() {{
+    local cur="${{COMP_WORDS[COMP_CWORD]}}"
+    local prev="${{COMP_WORDS[COMP_CWORD-1]}}"
+    COMPREPLY=()
+
+    case "$prev" in
+{option_cases}
+    esac
+
+    if [[ "$cur" == -* ]]; then
+        _{name}_complete_words {options}
+        return
+    fi
+
+    local i position=0
+    for ((i=1; i<COMP_CWORD; i++)); do
+        if [[ "${{COMP_WORDS[i]}}" == -* ]]; then
+            return
+        fi
+        position=$((position+1))
+    done
+
+    case "$position" in
+{positional_cases}
+    esac
+}}
+
+complete -o default -F _{name} {prog}
+"""
+
+def completion_script(prog, parser, positional_replacements=(), dynamic=()):
+    """
+    Return a bash completion script for the options of this argparse parser
+
+    Options with choices complete to those choices and positional arguments complete
+    like the option they are a replacement for. Options in dynamic complete to what
+    ``DELFICK_APP_COMPLETE=<option> <prog>`` prints after the line saying when that
+    expires, which is cached in ~/.cache/delfick_app/completion until then.
+    Anything else that takes a value completes to files.
+    """
+    import re
+    try:
+        from shlex import quote
+    except ImportError:
+        from pipes import quote
+
+    name = re.sub("[^a-zA-Z0-9_]", "_", prog)
+
+    options = []
+    completers = {}
+    option_cases = []
+    for action in parser._actions:
+        options.extend(action.option_strings)
+        if action.nargs == 0 or not action.option_strings:
+            continue
+
+        dynamic_options = [option for option in action.option_strings if option in dynamic]
+        if dynamic_options:
+            completer = '_{0}_complete_words "$(_{0}_dynamic {1})"'.format(name, quote(dynamic_options[0]))
+        elif action.choices is not None:
+            completer = "_{0}_complete_words {1}".format(name, quote(" ".join(str(choice) for choice in action.choices)))
+        else:
+            completer = ":"
+
+        for option in action.option_strings:
+            completers[option] = completer
+        option_cases.append("        {0}) {1}; return;;".format("|".join(quote(option) for option in action.option_strings), completer))
+
+    positional_cases = []
+    for index, replacement in enumerate(positional_replacements):
+        if type(replacement) is tuple:
+            replacement, _ = replacement
+        if replacement in completers:
+            positional_cases.append("        {0}) {1};;".format(index, completers[replacement]))
+
+    return _completion_template.format(
+          prog = quote(prog)
+        , name = name
+        , options = quote(" ".join(options))
+        , option_cases = "\n".join(option_cases)
+        , positional_cases = "\n".join(positional_cases)
+        )
+
+########################
+###   ENVIRONMENT
+########################
+
+class EnvironmentSnapshot(object):
+    """
+    A copy of the environment taken once, so that mainline reads os.environ a single time
+
+    Without an environ, variables are remembered from os.environ the first time they are
+    looked at and everything is only copied when that's needed, so a snapshot is cheap.
+
+    Variables starting with some prefixes are indexed by what comes after the prefix in one
+    pass over the snapshot. A snapshot may be given to ``App.environment`` to have mainline
+    use it instead of os.environ, for example in a daemon worker or another process.
+    """
+    def __init__(self, environ=None):
+        self.indexes = {}
+        self.missing = set()
+        self.complete = environ is not None
+        self.environ = {} if environ is None else dict(environ)
+
+    def __contains__(self, name):
+        return self.get(name, Ignore) is not Ignore
+
+    def __getitem__(self, name):
+        value = self.get(name, Ignore)
+        if value is Ignore:
+            raise KeyError(name)
+        return value
+
+    def get(self, name, default=None):
+        if not self.complete and name not in self.environ and name not in self.missing:
+            value = os.environ.get(name)
+            if value is None:
+                self.missing.add(name)
+            else:
+                self.environ[name] = value
+        return self.environ.get(name, default)
+
+    def copy_everything(self):
+        """Copy the rest of os.environ, keeping what we've already seen as it was"""
+        if not self.complete:
+            environ = dict(os.environ)
+            environ.update(self.environ)
+            for name in self.missing:
+                environ.pop(name, None)
+            self.environ = environ
+            self.complete = True
+
+    def prefixed(self, prefixes):
+        """Return {prefix: {rest: (name, value)}} for the variables that start with these prefixes"""
+        key = tuple(sorted(prefixes))
+        index = self.indexes.get(key)
+        if index is None:
+            self.copy_everything()
+            index = dict((prefix, {}) for prefix in key)
+            for name, value in self.environ.items():
+                for prefix in key:
+                    if name.startswith(prefix) and len(name) > len(prefix):
+                        index[prefix][name[len(prefix):]] = (name, value)
+            self.indexes[key] = index
+        return index
+
+    def __getstate__(self):
+        self.copy_everything()
+        return {"environ": self.environ}
+
+    def __setstate__(self, state):
+        self.__init__(state["environ"])
+
+########################
+###   CONFIG DEFAULTS
+########################
+
+def user_cache_dir(*parts):
+    """Return a directory under $XDG_CACHE_HOME (or ~/.cache) for delfick_app to cache things in"""
+    base = os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache")
+    return os.path.join(base, "delfick_app", *parts)
 
-            Then cli_args will be ``{"app": {"config": value, "option1": value, "option2": value}, "silent": value, "verbose": value, "debug": value}``
+class ConfigDefaults(object):
+    """
+    Read defaults for --flags from json, ini or yaml files
 
-        .. autoattribute:: cli_description
+    Nested sections become part of the flag, so ``{"app": {"pool_size": 3}}`` is the
+    default for ``--app-pool-size``. Options in the ``[defaults]`` section of an ini
+    file are for flags without a prefix. Later locations override earlier ones and
+    locations that don't exist are ignored.
 
-            The description to give at the top of --help output
+    What we parse is stored as json in cache_dir keyed by the path, mtime and size of the
+    file, so a config file that hasn't changed costs a stat rather than a parse. Files
+    with values json can't hold, like yaml dates, are parsed every time instead.
+    """
+    def __init__(self, locations, cache_dir=None):
+        if not isinstance(locations, (list, tuple)):
+            locations = [locations]
+        self.locations = [os.path.abspath(os.path.expanduser(location)) for location in locations]
+
+        self.cache_dir = cache_dir
+        if self.cache_dir is None:
+            self.cache_dir = user_cache_dir("config")
+
+    def values(self):
+        """Return {--flag: value} from all our locations"""
+        values = {}
+        for location in self.locations:
+            values.update(self.read(location))
+        return values
+
+    def read(self, location):
+        """Return {--flag: value} from this location, using the cache if the file hasn't changed"""
+        try:
+            stat = os.stat(location)
+        except OSError:
+            return {}
 
-        .. autoattribute:: cli_environment_defaults
+        key = (location, getattr(stat, "st_mtime_ns", stat.st_mtime), stat.st_size)
+        cache_location = os.path.join(self.cache_dir, "{0}.json".format(__import__("hashlib").sha1(location.encode("utf-8")).hexdigest()))
 
-            A map of environment variables to --argument that you want to map
+        import json
+        try:
+            with open(cache_location) as fle:
+                cached_key, values = json.load(fle)
+            if cached_key == list(key):
+                return values
+        except Exception:
+            pass
 
-            For example:
+        values = self.flatten(self.parse(location))
 
-            ``cli_environment_defaults = {"APP_CONFIG": "--config"}``
+        try:
+            content = json.dumps([key, values])
+        except (TypeError, ValueError) as error:
+            log.debug("Not caching config defaults\tlocation=%s\terror=%s", location, error)
+            return values
 
-            Items may also be a tuple of ``(replacement, default)``
+        try:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            temporary = "{0}.{1}.tmp".format(cache_location, os.getpid())
+            with open(temporary, "w") as fle:
+                fle.write(content)
+            os.rename(temporary, cache_location)
+        except (IOError, OSError) as error:
+            log.debug("Failed to cache config defaults\tlocation=%s\terror=%s", location, error)
+
+        return values
+
+    def parse(self, location):
+        """Return the data in this location based on its extension"""
+        try:
+            if location.endswith((".yml", ".yaml")):
+                try:
+                    import yaml
+                except ImportError:
+                    raise lazy("BadOption")("Need PyYAML installed to read yaml config defaults", location=location)
+                with open(location) as fle:
+                    data = yaml.safe_load(fle)
+
+            elif location.endswith((".ini", ".cfg")):
+                try:
+                    from configparser import RawConfigParser
+                except ImportError:
+                    from ConfigParser import RawConfigParser
+                parser = RawConfigParser()
+                parser.read(location)
+                data = dict(parser.items("defaults")) if parser.has_section("defaults") else {}
+                for section in parser.sections():
+                    if section != "defaults":
+                        data[section] = dict(parser.items(section))
 
-            For example, ``{"APP_CONFIG": ("--config", "./config.yml")}``
+            else:
+                with open(location) as fle:
+                    data = __import__("json").load(fle)
+        except lazy("BadOption"):
+            raise
+        except Exception as error:
+            raise lazy("BadOption")("Failed to read config defaults", location=location, error=error)
+
+        if data is None:
+            data = {}
+        if not isinstance(data, dict):
+            raise lazy("BadOption")("Config defaults should be a dictionary", location=location, got=type(data).__name__)
+        return data
+
+    def flatten(self, data, prefix=""):
+        """Return {--flag: value} from this nested dictionary"""
+        values = {}
+        for key, val in data.items():
+            name = "{0}{1}".format(prefix, str(key).lstrip("-").replace("_", "-"))
+            if isinstance(val, dict):
+                values.update(self.flatten(val, "{0}-".format(name)))
+            else:
+                values["--{0}".format(name)] = val
+        return values
 
-            Which means ``defaults["--config"] == {'default': "./config.yml"}`` if APP_CONFIG isn't in the environment.
+########################
+###   SUBCOMMANDS
+########################
 
-        .. autoattribute:: cli_positional_replacements
+class SubcommandRegistry(object):
+    """
+    A map of subcommand name to ``"module.path:attribute"`` that only imports what is used
 
-            A list mapping positional arguments to --arguments
+    A subcommand is imported with ``load(name)``. The first line of its ``description``
+    or docstring is used for --help, and those are cached in cache_dir keyed by the file,
+    mtime and size of each module. So --help only imports the modules that have changed.
+    Finding a module's file imports the packages it is in, but not the module itself.
+    """
+    def __init__(self, subcommands, cache_dir=None):
+        items = subcommands.items()
+        if not isinstance(subcommands, OrderedDict):
+            items = sorted(items)
+        self.paths = OrderedDict(items)
 
-            For example:
+        self.cache_dir = cache_dir
+        if self.cache_dir is None:
+            self.cache_dir = user_cache_dir("subcommands")
 
-            ``cli_positional_replacements = ['--environment', '--stack']``
-                Will mean the first positional argument becomes the value for --environment and the second positional becomes the value for '--stack'
+    def names(self):
+        return list(self.paths)
 
-                Note for this to work, you must do something like:
+    def __contains__(self, name):
+        return name in self.paths
 
-                .. code-block:: python
+    def load(self, name):
+        """Import and return the subcommand with this name"""
+        if name not in self.paths:
+            raise lazy("BadOption")("Unknown subcommand", wanted=name, available=self.names())
 
-                    def setup_other_args(self, parser, defaults):
-                        parser.add_argument('--environment'
-                            , help = "the environment!"
-                            , **defaults['--environment']
-                            )
+        import importlib
+        module_name, _, attribute = self.paths[name].partition(":")
+        try:
+            found = importlib.import_module(module_name)
+            for part in attribute.split("."):
+                if part:
+                    found = getattr(found, part)
+        except (ImportError, AttributeError) as error:
+            raise lazy("BadOption")("Failed to import subcommand", name=name, path=self.paths[name], error=error)
+        return found
+
+    def origin(self, path):
+        """Return (file, mtime, size) for the module in this path, or Nones if we can't find it"""
+        try:
+            from importlib.util import find_spec
+            spec = find_spec(path.partition(":")[0])
+            stat = os.stat(spec.origin)
+            return [spec.origin, getattr(stat, "st_mtime_ns", stat.st_mtime), stat.st_size]
+        except Exception:
+            return [None, None, None]
 
-            Items in positional_replacements may also be a tuple of ``(replacement, default)``
+    def descriptions(self):
+        """Return an OrderedDict of {name: description}, only importing subcommands that changed since last time"""
+        import hashlib
+        import json
 
-            For example:
+        key = hashlib.sha1(json.dumps(list(self.paths.items())).encode("utf-8")).hexdigest()
+        cache_location = os.path.join(self.cache_dir, "{0}.json".format(key))
 
-            ``cli_positional_replacements = [('--task', 'list_tasks')]``
-                will mean the first positional argument becomes the value for --task
+        try:
+            with open(cache_location) as fle:
+                cached = json.load(fle)
+        except Exception:
+            cached = {}
+
+        changed = False
+        descriptions = OrderedDict()
+        for name, path in self.paths.items():
+            origin = self.origin(path)
+            if name in cached and cached[name][:3] == origin:
+                descriptions[name] = cached[name][3]
+                continue
+
+            found = self.load(name)
+            description = getattr(found, "description", None) or getattr(found, "__doc__", None) or ""
+            descriptions[name] = description.strip().split("\n")[0]
+            cached[name] = origin + [descriptions[name]]
+            changed = True
+
+        if changed:
+            try:
+                if not os.path.exists(self.cache_dir):
+                    os.makedirs(self.cache_dir)
+                temporary = "{0}.{1}.tmp".format(cache_location, os.getpid())
+                with open(temporary, "w") as fle:
+                    json.dump(cached, fle)
+                os.rename(temporary, cache_location)
+            except (IOError, OSError) as error:
+                log.debug("Failed to cache subcommand descriptions\tlocation=%s\terror=%s", cache_location, error)
+
+        return descriptions
+
+    def help(self):
+        """Return the list of subcommands for the end of --help"""
+        descriptions = self.descriptions()
+        width = max([len(name) for name in descriptions] + [0])
+        lines = ["subcommands:"]
+        for name, description in descriptions.items():
+            lines.append("  {0}  {1}".format(name.ljust(width), description).rstrip())
+        return "\n".join(lines)
 
-                But if it's not specified, then ``defaults['--task'] == {"default": "list_tasks"}``
+########################
+###   HELP CACHE
+########################
 
-    ``Hooks``
+class HelpCache(object):
+    """
+    Rendered --help output kept in cache_dir
 
-        .. automethod:: execute
+    Each entry is in a file named after the hash of its key, so entries for
+    definitions that have changed are never read again.
+    """
+    def __init__(self, cache_dir=None):
+        self.cache_dir = cache_dir
+        if self.cache_dir is None:
+            self.cache_dir = user_cache_dir("help")
+
+    def location(self, key):
+        import hashlib
+        import json
+        digest = hashlib.sha1(json.dumps(key, sort_keys=True, default=repr).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, "{0}.txt".format(digest))
+
+    def get(self, key):
+        """Return the help we have for this key or None"""
+        try:
+            with open(self.location(key), "rb") as fle:
+                return fle.read().decode("utf-8")
+        except (IOError, OSError):
+            return None
+
+    def set(self, key, text):
+        """Remember the help for this key"""
+        location = self.location(key)
+        try:
+            if not os.path.exists(self.cache_dir):
+                os.makedirs(self.cache_dir)
+            temporary = "{0}.{1}.tmp".format(location, os.getpid())
+            with open(temporary, "wb") as fle:
+                fle.write(text.encode("utf-8"))
+            os.rename(temporary, location)
+        except (IOError, OSError) as error:
+            log.debug("Failed to cache help\tlocation=%s\terror=%s", location, error)
+
+    def invalidate(self):
+        """Forget all the help we have"""
+        if os.path.exists(self.cache_dir):
+            for name in os.listdir(self.cache_dir):
+                if name.endswith(".txt"):
+                    os.remove(os.path.join(self.cache_dir, name))
 
-        .. automethod:: setup_other_logging
+########################
+###   CATEGORIES
+########################
 
-        .. automethod:: specify_other_args
+class CategoryTrie(object):
     """
+    Knows which of the cli_categories each argparse dest belongs to
 
-    ########################
-    ###   SETTABLE PROPERTIES
-    ########################
+    Categories are split into words on underscores and stored in a trie so that
+    finding the category for a dest is one walk along the words in that dest.
 
-    VERSION = Ignore
-    boto_useragent_name = Ignore
+    A category may be nested with dots, so ``app.db`` means ``app_db_timeout`` ends
+    up as ``cli_args["app"]["db"]["timeout"]``. When a dest matches more than one
+    category, the longest category wins.
+    """
+    def __init__(self, categories):
+        self.root = {}
+        self.paths = []
+        self.indexes = {}
+        self.categories = tuple(categories)
+        for category in categories:
+            path = tuple(category.split("."))
+            self.paths.append(path)
+
+            node = self.root
+            for word in "_".join(path).split("_"):
+                node = node.setdefault(word, {})
+            node[None] = path
+
+    def split(self, key):
+        """Return (path, rest) for the longest category this key is in, or (None, key) if it isn't in one"""
+        found = (None, key)
+        words = key.split("_")
+
+        node = self.root
+        for index, word in enumerate(words[:-1]):
+            node = node.get(word)
+            if node is None:
+                break
+            if None in node:
+                found = (node[None], "_".join(words[index+1:]))
 
-    CliParserKls = property(lambda s: CliParser)
-    logging_handler_file = property(lambda s: sys.stderr)
+        return found
 
-    cli_categories = None
-    cli_description = "My amazing app"
-    cli_environment_defaults = None
-    cli_positional_replacements = None
+    def categorize(self, items):
+        """Return a dictionary from these (key, val) items that is broken up by our categories"""
+        cli_args = {}
+        containers = {}
+        for path in self.paths:
+            container = cli_args
+            for part in path:
+                container = container.setdefault(part, {})
+            containers[path] = container
+
+        for key, val in items:
+            path, rest = self.split(key)
+            if path is None:
+                cli_args[key] = val
+            else:
+                containers[path][rest] = val
 
-    ########################
-    ###   USAGE
-    ########################
+        return cli_args
 
-    @classmethod
-    def main(kls):
+    def index(self, dests):
         """
-        Instantiates this class and calls the mainline
+        Return {path: {name: (is_category, target)}} for these argparse dests
 
-        Usage is intended to be:
+        Where target is the path of a nested category or the dest holding the value.
+        This is only worked out once for each set of dests.
+        """
+        key = tuple(sorted(dests))
+        index = self.indexes.get(key)
+        if index is not None:
+            return index
+
+        index = {(): {}}
+        for path in self.paths:
+            for depth in range(1, len(path) + 1):
+                index.setdefault(path[:depth], {})
+                index[path[:depth-1]][path[depth-1]] = (True, path[:depth])
+
+        for dest in key:
+            path, rest = self.split(dest)
+            index[path or ()][rest] = (False, dest)
+
+        self.indexes[key] = index
+        return index
+
+def _hashable(val):
+    """Return something hashable that represents this value"""
+    if isinstance(val, (list, tuple)):
+        return tuple(_hashable(v) for v in val)
+    if isinstance(val, (dict, Mapping)):
+        return frozenset((k, _hashable(v)) for k, v in val.items())
+    if isinstance(val, set):
+        return frozenset(val)
+    return val
+
+class CliArgs(Mapping):
+    """
+    A read only view of an argparse namespace, broken up by categories
 
-        .. code-block:: python
+    Values are read from the namespace when they are asked for rather than copied,
+    and may be accessed as ``cli_args["app"]["config"]`` or ``cli_args.app.config``.
 
-            from delfick_app import App
+    These are hashable, compare equal to the equivalent dictionary and pickle as
+    just the namespace and the categories.
 
-            class MyApp(App):
-                [..]
+    The index of categories is only worked out by the top level view and is
+    shared with the nested views it hands out.
+    """
+    __slots__ = ("_namespace", "_categories", "_path", "_index", "_entries")
+
+    def __init__(self, namespace, categories=(), path=(), index=None):
+        categories = tuple(categories)
+        if index is None:
+            index = category_trie(categories).index(vars(namespace))
+        for name, val in (("_namespace", namespace), ("_categories", categories), ("_path", path), ("_index", index), ("_entries", index[path])):
+            object.__setattr__(self, name, val)
+
+    def __getitem__(self, key):
+        is_category, target = self._entries[key]
+        if is_category:
+            return CliArgs(self._namespace, self._categories, target, self._index)
+        return getattr(self._namespace, target)
+
+    def __getattr__(self, key):
+        if key.startswith("_"):
+            raise AttributeError(key)
+        try:
+            return self[key]
+        except KeyError:
+            raise AttributeError(key)
 
-            main = MyApp.main
-        """
-        app = kls()
-        app.mainline()
+    def __setattr__(self, key, val):
+        raise AttributeError("CliArgs are read only")
 
-    def execute(self, args, extra_args, cli_args, logging_handler):
-        """Hook for executing the application itself"""
-        raise NotImplementedError()
+    def __iter__(self):
+        return iter(sorted(self._entries))
 
-    def setup_other_logging(self, args, verbose=False, silent=False, debug=False):
-        """
-        Hook for setting up any other logging configuration
+    def __len__(self):
+        return len(self._entries)
 
-        For example:
+    def __hash__(self):
+        return hash(_hashable(self))
 
-        .. code-block:: python
+    def __reduce__(self):
+        return (CliArgs, (self._namespace, self._categories, self._path))
 
-            def setup_other_logging(self, args, verbose, silent, debug):
-                logging.getLogger("boto").setLevel([logging.CRITICAL, logging.ERROR][verbose or debug])
-                logging.getLogger("requests").setLevel([logging.CRITICAL, logging.ERROR][verbose or debug])
-                logging.getLogger("paramiko.transport").setLevel([logging.CRITICAL, logging.ERROR][verbose or debug])
-        """
+    def __repr__(self):
+        return "<CliArgs {0}>".format(self.as_dict())
 
-    def specify_other_args(self, parser, defaults):
-        """
-        Hook for adding more arguments to the argparse Parser
+    def as_dict(self):
+        """Return a copy of this as nested dictionaries"""
+        return dict((key, val.as_dict() if isinstance(val, CliArgs) else val) for key, val in self.items())
 
-        For example:
+_category_tries = {}
 
-        .. code-block:: python
+def category_trie(categories):
+    """Return a CategoryTrie for these categories, only making one the first time we see them"""
+    key = tuple(categories)
+    trie = _category_tries.get(key)
+    if trie is None:
+        trie = _category_tries[key] = CategoryTrie(key)
+    return trie
 
-            def specify_other_args(self, parser, defaults):
-                parser.add_argument("--special"
-                    , help = "taste the rainbow"
-                    , action = "store_true"
-                    )
-        """
+########################
+###   CliParser
+########################
 
-    ########################
-    ###   INTERNALS
-    ########################
+class CliParser(object):
+    """
+    Knows what argv looks like
 
-    def set_boto_useragent(self):
-        """Make boto report this application as the user agent"""
-        if self.boto_useragent_name is not Ignore and self.VERSION is not Ignore:
-            __import__("boto")
-            useragent = sys.modules["boto.connection"].UserAgent
-            if self.boto_useragent_name not in useragent:
-                sys.modules["boto.connection"].UserAgent = "{0} {1}/{2}".format(useragent, self.boto_useragent_name, self.VERSION)
+    After parse_args has been called, ``parsed`` is the ``(args, other_args, defaults)``
+    from that parse so that it can be looked at again without parsing argv a second time.
 
-    def mainline(self, argv=None, print_errors_to=sys.stdout):
-        """
-        The mainline for the application
+    If ``parser_cache`` is a ParserCache then the ArgumentParser is taken from there.
 
-        * Initialize parser and parse argv
-        * Initialize the logging
-        * run self.execute()
-        * Catch and display DelfickError
-        * Display traceback if we catch an error and args.debug
-        """
-        cli_parser = None
-        try:
-            cli_parser = self.make_cli_parser()
-            try:
-                args, extra_args, cli_args = cli_parser.interpret_args(argv, self.cli_categories)
-                handler = self.setup_logging(args, verbose=args.verbose, silent=args.silent, debug=args.debug)
-                self.set_boto_useragent()
-                self.execute(args, extra_args, cli_args, handler)
-            except KeyboardInterrupt:
-                if cli_parser and cli_parser.parse_args(argv)[0].debug:
-                    raise
-                raise UserQuit()
-        except DelfickError as error:
-            print("", file=print_errors_to)
-            print("!" * 80, file=print_errors_to)
-            print("Something went wrong! -- {0}".format(error.__class__.__name__), file=print_errors_to)
-            print("\t{0}".format(error), file=print_errors_to)
-            if cli_parser and cli_parser.parse_args(argv)[0].debug:
-                raise
-            sys.exit(1)
+    If ``fan_out_jobs`` is set then we have a ``--jobs`` option with that as the default,
+    and the options in ``fan_out`` take comma separated values.
 
-    def setup_logging(self, args, verbose=False, silent=False, debug=False, logging_name=""):
-        """Setup the RainbowLoggingHandler for the logs and call setup_other_logging"""
-        log = logging.getLogger(logging_name)
-        handler = RainbowLoggingHandler(self.logging_handler_file)
-        handler._column_color['%(asctime)s'] = ('cyan', None, False)
-        handler._column_color['%(levelname)-7s'] = ('green', None, False)
-        handler._column_color['%(message)s'][logging.INFO] = ('blue', None, False)
-        handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)-7s %(name)-15s %(message)s"))
-        log.addHandler(handler)
-        log.setLevel([logging.INFO, logging.DEBUG][verbose or debug])
-        if silent:
-            log.setLevel(logging.ERROR)
+    If ``response_files`` is set then ``@file`` arguments are replaced with the arguments
+    in that file, and if ``extra_args_as_list`` is set then the arguments after a ``--``
+    are given back as a list instead of being joined into a string.
 
-        self.setup_other_logging(args, verbose, silent, debug)
-        return handler
+    If ``args_as_view`` is set then cli_args is a CliArgs rather than nested dictionaries.
 
-    def setup_logging_theme(self, handler, colors="light"):
-        """
-        Setup a logging theme
+    Environment variables are read from ``environment`` if it is an EnvironmentSnapshot,
+    and ``environment_prefixes`` is a map of variable prefix to --option prefix, so that
+    options without a default from elsewhere are taken from matching variables.
 
-        Currently there is only ``light`` and ``dark`` which consists of a difference
-        in color for INFO level messages.
-        """
-        if colors not in ("light", "dark"):
-            log.warning("Told to set colors to a theme we don't have\tgot=%s\thave=[light, dark]", colors)
-            return
+    If ``config_defaults`` is a ConfigDefaults then defaults for options are taken from it
+    below positional arguments and above environment variables. These are only read once
+    for each parse and are kept in ``config`` until the next one.
 
-        # Haven't put much effort into actually working out more than just the message colour
-        if colors == "light":
-            handler._column_color['%(message)s'][logging.INFO] = ('cyan', None, False)
-        else:
-            handler._column_color['%(message)s'][logging.INFO] = ('blue', None, False)
+    If ``subcommands`` is a SubcommandRegistry then the subcommand named by ``subcommand_option``
+    is imported before the parser is made and is put on ``subcommand``.
 
-    def make_cli_parser(self):
-        """Return a CliParser instance"""
-        properties = {"specify_other_args": self.specify_other_args}
-        return type("CliParser", (self.CliParserKls, ), properties)(self.cli_description, self.cli_positional_replacements, self.cli_environment_defaults)
+    If ``help_cache`` is a HelpCache then --help is answered from there when it can be,
+    keyed by ``help_key_extra`` and help_key.
 
-########################
-###   CliParser
-########################
+    How long it takes to split, make the parser and parse is recorded in ``timings``.
+    """
+    parser_cache = None
+    fan_out = None
+    fan_out_jobs = None
+    environment = None
+    subcommand = None
+    subcommands = None
+    args_as_view = False
+    help_requested = False
+    subcommand_name = None
+    config_defaults = None
+    subcommand_option = "--task"
+    help_cache = None
+    help_key_extra = ()
+    response_files = False
+    environment_prefixes = None
+    extra_args_as_list = False
 
-class CliParser(object):
-    """Knows what argv looks like"""
     def __init__(self, description, positional_replacements=None, environment_defaults=None):
+        self.config = None
+        self.parsed = None
+        self.timings = Timings()
         self.description = description
         self.positional_replacements = positional_replacements
         if self.positional_replacements is None:
@@ -289,25 +2853,16 @@ class CliParser(object):
         extra is all the arguments after a --
         and cli_args is a dictionary representation of the args object
         """
-        if categories is None:
-            categories = []
         args, extra = self.parse_args(argv)
+        return args, extra, self.make_cli_args(args, categories)
 
-        cli_args = {}
-        for category in categories:
-            cli_args[category] = {}
-        for key, val in sorted(vars(args).items()):
-            found = False
-            for category in categories:
-                if key.startswith("{0}_".format(category)):
-                    cli_args[category][key[(len(category)+1):]] = val
-                    found = True
-                    break
-
-            if not found:
-                cli_args[key] = val
-
-        return args, extra, cli_args
+    def make_cli_args(self, args, categories=None):
+        """Return the dictionary representation of this args object, broken up by categories"""
+        if categories is None:
+            categories = []
+        if self.args_as_view:
+            return CliArgs(args, categories)
+        return category_trie(categories).categorize(sorted(vars(args).items()))
 
     def parse_args(self, argv=None):
         """
@@ -315,35 +2870,231 @@ class CliParser(object):
 
         Also complain if any --argument is both specified explicitly and as a positional
         """
-        args, other_args, defaults = self.split_args(argv)
-        parser = self.make_parser(defaults)
-        parsed = parser.parse_args(args)
+        self.subcommand = None
+        self.subcommand_name = None
+        self.help_requested = False
+
+        with self.timings.timing("split_args"):
+            args, other_args, defaults = self.split_args(argv)
+
+        if self.subcommands is not None or self.help_cache is not None:
+            self.help_requested = "-h" in args or "--help" in args
+
+        if self.subcommands is not None:
+            self.subcommand_name = self.chosen_subcommand(args, defaults)
+
+        help_key = None
+        if self.help_requested and self.help_cache is not None:
+            help_key = self.help_key(defaults)
+            cached = self.help_cache.get(help_key)
+            if cached is not None:
+                sys.stdout.write(cached)
+                sys.exit(0)
+
+        if self.subcommands is not None and self.subcommand_name in self.subcommands:
+            with self.timings.timing("load_subcommand"):
+                self.subcommand = self.subcommands.load(self.subcommand_name)
+
+        with self.timings.timing("make_parser"):
+            if self.parser_cache is None:
+                parser = self.make_parser(defaults)
+            else:
+                parser = self.parser_cache.parser(self, defaults)
+
+        if help_key is not None:
+            self.help_cache.set(help_key, parser.format_help())
+
+        with self.timings.timing("parse_args"):
+            namespace = self.defaults_namespace(parser, defaults)
+            if namespace is None:
+                parsed = parser.parse_args(args)
+            else:
+                parsed = parser.parse_args(args, namespace)
+        self.parsed = (parsed, other_args, defaults)
         self.check_args(args, defaults, self.positional_replacements)
         return parsed, other_args
 
+    def parser_key(self):
+        """Return what the ArgumentParser we make depends on apart from the defaults"""
+        return (self.subcommand_name, self.help_requested)
+
+    def help_key(self, defaults):
+        """Return what our --help output depends on"""
+        try:
+            from shutil import get_terminal_size
+            width = get_terminal_size().columns
+        except ImportError:
+            width = os.environ.get("COLUMNS")
+
+        subcommands = None
+        if self.subcommands is not None:
+            subcommands = [(name, path, self.subcommands.origin(path)) for name, path in self.subcommands.paths.items()]
+
+        return [
+              list(self.help_key_extra), width, os.path.basename(sys.argv[0]), self.description
+            , sorted((flag, sorted(options.items())) for flag, options in defaults.items())
+            , self.subcommand_name, subcommands
+            ]
+
+    def chosen_subcommand(self, args, defaults):
+        """Return the value of subcommand_option from args or defaults"""
+        option = self.subcommand_option
+        for index in range(len(args) - 1, -1, -1):
+            if args[index] == option and index + 1 < len(args):
+                return args[index + 1]
+            if args[index].startswith("{0}=".format(option)):
+                return args[index][len(option)+1:]
+        return defaults.get(option, {}).get("default")
+
+    def environment_snapshot(self):
+        """Return our EnvironmentSnapshot, or a new one if we weren't given one"""
+        if self.environment is None:
+            return EnvironmentSnapshot()
+        return self.environment
+
+    def defaults_namespace(self, parser, defaults):
+        """
+        Return an argparse Namespace with defaults from environment_prefixes and config_defaults
+
+        Or None if there aren't any. Config defaults are preferred over the environment.
+        """
+        found = {}
+        if self.environment_prefixes:
+            found.update(self.environment_values(parser, defaults))
+        if self.config_defaults is not None:
+            found.update(self.config_values(parser, defaults))
+
+        if found:
+            import argparse
+            return argparse.Namespace(**found)
+
+    def config_values(self, parser, defaults):
+        """
+        Return {dest: value} for the options in our config_defaults
+
+        Options that already have a default from environment_defaults or a positional argument are left alone.
+        """
+        config = self.config_values_found()
+
+        found = {}
+        for action in parser._actions:
+            for option in action.option_strings:
+                if "default" in defaults.get(option, {}):
+                    break
+
+                if option in config:
+                    value = self.converted_value(action, config[option], "Config defaults has a bad value", option=option)
+                    if value is not Ignore:
+                        found[action.dest] = value
+                    break
+        return found
+
+    def config_values_found(self):
+        """Return the values from our config_defaults, only reading them once for each parse"""
+        if self.config is None:
+            self.config = self.config_defaults.values()
+        return self.config
+
+    def environment_values(self, parser, defaults):
+        """
+        Return {dest: value} for the options that match environment_prefixes
+
+        Options that already have a default from environment_defaults or a positional argument are left alone.
+        """
+        index = self.environment_snapshot().prefixed(self.environment_prefixes)
+
+        found = {}
+        for action in parser._actions:
+            for option in action.option_strings:
+                if "default" in defaults.get(option, {}):
+                    break
+
+                for prefix, flag_prefix in self.environment_prefixes.items():
+                    if not option.startswith(flag_prefix):
+                        continue
+
+                    rest = option[len(flag_prefix):].replace("-", "_").upper()
+                    if rest in index[prefix]:
+                        name, value = index[prefix][rest]
+                        value = self.converted_value(action, value, "Environment variable has a bad value", variable=name)
+                        if value is not Ignore:
+                            found[action.dest] = value
+                        break
+                else:
+                    continue
+                break
+
+        return found
+
+    def converted_value(self, action, value, complaint, **info):
+        """
+        Convert a default for this argparse action using its type and check it against its choices
+
+        Strings are converted like they were on the command line and values that are
+        already something else, like from a json config, are only checked.
+        """
+        is_string = isinstance(value, type(u"")) or isinstance(value, str)
+
+        if action.nargs == 0:
+            if action.const is None:
+                return Ignore
+            if is_string:
+                value = value.lower() in ("1", "true", "yes", "on")
+            return action.const if value else action.default
+
+        many = action.nargs in ("*", "+") or isinstance(action.nargs, int)
+        if not many:
+            values = [value]
+        elif is_string:
+            values = value.split()
+        elif isinstance(value, (list, tuple)):
+            values = list(value)
+        else:
+            values = [value]
+
+        converted = []
+        for val in values:
+            if callable(action.type) and (isinstance(val, type(u"")) or isinstance(val, str)):
+                import argparse
+                try:
+                    val = action.type(val)
+                except (TypeError, ValueError, argparse.ArgumentTypeError) as error:
+                    raise lazy("BadOption")(complaint, value=value, error=error, **info)
+
+            if action.choices is not None and val not in action.choices:
+                raise lazy("BadOption")(complaint, value=value, available=list(action.choices), **info)
+            converted.append(val)
+
+        return converted if many else converted[0]
+
     def check_args(self, args, defaults, positional_replacements):
         """Check that we haven't specified an arg as positional and a --flag"""
         for index, replacement in enumerate(positional_replacements):
             if type(replacement) is tuple:
                 replacement, _ = replacement
             if "default" in defaults.get(replacement, {}) and replacement in args:
-                raise BadOption("Please don't specify an option as a positional argument and as a --flag", argument=replacement, position=index+1)
+                raise lazy("BadOption")("Please don't specify an option as a positional argument and as a --flag", argument=replacement, position=index+1)
 
     def split_args(self, argv):
         """
         Split up argv into args, other_args and defaults
 
         Other args is anything after a "--" and args is everything before a "--"
+
+        Other args is joined into a string unless ``extra_args_as_list`` is set
+        and ``@file`` arguments are expanded if ``response_files`` is set.
         """
         if argv is None:
             argv = sys.argv[1:]
 
+        self.config = None
+        if self.response_files:
+            argv = self.expand_response_files(argv)
+
         args = []
-        argv = list(argv)
         extras = None
 
-        while argv:
-            nxt = argv.pop(0)
+        for nxt in argv:
             if extras is not None:
                 extras.append(nxt)
             elif nxt == "--":
@@ -351,13 +3102,48 @@ class CliParser(object):
             else:
                 args.append(nxt)
 
-        other_args = ""
-        if extras:
-            other_args = " ".join(extras)
+        other_args = extras or []
+        if not self.extra_args_as_list:
+            other_args = " ".join(other_args)
 
         defaults = self.make_defaults(args, self.positional_replacements, self.environment_defaults)
         return args, other_args, defaults
 
+    def expand_response_files(self, argv, reading=(), passing=None):
+        """
+        Yield argv with any ``@file`` replaced by the arguments in that file
+
+        Response files have one argument per line and blank lines are ignored.
+        They are read a line at a time so that huge lists of arguments don't need
+        to be in memory twice, and may themselves refer to other response files.
+
+        Everything after the first ``--`` is passed through as is, whether that
+        ``--`` came from argv or from a response file.
+        """
+        if passing is None:
+            passing = [False]
+
+        for arg in argv:
+            if passing[0] or len(arg) < 2 or not arg.startswith("@"):
+                if arg == "--":
+                    passing[0] = True
+                yield arg
+                continue
+
+            location = os.path.abspath(arg[1:])
+            if location in reading:
+                raise lazy("BadOption")("Response file refers to itself", location=location)
+
+            try:
+                fle = open(location)
+            except (IOError, OSError) as error:
+                raise lazy("BadOption")("Couldn't read response file", location=location, error=error)
+
+            with fle:
+                lines = (line.rstrip("\r\n") for line in fle)
+                for nxt in self.expand_response_files((line for line in lines if line), reading + (location, ), passing):
+                    yield nxt
+
     def make_defaults(self, argv, positional_replacements, environment_defaults):
         """
         Make and return a dictionary of {--flag: {"default": value}}
@@ -381,27 +3167,38 @@ class CliParser(object):
 
         class Ignore(object): pass
 
+        environment = self.environment_snapshot()
         for env_name, replacement in environment_defaults.items():
             default = Ignore
             if type(replacement) is tuple:
                 replacement, default = replacement
 
-            if env_name in os.environ:
-                defaults[replacement] = {"default": os.environ[env_name]}
+            if env_name in environment:
+                defaults[replacement] = {"default": environment[env_name]}
             else:
                 if default is Ignore:
                     defaults[replacement] = {}
                 else:
                     defaults[replacement] = {"default": default}
 
+        if self.config_defaults is not None:
+            config = self.config_values_found()
+            for replacement in list(defaults) + list(positional_replacements):
+                if type(replacement) is tuple:
+                    replacement, _ = replacement
+                if replacement in config:
+                    defaults[replacement] = {"default": config[replacement]}
+
+        consumed = 0
         for replacement in positional_replacements:
             if type(replacement) is tuple:
                 replacement, _ = replacement
-            if argv and not argv[0].startswith("-"):
-                defaults[replacement] = {"default": argv[0]}
-                argv.pop(0)
+            if consumed < len(argv) and not argv[consumed].startswith("-"):
+                defaults[replacement] = {"default": argv[consumed]}
+                consumed += 1
             else:
                 break
+        del argv[:consumed]
 
         for replacement in positional_replacements:
             default = Ignore
@@ -416,8 +3213,12 @@ class CliParser(object):
         return defaults
 
     def make_parser(self, defaults):
-        """Create an argparse ArgumentParser, setup --verbose, --silent, --debug and call specify_other_args"""
-        parser = argparse.ArgumentParser(description=self.description)
+        """Create an argparse ArgumentParser, setup --verbose, --silent, --debug, --profile, --memprofile, --timings, call specify_other_args, add any subcommands and split fan_out options"""
+        import argparse
+        if self.subcommands is None:
+            parser = argparse.ArgumentParser(description=self.description)
+        else:
+            parser = argparse.ArgumentParser(description=self.description, formatter_class=argparse.RawDescriptionHelpFormatter)
 
         logging = parser.add_mutually_exclusive_group()
         logging.add_argument("--verbose"
@@ -435,6 +3236,162 @@ class CliParser(object):
             , action = "store_true"
             )
 
+        parser.add_argument("--profile"
+            , help = "Profile the app and write the stats to this file (or a generated name)"
+            , nargs = "?"
+            , const = True
+            , default = None
+            , metavar = "PSTATS_FILE"
+            )
+
+        parser.add_argument("--memprofile"
+            , help = "Trace memory allocations and optionally dump a tracemalloc snapshot to this file"
+            , nargs = "?"
+            , const = True
+            , default = None
+            , metavar = "SNAPSHOT_FILE"
+            )
+
+        parser.add_argument("--timings"
+            , help = "Display how long each part of starting up took"
+            , action = "store_true"
+            )
+
+        if self.fan_out_jobs is not None:
+            parser.add_argument("--jobs"
+                , help = "How many targets to run at the same time"
+                , type = int
+                , default = self.fan_out_jobs
+                )
+
         self.specify_other_args(parser, defaults)
+        if self.subcommands is not None:
+            self.specify_subcommand_args(parser, defaults)
+        if self.fan_out:
+            self.specify_fan_out_args(parser)
         return parser
 
+    def specify_fan_out_args(self, parser):
+        """Make the options in fan_out split comma separated values before their type and choices are used"""
+        for flag in self.fan_out:
+            action = parser._option_string_actions.get(flag)
+            if action is None or isinstance(action.type, FanOutType):
+                continue
+
+            action.type = FanOutType(action.type, action.choices)
+            if action.choices is not None:
+                action.choices = FanOutChoices(action.choices)
+
+    def specify_subcommand_args(self, parser, defaults):
+        """
+        Add subcommand_option if specify_other_args didn't, let the subcommand add its own
+        arguments and, if --help was asked for, list the subcommands at the end of it
+        """
+        if self.subcommand_option not in parser._option_string_actions:
+            parser.add_argument(self.subcommand_option
+                , help = "The subcommand to run"
+                , choices = self.subcommands.names()
+                , **defaults.get(self.subcommand_option, {})
+                )
+
+        if self.subcommand is not None and hasattr(self.subcommand, "specify_other_args"):
+            self.subcommand.specify_other_args(parser, defaults)
+
+        if self.help_requested:
+            parser.epilog = self.subcommands.help()
+
+
+########################
+###   DAEMON CLIENT
+########################
+
+def _send_message(connection, message, fds=None):
+    """Send a length prefixed json message, with file descriptors if we have any"""
+    import struct
+    import json
+
+    data = json.dumps(message).encode("utf-8")
+    header = struct.pack(">I", len(data))
+    if fds:
+        import socket
+        import array
+        connection.sendmsg([header], [(socket.SOL_SOCKET, socket.SCM_RIGHTS, array.array("i", fds))])
+    else:
+        connection.sendall(header)
+    connection.sendall(data)
+
+def _receive_message(connection, fds=0):
+    """Receive a message from _send_message and return (message, fds)"""
+    import struct
+    import json
+
+    received = []
+    if fds:
+        import socket
+        import array
+        fds_array = array.array("i")
+        header, ancillary, _, _ = connection.recvmsg(4, socket.CMSG_LEN(fds * fds_array.itemsize))
+        for level, kind, data in ancillary:
+            if level == socket.SOL_SOCKET and kind == socket.SCM_RIGHTS:
+                fds_array.frombytes(data[:len(data) - (len(data) % fds_array.itemsize)])
+        received = list(fds_array)
+    else:
+        header = b""
+
+    header = header + _receive_exactly(connection, 4 - len(header))
+    data = _receive_exactly(connection, struct.unpack(">I", header)[0])
+    return json.loads(data.decode("utf-8")), received
+
+def _receive_exactly(connection, length):
+    """Keep receiving until we have length bytes"""
+    data = b""
+    while len(data) < length:
+        chunk = connection.recv(length - len(data))
+        if not chunk:
+            raise EOFError("Connection closed before we got everything")
+        data += chunk
+    return data
+
+def run_client(socket_path, argv=None, stdio=None):
+    """
+    Ask the daemon listening on socket_path to run the mainline with our argv and return the exit code
+
+    We give the daemon our stdin, stdout and stderr (or the three file descriptors in stdio),
+    our working directory and the environment variables it asks for.
+    If we get a Ctrl-c it's passed on to the worker.
+    """
+    import socket
+    import signal
+
+    if argv is None:
+        argv = sys.argv[1:]
+
+    if stdio is None:
+        stdio = [0, 1, 2]
+
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    connection.connect(socket_path)
+    try:
+        wanted, _ = _receive_message(connection)
+        prefixes = tuple(wanted.get("environment_prefixes", ()))
+        environment = dict((name, os.environ[name]) for name in wanted["environment"] if name in os.environ)
+        environment.update((name, value) for name, value in os.environ.items() if prefixes and name.startswith(prefixes))
+        for stream in (sys.stdout, sys.stderr):
+            stream.flush()
+        _send_message(connection, {"argv": list(argv), "cwd": os.getcwd(), "environment": environment}, fds=stdio)
+
+        pid = _receive_message(connection)[0]["pid"]
+        while True:
+            try:
+                return _receive_message(connection)[0]["exit"]
+            except KeyboardInterrupt:
+                os.kill(pid, signal.SIGINT)
+            except EOFError:
+                # The worker died without telling us how it went
+                return 1
+    finally:
+        connection.close()
+
+def client_main(socket_path):
+    """Exit with the exit code from running our argv through the daemon on socket_path"""
+    sys.exit(run_client(socket_path))
@@ -0,0 +1,68 @@
+# coding: spec
+
+from delfick_app import App
+
+from delfick_error import DelfickError, DelfickErrorTestMixin
+from six.moves import StringIO
+from unittest import TestCase
+from textwrap import dedent
+import threading
+import asyncio
+
+class TestCase(TestCase, DelfickErrorTestMixin): pass
+
+describe TestCase, "App with an async execute":
+    it "runs execute on an event loop":
+        called = []
+        class MyApp(App):
+            async_executor_size = 2
+
+            async def execute(slf, args, extra_args, cli_args, handler):
+                loop = asyncio.get_event_loop()
+                thread = await loop.run_in_executor(None, threading.current_thread)
+                called.append((args.verbose, thread is not threading.current_thread()))
+
+        self.assertEqual(MyApp().mainline(["--verbose"], exit_on_error=False), 0)
+        self.assertEqual(called, [(True, True)])
+
+    it "prints DelfickError from tasks":
+        fle = StringIO()
+        class MyApp(App):
+            async def execute(slf, args, extra_args, cli_args, handler):
+                async def fail():
+                    raise DelfickError("nope", thing=1)
+                await asyncio.gather(fail(), asyncio.sleep(0))
+
+        self.assertEqual(MyApp().mainline([], print_errors_to=fle, exit_on_error=False), 1)
+        self.assertEqual(fle.getvalue(), dedent("""
+            !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
+            Something went wrong! -- DelfickError
+            \t"nope"\tthing=1
+        """))
+
+    it "cancels outstanding tasks and raises UserQuit on KeyboardInterrupt":
+        fle = StringIO()
+        cancelled = []
+        class MyApp(App):
+            async def execute(slf, args, extra_args, cli_args, handler):
+                async def forever():
+                    try:
+                        await asyncio.sleep(1000)
+                    except asyncio.CancelledError:
+                        cancelled.append(True)
+                        raise
+                asyncio.get_event_loop().create_task(forever())
+                await asyncio.sleep(0)
+                raise KeyboardInterrupt()
+
+        self.assertEqual(MyApp().mainline([], print_errors_to=fle, exit_on_error=False), 1)
+        self.assertEqual(cancelled, [True])
+        assert "Something went wrong! -- UserQuit" in fle.getvalue()
+
+    it "still raises KeyboardInterrupt with --debug":
+        class MyApp(App):
+            async def execute(slf, args, extra_args, cli_args, handler):
+                raise KeyboardInterrupt()
+
+        with self.fuzzyAssertRaisesError(KeyboardInterrupt):
+            MyApp().mainline(["--debug"])
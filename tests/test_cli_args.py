@@ -0,0 +1,75 @@
+# coding: spec
+
+from delfick_app import App, CliArgs
+
+from unittest import TestCase
+import argparse
+import mock
+import pickle
+
+describe TestCase, "CliArgs":
+    def setUp(self):
+        self.namespace = argparse.Namespace(app_config="c.yml", app_db_timeout=5, app_db_hosts=["a", "b"], other=1)
+        self.cli_args = CliArgs(self.namespace, ["app", "app.db"])
+
+    it "can be accessed by key or by attribute":
+        self.assertEqual(self.cli_args["app"]["config"], "c.yml")
+        self.assertEqual(self.cli_args.app.db.timeout, 5)
+        self.assertEqual(self.cli_args.other, 1)
+        self.assertEqual(sorted(self.cli_args), ["app", "other"])
+        self.assertEqual(len(self.cli_args.app), 2)
+
+        with self.assertRaises(KeyError):
+            self.cli_args["nope"]
+        with self.assertRaises(AttributeError):
+            self.cli_args.nope
+
+    it "only works out the index for the top level view":
+        with mock.patch("delfick_app.CategoryTrie.index") as index:
+            self.assertEqual(self.cli_args.app.db.timeout, 5)
+            self.assertEqual(self.cli_args["app"]["config"], "c.yml")
+        self.assertEqual(len(index.mock_calls), 0)
+
+    it "reads from the namespace rather than copying":
+        self.namespace.app_db_timeout = 10
+        self.assertEqual(self.cli_args.app.db.timeout, 10)
+
+    it "is read only":
+        with self.assertRaises(AttributeError):
+            self.cli_args.other = 2
+        with self.assertRaises(TypeError):
+            self.cli_args["other"] = 2
+
+    it "equals the equivalent dictionary":
+        expected = {"app": {"config": "c.yml", "db": {"timeout": 5, "hosts": ["a", "b"]}}, "other": 1}
+        self.assertEqual(self.cli_args, expected)
+        self.assertEqual(self.cli_args.as_dict(), expected)
+        self.assertIs(type(self.cli_args.as_dict()["app"]["db"]), dict)
+
+    it "is hashable":
+        same = CliArgs(argparse.Namespace(app_config="c.yml", app_db_timeout=5, app_db_hosts=["a", "b"], other=1), ["app", "app.db"])
+        self.assertEqual(hash(self.cli_args), hash(same))
+        self.assertEqual({self.cli_args: 1}[same], 1)
+
+    it "can be pickled":
+        unpickled = pickle.loads(pickle.dumps(self.cli_args))
+        self.assertEqual(unpickled, self.cli_args)
+        self.assertEqual(unpickled.app.db.hosts, ["a", "b"])
+
+    it "is given to execute when cli_args_as_view is set":
+        called = []
+
+        class MyApp(App):
+            cli_categories = ["app"]
+            cli_args_as_view = True
+
+            def specify_other_args(self, parser, defaults):
+                parser.add_argument("--app-config", dest="app_config")
+
+            def execute(self, args, extra_args, cli_args, handler):
+                called.append(cli_args)
+
+        self.assertEqual(MyApp().mainline(["--app-config", "c.yml", "--silent"], exit_on_error=False), 0)
+        self.assertIsInstance(called[0], CliArgs)
+        self.assertEqual(called[0].app.config, "c.yml")
+        self.assertIs(called[0]._namespace, called[0].app._namespace)
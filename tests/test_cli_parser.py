@@ -1,11 +1,13 @@
 # coding: spec
 
-from delfick_app import CliParser, Ignore, BadOption
+from delfick_app import CliParser, EnvironmentSnapshot, Ignore, BadOption
 
 from delfick_error import DelfickErrorTestMixin
 from contextlib import contextmanager
 from itertools import combinations
 from unittest import TestCase
+import tempfile
+import shutil
 import mock
 import sys
 import re
@@ -13,6 +15,14 @@ import os
 
 class TestCase(TestCase, DelfickErrorTestMixin): pass
 
+@contextmanager
+def a_temp_dir():
+    directory = tempfile.mkdtemp()
+    try:
+        yield directory
+    finally:
+        shutil.rmtree(directory)
+
 describe TestCase, "CliParser":
     @contextmanager
     def swapped_env(self, **swapped):
@@ -95,6 +105,20 @@ describe TestCase, "CliParser":
             self.assertEqual(parsed.blah, "tree")
             self.assertEqual(parsed.meh, "bus")
 
+        it "remembers what it parsed":
+            class Parser(CliParser):
+                def specify_other_args(slf, parser, defaults):
+                    parser.add_argument("--task"
+                        , help = "specify the task"
+                        , **defaults["--task"]
+                        )
+
+            parser = Parser("", ["--task"], {})
+            self.assertIs(parser.parsed, None)
+
+            parsed, other_args = parser.parse_args(['whatever', '--debug', '--', 'stuff'])
+            self.assertEqual(parser.parsed, (parsed, "stuff", {"--task": {"default": "whatever"}}))
+
         it "works in the error case":
             class Parser(CliParser):
                 def specify_other_args(slf, parser, defaults):
@@ -119,6 +143,53 @@ describe TestCase, "CliParser":
             with self.fuzzyAssertRaisesError(BadOption, "Please don't specify an option as a positional argument and as a --flag", argument="--env", position=2):
                 parser.check_args(['list_tasks', 'dev', '--env', 'staging'], defaults, positional_replacements)
 
+    describe "environment_prefixes":
+        def make_parser(self, environ):
+            class Parser(CliParser):
+                def specify_other_args(slf, parser, defaults):
+                    parser.add_argument("--config", **defaults["--config"])
+                    parser.add_argument("--pool-size", type=int, default=1)
+                    parser.add_argument("--hosts", nargs="+")
+                    parser.add_argument("--mode", choices=["fast", "slow"])
+                    parser.add_argument("--dry-run", action="store_true")
+
+            parser = Parser("", ["--config"], {"APP_CONFIG_FILE": "--config"})
+            parser.environment_prefixes = {"APP_": "--"}
+            parser.environment = EnvironmentSnapshot(environ)
+            return parser
+
+        it "takes converted values from variables with the prefix":
+            parser = self.make_parser({"APP_POOL_SIZE": "3", "APP_HOSTS": "a b", "APP_MODE": "slow", "APP_DRY_RUN": "yes", "OTHER_MODE": "fast"})
+            args, _ = parser.parse_args([])
+            self.assertEqual((args.pool_size, args.hosts, args.mode, args.dry_run), (3, ["a", "b"], "slow", True))
+
+            args, _ = self.make_parser({"APP_DRY_RUN": "0"}).parse_args([])
+            self.assertEqual((args.pool_size, args.dry_run), (1, False))
+
+        it "prefers the command line, positionals and environment_defaults":
+            parser = self.make_parser({"APP_POOL_SIZE": "3", "APP_CONFIG": "from_prefix", "APP_CONFIG_FILE": "from_defaults"})
+            args, _ = parser.parse_args(["--pool-size", "4"])
+            self.assertEqual((args.pool_size, args.config), (4, "from_defaults"))
+
+            args, _ = self.make_parser({"APP_CONFIG": "from_prefix"}).parse_args(["positional"])
+            self.assertEqual(args.config, "positional")
+
+            args, _ = self.make_parser({"APP_CONFIG": "from_prefix"}).parse_args([])
+            self.assertEqual(args.config, "from_prefix")
+
+        it "complains about values that can't be converted":
+            with self.fuzzyAssertRaisesError(BadOption, "Environment variable has a bad value", variable="APP_POOL_SIZE", value="lots"):
+                self.make_parser({"APP_POOL_SIZE": "lots"}).parse_args([])
+
+            with self.fuzzyAssertRaisesError(BadOption, "Environment variable has a bad value", variable="APP_MODE", available=["fast", "slow"]):
+                self.make_parser({"APP_MODE": "medium"}).parse_args([])
+
+        it "reads environment_defaults from the snapshot rather than os.environ":
+            parser = CliParser("")
+            parser.environment = EnvironmentSnapshot({"CONFIG_LOCATION": "from_snapshot"})
+            with self.swapped_env(CONFIG_LOCATION="from_environ"):
+                self.assertEqual(parser.make_defaults([], [], {"CONFIG_LOCATION": "--config"}), {"--config": {"default": "from_snapshot"}})
+
     describe "interpret_args":
         it "can categorize based on categories and names of args":
             class Parser(CliParser):
@@ -142,7 +213,25 @@ describe TestCase, "CliParser":
             self.assertEqual(args.my_app_two, "2")
             self.assertEqual(args.other, "3")
 
-            self.assertEqual(cli_args, {"my_app": {"one": "1", "two": "2"}, "other": "3", "silent": False, "debug": False, "verbose": False})
+            self.assertEqual(cli_args, {"my_app": {"one": "1", "two": "2"}, "other": "3", "silent": False, "debug": False, "verbose": False, "timings": False, "profile": None, "memprofile": None})
+
+        it "can nest categories and prefers the longest category":
+            class Parser(CliParser):
+                def specify_other_args(slf, parser, defaults):
+                    parser.add_argument("--app-name", dest="app_name")
+                    parser.add_argument("--app-db-timeout", dest="app_db_timeout")
+                    parser.add_argument("--app-db-pool-size", dest="app_db_pool_size")
+                    parser.add_argument("--app-dbs", dest="app_dbs")
+                    parser.add_argument("--my-app-db-user", dest="my_app_db_user")
+                    parser.add_argument("--my-app-other", dest="my_app_other")
+
+            parser = Parser("")
+            argv = ["--app-name", "a", "--app-db-timeout", "5", "--app-db-pool-size", "2", "--app-dbs", "d", "--my-app-db-user", "u", "--my-app-other", "o"]
+            _, _, cli_args = parser.interpret_args(argv, ["app", "app.db", "my_app_db"])
+
+            self.assertEqual(cli_args["app"], {"name": "a", "dbs": "d", "db": {"timeout": "5", "pool_size": "2"}})
+            self.assertEqual(cli_args["my_app_db"], {"user": "u"})
+            self.assertEqual(cli_args["my_app_other"], "o")
 
     describe "make_defaults":
         it "has no defaults if there are no positional_replacements or environment_defaults":
@@ -294,6 +383,58 @@ describe TestCase, "CliParser":
             self.assertEqual(other_args, 'and stuff')
             self.assertEqual(defaults, {'--env': {"default": "dev"}, "--task": {"default": "list_tasks"}, "--config": {"default": "somewhere"}})
 
+        it "can give back other_args as a list":
+            parser = CliParser("")
+            parser.extra_args_as_list = True
+            self.assertEqual(parser.split_args(['a', '--', 'b', '--', 'c'])[:2], (['a'], ['b', '--', 'c']))
+            self.assertEqual(parser.split_args(['a'])[:2], (['a'], []))
+
+        it "expands response files if asked to":
+            with a_temp_dir() as directory:
+                inner = os.path.join(directory, "inner")
+                with open(inner, "w") as fle:
+                    fle.write("--\nfile one\n\nfile_two\n")
+
+                outer = os.path.join(directory, "outer")
+                with open(outer, "w") as fle:
+                    fle.write("--blah\n1\n@{0}\n".format(inner))
+
+                parser = CliParser("", ['--task'])
+                self.assertEqual(parser.split_args(['t', '@{0}'.format(outer)])[:2], (['@{0}'.format(outer)], ''))
+
+                parser.response_files = True
+                args, other_args, defaults = parser.split_args(['t', '@{0}'.format(outer), 'file_three'])
+                self.assertEqual(args, ['--blah', '1'])
+                self.assertEqual(other_args, 'file one file_two file_three')
+                self.assertEqual(defaults, {"--task": {"default": "t"}})
+
+        it "doesn't expand response files after a --":
+            with a_temp_dir() as directory:
+                options = os.path.join(directory, "options")
+                with open(options, "w") as fle:
+                    fle.write("--blah\n--\n@someone\n")
+
+                parser = CliParser("")
+                parser.response_files = True
+                parser.extra_args_as_list = True
+                self.assertEqual(parser.split_args(['--', '@someone'])[:2], ([], ['@someone']))
+                self.assertEqual(parser.split_args(['@{0}'.format(options), '@else'])[:2], (['--blah'], ['@someone', '@else']))
+
+        it "complains about response files that can't be read or refer to themselves":
+            with a_temp_dir() as directory:
+                parser = CliParser("")
+                parser.response_files = True
+
+                missing = os.path.join(directory, "missing")
+                with self.fuzzyAssertRaisesError(BadOption, "Couldn't read response file", location=missing):
+                    parser.split_args(['@{0}'.format(missing)])
+
+                looping = os.path.join(directory, "looping")
+                with open(looping, "w") as fle:
+                    fle.write("a\n@{0}\n".format(looping))
+                with self.fuzzyAssertRaisesError(BadOption, "Response file refers to itself", location=looping):
+                    parser.split_args(['@{0}'.format(looping)])
+
     describe "make_parser":
         it "calls specify_other_args with the parser":
             parser = mock.Mock(name="parser")
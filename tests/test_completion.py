@@ -0,0 +1,80 @@
+# coding: spec
+
+from delfick_app import App
+
+from six.moves import StringIO
+from unittest import TestCase
+import subprocess
+import tempfile
+import shutil
+import time
+import os
+
+class CompletingApp(App):
+    cli_positional_replacements = ["--task", ("--environment", "dev")]
+    completion_dynamic = ["--stack"]
+
+    def specify_other_args(self, parser, defaults):
+        parser.add_argument("--task", choices=["deploy", "list"], **defaults["--task"])
+        parser.add_argument("--environment", **defaults["--environment"])
+        parser.add_argument("--stack")
+        parser.add_argument("--mode", choices=["fast", "slow"])
+
+    def completion_values(self, option):
+        return ["{0}_one".format(option.strip("-")), "{0}_two".format(option.strip("-"))]
+
+describe TestCase, "Completion":
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.script = os.path.join(self.directory, "completion.sh")
+        with open(self.script, "w") as fle:
+            fle.write(CompletingApp().completion_script("my-app"))
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def complete(self, *words):
+        command = 'source {0}; COMP_WORDS=({1}); COMP_CWORD={2}; _my_app; echo "${{COMPREPLY[@]}}"'.format(
+              self.script, " ".join("'{0}'".format(word) for word in words), len(words) - 1
+            )
+        env = dict(os.environ, XDG_CACHE_HOME=self.directory)
+        return subprocess.check_output(["bash", "-c", command], env=env).decode().split()
+
+    it "completes options, choices and positionals without starting python":
+        self.assertEqual(self.complete(self.script, "--mo"), ["--mode"])
+        self.assertEqual(self.complete(self.script, "--mode", ""), ["fast", "slow"])
+        self.assertEqual(self.complete(self.script, "de"), ["deploy"])
+        self.assertEqual(self.complete(self.script, "--silent", "de"), [])
+        self.assertEqual(self.complete(self.script, "--environment", ""), [])
+
+    it "caches dynamic values until they expire":
+        calls = os.path.join(self.directory, "calls")
+        prog = os.path.join(self.directory, "my-app")
+        with open(prog, "w") as fle:
+            fle.write("#!/bin/bash\necho called >> {0}\necho $(( $(date +%s) + $EXPIRE_IN ))\necho stack_one\necho stack_two\n".format(calls))
+        os.chmod(prog, 0o755)
+
+        os.environ["EXPIRE_IN"] = "300"
+        try:
+            self.assertEqual(self.complete(prog, "--stack", ""), ["stack_one", "stack_two"])
+            self.assertEqual(self.complete(prog, "--stack", "stack_t"), ["stack_two"])
+            with open(calls) as fle:
+                self.assertEqual(len(fle.readlines()), 1)
+
+            os.environ["EXPIRE_IN"] = "-1"
+            shutil.rmtree(os.path.join(self.directory, "delfick_app"))
+            self.complete(prog, "--stack", "")
+            self.complete(prog, "--stack", "")
+            with open(calls) as fle:
+                self.assertEqual(len(fle.readlines()), 3)
+        finally:
+            del os.environ["EXPIRE_IN"]
+
+    it "prints when the values expire and then the values":
+        out = StringIO()
+        before = time.time()
+        CompletingApp().print_completion_values("--stack", out=out)
+
+        lines = out.getvalue().splitlines()
+        self.assertEqual(lines[1:], ["stack_one", "stack_two"])
+        assert before + 299 <= int(lines[0]) <= time.time() + 300
@@ -0,0 +1,118 @@
+# coding: spec
+
+from delfick_app import App, ConfigDefaults, BadOption
+
+from delfick_error import DelfickErrorTestMixin
+from unittest import TestCase
+import tempfile
+import shutil
+import json
+import mock
+import os
+
+class TestCase(TestCase, DelfickErrorTestMixin): pass
+
+describe TestCase, "ConfigDefaults":
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.directory, "cache")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def write(self, name, content):
+        location = os.path.join(self.directory, name)
+        with open(location, "w") as fle:
+            fle.write(content)
+        return location
+
+    it "reads flags from nested json and ini":
+        json_location = self.write("config.json", '{"config": "c.yml", "app": {"pool_size": 3}}')
+        ini_location = self.write("config.ini", "[defaults]\nconfig = other.yml\n\n[app]\ntimeout = 5\n")
+
+        config = ConfigDefaults([json_location, ini_location, os.path.join(self.directory, "missing.json")], cache_dir=self.cache_dir)
+        self.assertEqual(config.values(), {"--config": "other.yml", "--app-pool-size": 3, "--app-timeout": "5"})
+
+    it "only parses a file again when it changes":
+        location = self.write("config.json", '{"one": 1}')
+        parse = mock.Mock(name="parse", side_effect=ConfigDefaults.parse)
+
+        with mock.patch.object(ConfigDefaults, "parse", lambda s, location: parse(s, location)):
+            self.assertEqual(ConfigDefaults(location, cache_dir=self.cache_dir).values(), {"--one": 1})
+            self.assertEqual(ConfigDefaults(location, cache_dir=self.cache_dir).values(), {"--one": 1})
+            self.assertEqual(len(parse.mock_calls), 1)
+
+            self.write("config.json", '{"one": 10}')
+            self.assertEqual(ConfigDefaults(location, cache_dir=self.cache_dir).values(), {"--one": 10})
+            self.assertEqual(len(parse.mock_calls), 2)
+
+    it "doesn't interpolate ini values":
+        location = self.write("config.ini", "[defaults]\ndate_format = %Y-%m-%d\n")
+        self.assertEqual(ConfigDefaults(location, cache_dir=self.cache_dir).values(), {"--date-format": "%Y-%m-%d"})
+
+    it "caches what it parses as json":
+        location = self.write("config.json", '{"one": 1, "two": [2]}')
+        ConfigDefaults(location, cache_dir=self.cache_dir).values()
+
+        cached = os.listdir(self.cache_dir)
+        self.assertEqual(len(cached), 1)
+        self.assertTrue(cached[0].endswith(".json"))
+        with open(os.path.join(self.cache_dir, cached[0])) as fle:
+            self.assertEqual(json.load(fle)[1], {"--one": 1, "--two": [2]})
+
+    it "complains about config it can't use":
+        location = self.write("config.json", '{"one": ')
+        with self.fuzzyAssertRaisesError(BadOption, "Failed to read config defaults", location=location):
+            ConfigDefaults(location, cache_dir=self.cache_dir).values()
+
+        location = self.write("list.json", '[1, 2]')
+        with self.fuzzyAssertRaisesError(BadOption, "Config defaults should be a dictionary", location=location, got="list"):
+            ConfigDefaults(location, cache_dir=self.cache_dir).values()
+
+    it "is below positionals and above the environment in mainline":
+        called = []
+        location = self.write("config.json", '{"task": "from_config", "thing": "from_config", "pool_size": "4", "dry_run": true}')
+
+        class MyApp(App):
+            cli_positional_replacements = ["--task"]
+            cli_environment_defaults = {"DELFICK_APP_CONFIG_TEST": "--thing"}
+            cli_environment_prefixes = {"DELFICK_APP_CONFIG_TEST_": "--"}
+            cli_config_defaults = ConfigDefaults(location, cache_dir=self.cache_dir)
+
+            def specify_other_args(slf, parser, defaults):
+                parser.add_argument("--task", **defaults["--task"])
+                parser.add_argument("--thing", **defaults["--thing"])
+                parser.add_argument("--pool-size", type=int, default=1)
+                parser.add_argument("--dry-run", action="store_true")
+
+            def execute(slf, args, extra_args, cli_args, handler):
+                called.append((args.task, args.thing, args.pool_size, args.dry_run))
+
+        os.environ["DELFICK_APP_CONFIG_TEST"] = "from_env"
+        os.environ["DELFICK_APP_CONFIG_TEST_POOL_SIZE"] = "2"
+        try:
+            self.assertEqual(MyApp().mainline(["--silent"], exit_on_error=False), 0)
+            self.assertEqual(MyApp().mainline(["positional", "--silent"], exit_on_error=False), 0)
+        finally:
+            del os.environ["DELFICK_APP_CONFIG_TEST"]
+            del os.environ["DELFICK_APP_CONFIG_TEST_POOL_SIZE"]
+
+        self.assertEqual(called, [("from_config", "from_config", 4, True), ("positional", "from_config", 4, True)])
+
+    it "only reads config defaults once for each parse":
+        location = self.write("config.json", '{"task": "from_config"}')
+        config = ConfigDefaults(location, cache_dir=self.cache_dir)
+        values = mock.Mock(name="values", side_effect=config.values)
+
+        class MyApp(App):
+            cli_positional_replacements = ["--task"]
+            cli_config_defaults = config
+
+            def execute(slf, args, extra_args, cli_args, handler):
+                pass
+
+        with mock.patch.object(config, "values", values):
+            self.assertEqual(MyApp().mainline(["--silent"], exit_on_error=False), 0)
+            self.assertEqual(len(values.mock_calls), 1)
+            self.assertEqual(MyApp().mainline(["--silent"], exit_on_error=False), 0)
+            self.assertEqual(len(values.mock_calls), 2)
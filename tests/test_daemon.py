@@ -0,0 +1,116 @@
+# coding: spec
+
+from delfick_app import App, run_client
+
+from delfick_error import DelfickError, DelfickErrorTestMixin
+from six.moves import StringIO
+from unittest import TestCase
+import tempfile
+import shutil
+import signal
+import time
+import os
+
+class TestCase(TestCase, DelfickErrorTestMixin): pass
+
+class DaemonApp(App):
+    daemon_idle_timeout = 30
+    cli_environment_defaults = {"DELFICK_APP_DAEMON_TEST": ("--thing", "default")}
+    cli_environment_prefixes = {"DELFICK_APP_DAEMON_PREFIXED_": "--"}
+
+    def specify_other_args(self, parser, defaults):
+        parser.add_argument("--thing", **defaults["--thing"])
+        parser.add_argument("--fail", action="store_true")
+        parser.add_argument("--count", type=int, default=0)
+
+    def execute(self, args, extra_args, cli_args, handler):
+        print("thing={0} cwd={1} extra={2} count={3}".format(args.thing, os.getcwd(), extra_args, args.count))
+        if args.fail:
+            raise DelfickError("Failed on purpose", thing=args.thing)
+
+describe TestCase, "Daemon":
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.socket_path = os.path.join(self.directory, "daemon.sock")
+
+        class MyApp(DaemonApp):
+            daemon_socket = self.socket_path
+
+        self.pid = os.fork()
+        if self.pid == 0:
+            try:
+                MyApp.daemon_main()
+            finally:
+                os._exit(0)
+
+        start = time.time()
+        while not os.path.exists(self.socket_path):
+            assert time.time() - start < 10, "Daemon never started"
+            time.sleep(0.01)
+
+    def tearDown(self):
+        os.kill(self.pid, signal.SIGTERM)
+        os.waitpid(self.pid, 0)
+        shutil.rmtree(self.directory)
+
+    def run_client(self, argv):
+        with tempfile.TemporaryFile() as out, tempfile.TemporaryFile() as err, open(os.devnull) as stdin:
+            code = run_client(self.socket_path, argv, stdio=[stdin.fileno(), out.fileno(), err.fileno()])
+            out.seek(0)
+            return code, out.read().decode()
+
+    it "runs the mainline with our argv, cwd and environment":
+        original = os.environ.get("DELFICK_APP_DAEMON_TEST")
+        try:
+            os.environ["DELFICK_APP_DAEMON_TEST"] = "from_env"
+            os.environ["DELFICK_APP_DAEMON_PREFIXED_COUNT"] = "3"
+            self.assertEqual(self.run_client(["--", "one", "two"]), (0, "thing=from_env cwd={0} extra=one two count=3\n".format(os.getcwd())))
+
+            del os.environ["DELFICK_APP_DAEMON_TEST"]
+            del os.environ["DELFICK_APP_DAEMON_PREFIXED_COUNT"]
+            self.assertEqual(self.run_client([]), (0, "thing=default cwd={0} extra= count=0\n".format(os.getcwd())))
+        finally:
+            os.environ.pop("DELFICK_APP_DAEMON_PREFIXED_COUNT", None)
+            if original is not None:
+                os.environ["DELFICK_APP_DAEMON_TEST"] = original
+
+    it "has the same output and exit code as a normal run when it fails":
+        expected = StringIO()
+        try:
+            DaemonApp().mainline(["--fail", "--thing", "stuff"], print_errors_to=expected)
+            assert False, "Expected a SystemExit"
+        except SystemExit as error:
+            expected_code = error.code
+
+        code, output = self.run_client(["--fail", "--thing", "stuff"])
+        self.assertEqual(code, expected_code)
+        self.assertEqual(output, "thing=stuff cwd={0} extra= count=0\n{1}".format(os.getcwd(), expected.getvalue()))
+
+    it "passes on the exit code from argparse":
+        self.assertEqual(self.run_client(["--not-an-option"])[0], 2)
+
+describe TestCase, "Daemon idle timeout":
+    it "stops and cleans up the socket when there are no clients":
+        directory = tempfile.mkdtemp()
+        try:
+            class MyApp(DaemonApp):
+                daemon_socket = os.path.join(directory, "daemon.sock")
+                daemon_idle_timeout = 0.2
+
+            pid = os.fork()
+            if pid == 0:
+                try:
+                    MyApp.daemon_main()
+                finally:
+                    os._exit(0)
+
+            start = time.time()
+            while os.waitpid(pid, os.WNOHANG)[0] != pid:
+                if time.time() - start > 10:
+                    os.kill(pid, signal.SIGKILL)
+                    assert False, "Daemon never stopped"
+                time.sleep(0.05)
+
+            assert not os.path.exists(MyApp.daemon_socket)
+        finally:
+            shutil.rmtree(directory)
@@ -0,0 +1,160 @@
+# coding: spec
+
+from delfick_app import App
+
+from delfick_error import DelfickError, DelfickErrorTestMixin
+from six.moves import StringIO
+from unittest import TestCase
+from textwrap import dedent
+import tempfile
+import logging
+import shutil
+import os
+
+class TestCase(TestCase, DelfickErrorTestMixin): pass
+
+class FanOutApp(App):
+    logging_format = "plain"
+    logging_handler_file = property(lambda s: s.logs)
+    cli_fan_out = ["--environment", "--stack"]
+    cli_positional_replacements = ["--environment", "--stack"]
+
+    def specify_other_args(self, parser, defaults):
+        parser.add_argument("--environment", **defaults["--environment"])
+        parser.add_argument("--stack", **defaults["--stack"])
+
+    def execute(self, args, extra_args, cli_args, handler):
+        logging.getLogger("delfick_app_tests").info("deploying %s", args.stack)
+        if args.environment == "quit":
+            raise KeyboardInterrupt()
+        if args.environment == "prod" and args.stack == "db":
+            raise DelfickError("Not allowed", environment=args.environment, stack=args.stack)
+        print("{0} {1} {2}".format(args.environment, args.stack, args.jobs), file=self.output)
+
+class ProcessApp(App):
+    fan_out_pool = "process"
+    logging_handler_file = property(lambda s: s.logs)
+    cli_fan_out = ["--environment"]
+    cli_positional_replacements = ["--environment"]
+
+    def specify_other_args(self, parser, defaults):
+        parser.add_argument("--environment", **defaults["--environment"])
+
+    def execute(self, args, extra_args, cli_args, handler):
+        if args.environment == "prod":
+            raise DelfickError("Not allowed", environment=args.environment, pid=os.getpid())
+
+class BufferedProcessApp(App):
+    fan_out_pool = "process"
+    logging_format = "plain"
+    logging_buffer_size = 65536
+    logging_buffer_interval = 60
+    logging_handler_file = property(lambda s: open(s.log_location, "a"))
+    cli_fan_out = ["--environment"]
+    cli_positional_replacements = ["--environment"]
+
+    def specify_other_args(self, parser, defaults):
+        parser.add_argument("--environment", **defaults["--environment"])
+
+    def execute(self, args, extra_args, cli_args, handler):
+        logging.getLogger("delfick_app_tests").info("deploying %s", args.environment)
+
+class TypedApp(App):
+    logging_handler_file = property(lambda s: StringIO())
+    cli_fan_out = ["--environment", "--replicas"]
+    cli_positional_replacements = ["--environment"]
+
+    def specify_other_args(self, parser, defaults):
+        parser.add_argument("--environment", choices=["dev", "stg", "prod"], **defaults["--environment"])
+        parser.add_argument("--replicas", type=int, default=1)
+
+    def execute(self, args, extra_args, cli_args, handler):
+        self.called.append((args.environment, args.replicas))
+
+describe TestCase, "Fan out":
+    def make_app(self, logs):
+        app = FanOutApp()
+        app.output = StringIO()
+        app.logs = logs
+        return app
+
+    it "runs execute for each combination":
+        logs = StringIO()
+        app = self.make_app(logs)
+        self.assertEqual(app.mainline(["dev,stg", "web", "--jobs", "2"], exit_on_error=False), 0)
+        self.assertEqual(sorted(app.output.getvalue().strip().split("\n")), ["dev web 2", "stg web 2"])
+
+        lines = sorted(line.split("delfick_app_tests")[1].strip() for line in logs.getvalue().strip().split("\n"))
+        self.assertEqual(lines, ["[environment=dev] deploying web", "[environment=stg] deploying web"])
+
+    it "shows a UserQuit when the user quits during fan out":
+        errors = StringIO()
+        app = self.make_app(StringIO())
+        self.assertEqual(app.mainline(["quit,dev,stg", "web", "--jobs", "1"], print_errors_to=errors, exit_on_error=False), 1)
+        self.assertIn("UserQuit", errors.getvalue())
+
+    it "complains if there aren't any jobs to fan out with":
+        for jobs in ("0", "-1"):
+            errors = StringIO()
+            app = self.make_app(StringIO())
+            self.assertEqual(app.mainline(["dev,stg", "web", "--jobs", jobs], print_errors_to=errors, exit_on_error=False), 1)
+            self.assertIn("Something went wrong! -- BadOption", errors.getvalue())
+            self.assertIn("Need at least one job to fan out with", errors.getvalue())
+            self.assertEqual(app.output.getvalue(), "")
+
+    it "converts and checks each of the values":
+        app = TypedApp()
+        app.called = []
+        self.assertEqual(app.mainline(["dev,stg", "--replicas", "1,3"], exit_on_error=False), 0)
+        self.assertEqual(sorted(app.called), [("dev", 1), ("dev", 3), ("stg", 1), ("stg", 3)])
+
+        app.called = []
+        self.assertEqual(app.mainline(["prod", "--replicas", "2"], exit_on_error=False), 0)
+        self.assertEqual(app.called, [("prod", 2)])
+
+        for argv in (["dev,nope"], ["dev", "--replicas", "1,two"]):
+            with self.assertRaises(SystemExit):
+                TypedApp().mainline(argv, exit_on_error=False)
+
+    it "runs execute normally when there is only one target":
+        app = self.make_app(StringIO())
+        self.assertEqual(app.mainline(["dev", "web"], exit_on_error=False), 0)
+        self.assertEqual(app.output.getvalue(), "dev web 4\n")
+
+    it "displays all the errors together":
+        errors = StringIO()
+        app = self.make_app(StringIO())
+        self.assertEqual(app.mainline(["dev,prod", "web,db"], print_errors_to=errors, exit_on_error=False), 1)
+        self.assertEqual(sorted(app.output.getvalue().strip().split("\n")), ["dev db 4", "dev web 4", "prod web 4"])
+        self.assertEqual(errors.getvalue(), dedent("""
+            !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
+            Something went wrong! -- FanOutError
+            \t"Fan out failed. 1 of 4 targets failed"\tfailed=environment=prod stack=db
+            errors:
+            =======
+
+            \t"Not allowed"\tenvironment=prod\tstack=db
+            -------
+        """))
+
+    it "can use a process pool":
+        errors = StringIO()
+        app = ProcessApp()
+        app.logs = StringIO()
+        self.assertEqual(app.mainline(["dev,prod"], print_errors_to=errors, exit_on_error=False), 1)
+        assert "Something went wrong! -- FanOutError" in errors.getvalue()
+        assert "pid={0}".format(os.getpid()) not in errors.getvalue()
+
+    it "writes buffered logs from a process pool":
+        directory = tempfile.mkdtemp()
+        try:
+            app = BufferedProcessApp()
+            app.log_location = os.path.join(directory, "logs")
+            self.assertEqual(app.mainline(["dev,stg"], exit_on_error=False), 0)
+            with open(app.log_location) as fle:
+                logs = fle.read()
+        finally:
+            shutil.rmtree(directory)
+
+        self.assertIn("[environment=dev] deploying dev", logs)
+        self.assertIn("[environment=stg] deploying stg", logs)
@@ -0,0 +1,70 @@
+# coding: spec
+
+from delfick_app import App, CliParser, HelpCache
+
+from six.moves import StringIO
+from unittest import TestCase
+import tempfile
+import shutil
+import mock
+import os
+
+describe TestCase, "HelpCache":
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.help_cache = HelpCache(self.directory)
+
+        class MyApp(App):
+            VERSION = "0.1"
+            cli_help_cache = self.help_cache
+            cli_positional_replacements = ["--task"]
+
+            def specify_other_args(slf, parser, defaults):
+                parser.add_argument("--task", help="The task to run, which has quite a long description so it needs wrapping", **defaults["--task"])
+                parser.add_argument("--stack", help="The stack", choices=["web", "db"])
+        self.MyApp = MyApp
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def help_output(self, app_kls, argv=("--help", ), columns="80"):
+        out = StringIO()
+        with mock.patch.dict(os.environ, {"COLUMNS": columns}), mock.patch("sys.stdout", out):
+            with self.assertRaises(SystemExit) as error:
+                app_kls().mainline(list(argv))
+        self.assertEqual(error.exception.code, 0)
+        return out.getvalue()
+
+    def no_parser(self):
+        return mock.patch.object(CliParser, "make_parser", mock.Mock(name="make_parser", side_effect=AssertionError("Shouldn't make a parser")))
+
+    it "gives exactly what argparse says without making the parser":
+        from_argparse = self.help_output(self.MyApp)
+        with self.no_parser():
+            from_cache = self.help_output(self.MyApp)
+        self.assertEqual(from_cache.encode("utf-8"), from_argparse.encode("utf-8"))
+
+        cli_parser = self.MyApp().make_cli_parser()
+        with mock.patch.dict(os.environ, {"COLUMNS": "80"}):
+            self.assertEqual(from_cache, cli_parser.make_parser(cli_parser.split_args(["--help"])[2]).format_help())
+
+    it "makes the parser again when the key changes or the cache is invalidated":
+        narrow = self.help_output(self.MyApp, columns="50")
+        wide = self.help_output(self.MyApp, columns="120")
+        self.assertNotEqual(narrow, wide)
+        with self.no_parser():
+            self.assertEqual(self.help_output(self.MyApp, columns="50"), narrow)
+            self.assertEqual(self.help_output(self.MyApp, columns="120"), wide)
+
+        class NewApp(self.MyApp):
+            VERSION = "0.2"
+
+        make_parser = mock.Mock(name="make_parser", side_effect=CliParser.make_parser)
+        with mock.patch.object(CliParser, "make_parser", lambda s, defaults: make_parser(s, defaults)):
+            self.help_output(NewApp)
+            self.help_output(self.MyApp, argv=["deploy", "--help"])
+            self.assertEqual(len(make_parser.mock_calls), 2)
+
+            self.help_cache.invalidate()
+            self.help_output(self.MyApp)
+            self.assertEqual(len(make_parser.mock_calls), 3)
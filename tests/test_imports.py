@@ -0,0 +1,31 @@
+# coding: spec
+
+from unittest import TestCase
+import subprocess
+import json
+import sys
+import os
+
+this_dir = os.path.dirname(__file__)
+
+describe TestCase, "Importing delfick_app":
+    def modules_after(self, statement):
+        """Return the modules that are loaded by a fresh interpreter after running statement"""
+        script = "import sys, json; before = set(sys.modules); {0}; print(json.dumps(sorted(set(sys.modules) - before)))".format(statement)
+        output = subprocess.check_output([sys.executable, "-c", script], cwd=os.path.join(this_dir, ".."))
+        return set(json.loads(output.decode().strip()))
+
+    it "does not import the expensive dependencies":
+        loaded = self.modules_after("import delfick_app")
+        for name in ("argparse", "delfick_error", "rainbow_logging_handler"):
+            assert name not in loaded, "Expected {0} to not be imported".format(name)
+
+    it "loads barely more modules than logging itself":
+        baseline = self.modules_after("import logging")
+        loaded = self.modules_after("import delfick_app")
+        extra = loaded - baseline
+        assert len(extra) <= 5, "Importing delfick_app loaded too many modules: {0}".format(sorted(extra))
+
+    it "still provides the lazy attributes":
+        loaded = self.modules_after("from delfick_app import BadOption, DelfickError; assert issubclass(BadOption, DelfickError)")
+        assert "delfick_error" in loaded
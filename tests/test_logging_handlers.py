@@ -0,0 +1,238 @@
+# coding: spec
+
+from delfick_app import App, QueueLoggingHandler, PlainFormatter, JsonFormatter, BufferedStream, BufferedLoggingHandler
+
+from delfick_error import DelfickError, DelfickErrorTestMixin
+from six.moves import StringIO
+from unittest import TestCase
+import threading
+import logging
+import json
+import time
+import sys
+
+class TestCase(TestCase, DelfickErrorTestMixin): pass
+
+class Recorder(logging.Handler):
+    def __init__(self, wait=None):
+        super(Recorder, self).__init__()
+        self.wait = wait
+        self.entered = threading.Event()
+        self.closed = False
+        self.messages = []
+        self.threads = []
+
+    def emit(self, record):
+        self.entered.set()
+        if self.wait is not None:
+            self.wait.wait()
+        self.threads.append(threading.current_thread())
+        self.messages.append(record.getMessage())
+
+    def close(self):
+        self.closed = True
+        super(Recorder, self).close()
+
+describe TestCase, "Formatters":
+    def make_record(self, msg, *args, **kwargs):
+        return logging.LogRecord("delfick_app_tests", logging.INFO, __file__, 1, msg, args, kwargs.get("exc_info"))
+
+    it "plain formatter formats like the normal formatter":
+        record = self.make_record("hello %s", "there")
+        expected = logging.Formatter("%(asctime)s %(levelname)-7s %(name)-15s %(message)s").format(record)
+        self.assertEqual(PlainFormatter().format(record), expected)
+
+        try:
+            raise ValueError("nope")
+        except ValueError:
+            record = self.make_record("failed", exc_info=sys.exc_info())
+        expected = logging.Formatter("%(asctime)s %(levelname)-7s %(name)-15s %(message)s").format(record)
+        self.assertEqual(PlainFormatter().format(record), expected)
+
+    it "json formatter makes a json object per record":
+        record = self.make_record("hello \"%s\"", "there")
+        self.assertEqual(json.loads(JsonFormatter().format(record)), {"level": "INFO", "name": "delfick_app_tests", "created": record.created, "message": 'hello "there"'})
+
+        try:
+            raise ValueError("nope")
+        except ValueError:
+            record = self.make_record("failed", exc_info=sys.exc_info())
+        formatted = json.loads(JsonFormatter().format(record))
+        self.assertEqual(formatted["message"], "failed")
+        assert formatted["exception"].endswith("ValueError: nope"), formatted["exception"]
+
+    describe "with the App":
+        def formatter_for(self, fle, logging_format=None):
+            class MyApp(App):
+                logging_handler_file = fle
+            MyApp.logging_format = logging_format
+            return MyApp().make_logging_handler().formatter
+
+        it "uses plain if the file isn't a tty":
+            assert isinstance(self.formatter_for(StringIO()), PlainFormatter)
+
+        it "uses rainbow if the file is a tty":
+            fle = StringIO()
+            fle.isatty = lambda: True
+            self.assertIs(type(self.formatter_for(fle)), logging.Formatter)
+
+        it "uses the logging_format it is told to use":
+            assert isinstance(self.formatter_for(StringIO(), "json"), JsonFormatter)
+            self.assertIs(type(self.formatter_for(StringIO(), "rainbow")), logging.Formatter)
+            with self.assertRaises(ValueError):
+                self.formatter_for(StringIO(), "fancy")
+
+class Writes(object):
+    def __init__(self):
+        self.writes = []
+        self.written = threading.Event()
+
+    def write(self, data):
+        self.writes.append(data)
+        self.written.set()
+
+    def flush(self):
+        pass
+
+describe TestCase, "Buffering":
+    it "writes once there is enough to write":
+        stream = Writes()
+        buffered = BufferedStream(stream, size=10, interval=60)
+        buffered.write("12345")
+        buffered.flush()
+        self.assertEqual(stream.writes, [])
+
+        buffered.write("67890")
+        self.assertEqual(stream.writes, ["1234567890"])
+
+        buffered.write("a")
+        buffered.close()
+        self.assertEqual(stream.writes, ["1234567890", "a"])
+        self.assertIs(buffered.timer, None)
+
+    it "writes after the interval":
+        stream = Writes()
+        buffered = BufferedStream(stream, size=1000, interval=0.05)
+        buffered.write("hello")
+        self.assertEqual(stream.writes, [])
+        stream.written.wait(5)
+        self.assertEqual(stream.writes, ["hello"])
+
+    it "writes straight away for important records":
+        stream = Writes()
+        buffered = BufferedStream(stream, size=1000, interval=60)
+        target = logging.StreamHandler(buffered)
+        target.setFormatter(logging.Formatter("%(message)s"))
+        handler = BufferedLoggingHandler(target, buffered, flush_level=logging.ERROR)
+
+        log = logging.getLogger("delfick_app_tests.buffered")
+        log.propagate = False
+        log.setLevel(logging.INFO)
+        log.handlers[:] = [handler]
+
+        log.info("one")
+        log.warning("two")
+        self.assertEqual(stream.writes, [])
+
+        log.error("three")
+        self.assertEqual(stream.writes, ["one\ntwo\nthree\n"])
+
+        log.info("four")
+        handler.close()
+        self.assertEqual(stream.writes, ["one\ntwo\nthree\n", "four\n"])
+
+    it "is written when mainline fails":
+        stream = Writes()
+        class MyApp(App):
+            logging_format = "plain"
+            logging_buffer_size = 1000
+            logging_buffer_interval = 60
+            logging_handler_file = stream
+
+            def execute(slf, args, extra_args, cli_args, handler):
+                logging.getLogger("delfick_app_tests").info("before the error")
+                raise KeyboardInterrupt()
+
+        self.assertEqual(MyApp().mainline([], print_errors_to=StringIO(), exit_on_error=False), 1)
+        self.assertEqual(len(stream.writes), 1)
+        assert stream.writes[0].endswith("before the error\n"), stream.writes
+
+describe TestCase, "QueueLoggingHandler":
+    def make_logger(self, handler):
+        log = logging.getLogger("delfick_app_tests.queue")
+        log.propagate = False
+        log.setLevel(logging.INFO)
+        log.handlers[:] = [handler]
+        return log
+
+    it "gives records to the target on another thread":
+        target = Recorder()
+        handler = QueueLoggingHandler(target)
+        log = self.make_logger(handler)
+
+        things = ["one"]
+        log.info("hello %s", things)
+        things.append("two")
+        log.info("there")
+        handler.flush()
+
+        self.assertEqual(target.messages, ["hello ['one']", "there"])
+        assert threading.current_thread() not in target.threads
+
+        handler.close()
+        assert not handler.thread.is_alive()
+        assert target.closed
+
+    it "complains about unknown overflow policies":
+        with self.assertRaises(ValueError):
+            QueueLoggingHandler(Recorder(), overflow="explode")
+
+    it "can count and drop records when the queue is full":
+        wait = threading.Event()
+        target = Recorder(wait)
+        handler = QueueLoggingHandler(target, size=2, overflow="count_and_drop")
+        log = self.make_logger(handler)
+
+        log.info("message 0")
+        target.entered.wait()
+        for i in range(1, 10):
+            log.info("message %s", i)
+
+        wait.set()
+        handler.close()
+        self.assertEqual(target.messages[-1], "Dropped 7 log records because the logging queue was full")
+        self.assertEqual(target.messages[:-1], ["message 0", "message 1", "message 2"])
+
+    it "can drop the oldest records when the queue is full":
+        wait = threading.Event()
+        target = Recorder(wait)
+        handler = QueueLoggingHandler(target, size=2, overflow="drop_oldest")
+        log = self.make_logger(handler)
+
+        log.info("message 0")
+        target.entered.wait()
+        for i in range(1, 10):
+            log.info("message %s", i)
+
+        wait.set()
+        handler.close()
+        self.assertEqual(target.messages[-1], "Dropped 7 log records because the logging queue was full")
+        self.assertEqual(target.messages[:-1], ["message 0", "message 8", "message 9"])
+
+    describe "with the App":
+        it "flushes the logs before printing errors":
+            fle = StringIO()
+            class MyApp(App):
+                logging_async = True
+                logging_handler_file = fle
+
+                def execute(slf, args, extra_args, cli_args, handler):
+                    assert isinstance(handler, QueueLoggingHandler)
+                    logging.getLogger("delfick_app_tests").info("before the error")
+                    raise DelfickError("nope")
+
+            self.assertEqual(MyApp().mainline([], print_errors_to=fle, exit_on_error=False), 1)
+            fle.seek(0)
+            lines = fle.read().split("\n")
+            assert lines[0].endswith("before the error"), lines
+            self.assertEqual(lines[2], "!" * 80)
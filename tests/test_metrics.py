@@ -0,0 +1,146 @@
+# coding: spec
+
+from delfick_app import App, Metrics
+
+from delfick_error import DelfickError, DelfickErrorTestMixin
+from six.moves import StringIO
+from unittest import TestCase
+from textwrap import dedent
+import threading
+import tempfile
+import shutil
+import pickle
+import json
+import os
+
+class TestCase(TestCase, DelfickErrorTestMixin): pass
+
+class CountingApp(App):
+    fan_out_pool = "process"
+    metrics_prefix = "counting"
+    cli_fan_out = ["--environment"]
+    cli_positional_replacements = ["--environment"]
+    logging_handler_file = property(lambda s: StringIO())
+
+    def specify_other_args(self, parser, defaults):
+        parser.add_argument("--environment", **defaults["--environment"])
+
+    def execute(self, args, extra_args, cli_args, handler):
+        self.metrics.counter("deploys").inc()
+
+describe TestCase, "Metrics":
+    it "has counters, gauges and histograms":
+        metrics = Metrics("app")
+        metrics.counter("things", help="How many things", kind="a").inc()
+        metrics.counter("things", kind="a").inc(2)
+        metrics.counter("things", kind="b").inc()
+        metrics.gauge("size").set(10)
+        metrics.gauge("size").dec(3)
+        for val in (0.1, 0.5, 20):
+            metrics.histogram("took", buckets=[0.2, 1]).observe(val)
+
+        self.assertEqual(metrics.as_prometheus(), dedent("""\
+            # TYPE app_size gauge
+            app_size 7.0
+            # HELP app_things How many things
+            # TYPE app_things counter
+            app_things{kind="a"} 3.0
+            app_things{kind="b"} 1.0
+            # TYPE app_took histogram
+            app_took_bucket{le="0.2"} 1.0
+            app_took_bucket{le="1.0"} 2.0
+            app_took_bucket{le="+Inf"} 3.0
+            app_took_sum 20.6
+            app_took_count 3.0
+        """))
+
+        self.assertEqual(metrics.as_json()[0], {"name": "app_things", "type": "counter", "labels": {"kind": "a"}, "value": 3})
+        self.assertEqual(metrics.as_json()[-1], {"name": "app_took", "type": "histogram", "labels": {}, "buckets": [0.2, 1], "counts": [1, 1, 1], "sum": 20.6, "count": 3})
+
+    it "complains if a metric is asked for as a different type":
+        metrics = Metrics()
+        metrics.counter("things")
+        with self.assertRaises(ValueError):
+            metrics.gauge("things")
+
+    it "can be used from many threads":
+        metrics = Metrics()
+        def inc():
+            for _ in range(1000):
+                metrics.counter("things").inc()
+        threads = [threading.Thread(target=inc) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(metrics.counter("things").value, 8000)
+
+    it "can be pickled and merged":
+        metrics = Metrics("app")
+        metrics.counter("things").inc(2)
+        metrics.histogram("took", buckets=[1]).observe(0.5)
+
+        other = pickle.loads(pickle.dumps(metrics))
+        other.counter("things").inc()
+        other.gauge("size").set(3)
+
+        metrics.merge(other)
+        self.assertEqual(metrics.counter("things").value, 5)
+        self.assertEqual(metrics.gauge("size").value, 3)
+        self.assertEqual(metrics.histogram("took").counts, [2, 0])
+
+    it "writes prometheus or json files":
+        directory = tempfile.mkdtemp()
+        try:
+            metrics = Metrics("app")
+            metrics.counter("things").inc()
+
+            metrics.write(os.path.join(directory, "app.prom"))
+            with open(os.path.join(directory, "app.prom")) as fle:
+                self.assertEqual(fle.read(), metrics.as_prometheus())
+
+            metrics.write(os.path.join(directory, "app.json"))
+            with open(os.path.join(directory, "app.json")) as fle:
+                self.assertEqual(json.load(fle), metrics.as_json())
+
+            self.assertEqual(sorted(os.listdir(directory)), ["app.json", "app.prom"])
+        finally:
+            shutil.rmtree(directory)
+
+    describe "with the App":
+        it "writes the metrics from the mainline":
+            directory = tempfile.mkdtemp()
+            try:
+                path = os.path.join(directory, "app.json")
+                seen = []
+                class MyApp(App):
+                    metrics_file = path
+
+                    def execute(slf, args, extra_args, cli_args, handler):
+                        seen.append(sorted(dict(labels)["phase"] for (name, labels) in slf.metrics.metrics if name == "phase_seconds"))
+                        slf.metrics.counter("executed").inc()
+                        raise DelfickError("nope")
+
+                self.assertEqual(MyApp().mainline([], print_errors_to=StringIO(), exit_on_error=False), 1)
+                self.assertEqual(seen, [["make_cli_parser", "make_parser", "parse_args", "set_boto_useragent", "setup_logging", "split_args"]])
+
+                with open(path) as fle:
+                    written = dict((item["name"], item) for item in json.load(fle) if item["name"] != "myapp_phase_seconds")
+                self.assertEqual(sorted(written), ["myapp_executed", "myapp_exit_status", "myapp_last_run_timestamp_seconds"])
+                self.assertEqual(written["myapp_exit_status"]["value"], 1)
+                self.assertEqual(written["myapp_executed"]["value"], 1)
+            finally:
+                shutil.rmtree(directory)
+
+        it "gets the metrics from fan out processes":
+            app = CountingApp()
+            self.assertEqual(app.mainline(["dev,stg,prod"], exit_on_error=False), 0)
+            self.assertEqual(app.metrics.counter("deploys").value, 3)
+            self.assertEqual(app.metrics.gauge("exit_status").value, 0)
+
+        it "shares one Metrics between the lines of a batch":
+            app = CountingApp()
+            results = app.batch(["dev", "stg", "prod"], summary_to=StringIO())
+            self.assertEqual([result.status for result in results], ["ok", "ok", "ok"])
+            self.assertEqual(app.metrics.counter("deploys").value, 3)
+            self.assertEqual(app.metrics.gauge("exit_status").value, 0)
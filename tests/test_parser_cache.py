@@ -0,0 +1,93 @@
+# coding: spec
+
+from delfick_app import App, CliParser, ParserCache
+
+from delfick_error import DelfickErrorTestMixin
+from unittest import TestCase
+import mock
+import os
+
+class TestCase(TestCase, DelfickErrorTestMixin): pass
+
+describe TestCase, "ParserCache":
+    def make_app_kls(self, called, cache):
+        class MyApp(App):
+            cli_parser_cache = cache
+            cli_environment_defaults = {"DELFICK_APP_CACHE_TEST": "--thing"}
+            cli_positional_replacements = ["--task"]
+
+            def specify_other_args(slf, parser, defaults):
+                called.append(slf)
+                parser.add_argument("--task", **defaults["--task"])
+                parser.add_argument("--thing", **defaults["--thing"])
+
+            def execute(slf, args, extra_args, cli_args, handler):
+                called.append((args.task, args.thing))
+        return MyApp
+
+    it "reuses the generated class and parser between mainline calls":
+        called = []
+        cache = ParserCache()
+        MyApp = self.make_app_kls(called, cache)
+
+        app = MyApp()
+        first = app.make_cli_parser()
+        second = MyApp().make_cli_parser()
+        self.assertIs(first.__class__, second.__class__)
+        assert isinstance(first, CliParser)
+        self.assertIs(first.app, app)
+
+        with mock.patch("delfick_app.App.setup_logging"):
+            app.mainline(["one"])
+            MyApp().mainline(["one"])
+            self.assertEqual(called, [app, ("one", None), ("one", None)])
+
+            del called[:]
+            app.mainline(["two"])
+            self.assertEqual(called, [app, ("two", None)])
+
+            del called[:]
+            with mock.patch.dict(os.environ, {"DELFICK_APP_CACHE_TEST": "stuff"}):
+                app.mainline(["two"])
+            self.assertEqual(called, [app, ("two", "stuff")])
+
+    it "is bounded":
+        called = []
+        cache = ParserCache(size=2)
+        app = self.make_app_kls(called, cache)()
+        for task in ("one", "two", "three", "one"):
+            app.make_cli_parser().parse_args([task])
+
+        self.assertEqual(len(called), 4)
+        self.assertEqual(len(cache.parsers), 2)
+
+    it "can be invalidated for one app":
+        called = []
+        cache = ParserCache()
+        MyApp = self.make_app_kls(called, cache)
+        OtherApp = self.make_app_kls(called, cache)
+
+        MyApp().make_cli_parser().parse_args(["one"])
+        OtherApp().make_cli_parser().parse_args(["one"])
+        self.assertEqual(len(cache.classes), 2)
+        self.assertEqual(len(cache.parsers), 2)
+
+        cache.invalidate(MyApp)
+        self.assertEqual(list(cache.classes), [(OtherApp, CliParser)])
+        self.assertEqual(len(cache.parsers), 1)
+
+        MyApp().make_cli_parser().parse_args(["one"])
+        self.assertEqual(len(called), 3)
+
+        cache.invalidate()
+        self.assertEqual(len(cache.classes), 0)
+        self.assertEqual(len(cache.parsers), 0)
+
+    it "doesn't cache defaults it can't hash":
+        cli_parser = mock.Mock(name="cli_parser", description="")
+        cache = ParserCache()
+        defaults = {"--thing": {"default": []}}
+        cache.parser(cli_parser, defaults)
+        cache.parser(cli_parser, defaults)
+        self.assertEqual(len(cli_parser.make_parser.mock_calls), 2)
+        self.assertEqual(len(cache.parsers), 0)
@@ -0,0 +1,109 @@
+# coding: spec
+
+from delfick_app import App, SubcommandRegistry, BadOption
+
+from delfick_error import DelfickErrorTestMixin
+from six.moves import StringIO
+from unittest import TestCase
+import tempfile
+import shutil
+import mock
+import sys
+import os
+
+class TestCase(TestCase, DelfickErrorTestMixin): pass
+
+deploy_module = '''
+class Deploy(object):
+    """Deploy the app
+
+    More words
+    """
+    @staticmethod
+    def specify_other_args(parser, defaults):
+        parser.add_argument("--stack")
+'''
+
+listing_module = '''
+class List(object):
+    description = "List things"
+'''
+
+describe TestCase, "Subcommands":
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.package = "delfick_app_subcommands_{0}".format(self.id().split(".")[-1])
+        os.makedirs(os.path.join(self.directory, "packages", self.package))
+        for name, content in (("__init__", ""), ("deploy", deploy_module), ("listing", listing_module)):
+            self.write(name, content)
+        sys.path.insert(0, os.path.join(self.directory, "packages"))
+
+        self.registry = SubcommandRegistry(
+              { "deploy": "{0}.deploy:Deploy".format(self.package)
+              , "list": "{0}.listing:List".format(self.package)
+              }
+            , cache_dir = os.path.join(self.directory, "cache")
+            )
+
+    def tearDown(self):
+        sys.path.remove(os.path.join(self.directory, "packages"))
+        for name in list(sys.modules):
+            if name.startswith(self.package):
+                del sys.modules[name]
+        shutil.rmtree(self.directory)
+
+    def write(self, name, content):
+        with open(os.path.join(self.directory, "packages", self.package, "{0}.py".format(name)), "w") as fle:
+            fle.write(content)
+
+    def make_app(self, called):
+        class MyApp(App):
+            cli_subcommands = self.registry
+            cli_positional_replacements = ["--task"]
+
+            def execute(slf, args, extra_args, cli_args, handler):
+                called.append((args.task, getattr(args, "stack", None), slf.subcommand))
+        return MyApp
+
+    it "only imports the subcommand that was chosen":
+        called = []
+        self.assertEqual(self.make_app(called)().mainline(["deploy", "--stack", "web", "--silent"], exit_on_error=False), 0)
+
+        deploy = sys.modules["{0}.deploy".format(self.package)]
+        self.assertEqual(called, [("deploy", "web", deploy.Deploy)])
+        assert "{0}.listing".format(self.package) not in sys.modules
+
+    it "complains about subcommands it doesn't know":
+        with mock.patch("sys.stderr", StringIO()):
+            with self.assertRaises(SystemExit) as error:
+                self.make_app([])().mainline(["--task", "nope", "--silent"])
+        self.assertEqual(error.exception.code, 2)
+
+        with self.fuzzyAssertRaisesError(BadOption, "Unknown subcommand", wanted="nope", available=["deploy", "list"]):
+            self.registry.load("nope")
+
+    it "lists the subcommands in --help from cached descriptions":
+        help_text = StringIO()
+        with mock.patch("sys.stdout", help_text):
+            with self.assertRaises(SystemExit):
+                self.make_app([])().mainline(["--help"])
+        self.assertIn("subcommands:\n  deploy  Deploy the app\n  list    List things\n", help_text.getvalue())
+
+        for name in list(sys.modules):
+            if name.startswith("{0}.".format(self.package)):
+                del sys.modules[name]
+
+        self.assertEqual(self.registry.help(), "subcommands:\n  deploy  Deploy the app\n  list    List things")
+        assert "{0}.deploy".format(self.package) not in sys.modules
+        assert "{0}.listing".format(self.package) not in sys.modules
+
+        self.write("listing", 'class List(object):\n    description = "List all the things"\n')
+        self.assertEqual(self.registry.descriptions()["list"], "List all the things")
+        assert "{0}.deploy".format(self.package) not in sys.modules
+
+    it "forgets the subcommand from the previous line in a batch":
+        called = []
+        self.make_app(called)().batch(["deploy --silent --stack web", "--silent"], summary_to=StringIO())
+
+        deploy = sys.modules["{0}.deploy".format(self.package)]
+        self.assertEqual(called, [("deploy", "web", deploy.Deploy), (None, None, None)])
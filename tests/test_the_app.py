@@ -6,13 +6,19 @@ from delfick_error import DelfickError, DelfickErrorTestMixin
 from six.moves import StringIO
 from unittest import TestCase
 from textwrap import dedent
+import subprocess
 import datetime
+import threading
 import tempfile
 import logging
+import shutil
 import mock
+import sys
 import os
 import re
 
+this_dir = os.path.dirname(__file__)
+
 class TestCase(TestCase, DelfickErrorTestMixin): pass
 
 describe TestCase, "App":
@@ -41,6 +47,37 @@ describe TestCase, "App":
             assert "delfick_app_tests" in UserAgent
             self.assertEqual(UserAgent, "{0} delfick_app_tests/0.1".format(original))
 
+        it "waits for boto and botocore to be imported by something else":
+            directory = tempfile.mkdtemp()
+            try:
+                os.makedirs(os.path.join(directory, "botocore"))
+                with open(os.path.join(directory, "botocore", "__init__.py"), "w") as fle:
+                    pass
+                with open(os.path.join(directory, "botocore", "session.py"), "w") as fle:
+                    fle.write("class Session(object):\n    def __init__(self):\n        self.user_agent_extra = ''\n")
+
+                script = "\n".join([
+                      "import sys"
+                    , "from delfick_app import App"
+                    , "class MyApp(App):"
+                    , "    VERSION = '0.1'"
+                    , "    boto_useragent_name = 'delfick_app_tests'"
+                    , "    def execute(self, args, extra_args, cli_args, handler): pass"
+                    , "MyApp().mainline(['--silent'], exit_on_error=False)"
+                    , "MyApp().mainline(['--silent'], exit_on_error=False)"
+                    , "print(sorted(name for name in sys.modules if name.split('.')[0] in ('boto', 'botocore')))"
+                    , "from boto.connection import UserAgent"
+                    , "from botocore.session import Session"
+                    , "print(UserAgent.count('delfick_app_tests/0.1'))"
+                    , "print(Session().user_agent_extra)"
+                    ])
+
+                env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.join(this_dir, ".."), directory] + sys.path))
+                output = subprocess.check_output([sys.executable, "-c", script], env=env).decode()
+                self.assertEqual(output.split("\n"), ["[]", "1", "delfick_app_tests/0.1", ""])
+            finally:
+                shutil.rmtree(directory)
+
     describe "mainline":
         it "catches DelfickError errors and prints them nicely":
             fle = StringIO()
@@ -115,6 +152,74 @@ describe TestCase, "App":
             with self.fuzzyAssertRaisesError(KeyboardInterrupt):
                 MyApp().mainline(['--debug'])
 
+        it "only parses argv once when execute fails":
+            called = []
+            class MyApp(App):
+                def specify_other_args(slf, parser, defaults):
+                    called.append(1)
+
+                def execute(slf, args, extra_args, cli_args, handler):
+                    raise DelfickError("nope")
+
+            try:
+                MyApp().mainline([], print_errors_to=StringIO())
+                assert False, "This should have failed"
+            except SystemExit as error:
+                self.assertEqual(error.code, 1)
+            self.assertEqual(called, [1])
+
+            del called[:]
+            with self.fuzzyAssertRaisesError(DelfickError, "nope"):
+                MyApp().mainline(['--debug'])
+            self.assertEqual(called, [1])
+
+        it "only parses argv once when the user quits":
+            called = []
+            original_make_parser = CliParser.make_parser
+            def make_parser(slf, defaults):
+                called.append(1)
+                return original_make_parser(slf, defaults)
+
+            class MyApp(App):
+                def execute(slf, args, extra_args, cli_args, handler):
+                    raise KeyboardInterrupt()
+
+            with mock.patch.object(CliParser, "make_parser", make_parser):
+                with self.fuzzyAssertRaisesError(KeyboardInterrupt):
+                    MyApp().mainline(['--debug'])
+            self.assertEqual(called, [1])
+
+        it "returns an exit code instead of exiting if asked to":
+            class MyApp(App):
+                def execute(slf, args, extra_args, cli_args, handler):
+                    if args.verbose:
+                        raise DelfickError("nope")
+
+            self.assertEqual(MyApp().mainline([], print_errors_to=StringIO(), exit_on_error=False), 0)
+            self.assertEqual(MyApp().mainline(["--verbose"], print_errors_to=StringIO(), exit_on_error=False), 1)
+
+        it "doesn't stack logging handlers when called many times":
+            fle = StringIO()
+            handlers = []
+            class MyApp(App):
+                logging_handler_file = fle
+                def execute(slf, args, extra_args, cli_args, handler):
+                    handlers.append(list(logging.getLogger("").handlers))
+                    logging.getLogger("delfick_app_tests").info("hello")
+
+            root = logging.getLogger("")
+            before = (root.level, list(root.handlers))
+            for _ in range(3):
+                MyApp().mainline([])
+
+            self.assertEqual((root.level, root.handlers), before)
+            self.assertEqual(len(handlers), 3)
+            for found in handlers:
+                self.assertEqual(len(found), len(before[1]) + 1)
+
+            fle.seek(0)
+            self.assertEqual(len(fle.readlines()), 3)
+
         it "parse args, sets up logging, sets boto agent and calls execute":
             called = []
 
@@ -156,6 +261,217 @@ describe TestCase, "App":
             setup_logging.assert_called_once_with(args, verbose=args.verbose, silent=args.silent, debug=args.debug)
             execute.assert_called_once_with(args, extra_args, cli_args, handler)
 
+    describe "timings":
+        it "gives the timings to timings_recorded":
+            recorded = []
+            class MyApp(App):
+                def timings_recorded(slf, timings):
+                    recorded.append(timings)
+
+                def execute(slf, args, extra_args, cli_args, handler):
+                    pass
+
+            with mock.patch("sys.stderr", StringIO()) as stderr:
+                MyApp().mainline([])
+            self.assertEqual(stderr.getvalue(), "")
+
+            self.assertEqual(len(recorded), 1)
+            self.assertEqual(list(recorded[0].phases), ["make_cli_parser", "split_args", "make_parser", "parse_args", "setup_logging", "set_boto_useragent", "execute"])
+            for seconds in recorded[0].phases.values():
+                assert seconds >= 0
+
+        it "records timings for failed runs":
+            recorded = []
+            class MyApp(App):
+                def timings_recorded(slf, timings):
+                    recorded.append(timings)
+
+                def execute(slf, args, extra_args, cli_args, handler):
+                    raise DelfickError("nope")
+
+            self.assertEqual(MyApp().mainline([], print_errors_to=StringIO(), exit_on_error=False), 1)
+            self.assertEqual(list(recorded[0].phases)[-1], "execute")
+
+        it "displays the timings with --timings":
+            class MyApp(App):
+                def execute(slf, args, extra_args, cli_args, handler):
+                    pass
+
+            with mock.patch("sys.stderr", StringIO()) as stderr:
+                MyApp().mainline(["--timings"])
+
+            lines = stderr.getvalue().strip().split("\n")
+            self.assertEqual(lines[0], "Timings")
+            self.assertEqual([line.split()[0] for line in lines[1:]], ["make_cli_parser", "split_args", "make_parser", "parse_args", "setup_logging", "set_boto_useragent", "execute", "total"])
+
+    describe "profiling":
+        def make_app(self, logs, fail=False):
+            class MyApp(App):
+                logging_handler_file = logs
+
+                def execute(slf, args, extra_args, cli_args, handler):
+                    sorted(range(1000))
+                    if fail:
+                        raise KeyboardInterrupt()
+            return MyApp()
+
+        def profiled_functions(self, path):
+            import pstats
+            return [func for _, _, func in pstats.Stats(path).stats]
+
+        it "writes a profile of execute with --profile":
+            directory = tempfile.mkdtemp()
+            try:
+                path = os.path.join(directory, "out.pstats")
+                logs = StringIO()
+                self.make_app(logs).mainline(["--profile", path])
+                assert "sorted" in str(self.profiled_functions(path))
+                assert "Wrote profile to {0}".format(path) in logs.getvalue()
+                assert "cumulative" in logs.getvalue() or "cumtime" in logs.getvalue()
+            finally:
+                shutil.rmtree(directory)
+
+        it "writes the profile even when the run fails":
+            directory = tempfile.mkdtemp()
+            try:
+                path = os.path.join(directory, "out.pstats")
+                self.assertEqual(self.make_app(StringIO(), fail=True).mainline(["--profile={0}".format(path)], print_errors_to=StringIO(), exit_on_error=False), 1)
+                assert os.path.exists(path)
+            finally:
+                shutil.rmtree(directory)
+
+        it "can profile the whole mainline":
+            directory = tempfile.mkdtemp()
+            try:
+                path = os.path.join(directory, "out.pstats")
+                app = self.make_app(StringIO())
+                app.profile_mainline = True
+                app.mainline(["--profile", path])
+                assert "make_cli_parser" in str(self.profiled_functions(path))
+            finally:
+                shutil.rmtree(directory)
+
+        it "can sample runs using an environment variable":
+            app = self.make_app(StringIO())
+            with mock.patch.dict(os.environ, {"DELFICK_APP_PROFILE_EVERY": "1"}):
+                path = app.profile_path(None)
+                assert path.startswith("myapp-") and path.endswith(".pstats"), path
+
+            with mock.patch.dict(os.environ, {"DELFICK_APP_PROFILE_EVERY": "1000000000"}):
+                self.assertIs(app.profile_path(None), None)
+
+            with mock.patch.dict(os.environ, {}, clear=True):
+                self.assertIs(app.profile_path(None), None)
+
+            self.assertEqual(app.profile_option_in(["dev", "--profile"]), True)
+            self.assertEqual(app.profile_option_in(["--profile", "a.pstats"]), "a.pstats")
+            self.assertIs(app.profile_option_in(["dev", "--", "--profile"]), None)
+
+    describe "memory profiling":
+        it "reports memory with --memprofile":
+            directory = tempfile.mkdtemp()
+            try:
+                path = os.path.join(directory, "out.snapshot")
+                logs = StringIO()
+                kept = []
+
+                class MyApp(App):
+                    logging_handler_file = logs
+
+                    def execute(slf, args, extra_args, cli_args, handler):
+                        slf.memory_snapshot("start")
+                        kept.append([str(i) for i in range(10000)])
+                        slf.memory_snapshot("made strings")
+                        raise DelfickError("nope")
+
+                self.assertEqual(MyApp().mainline(["--memprofile", path], print_errors_to=StringIO(), exit_on_error=False), 1)
+
+                import tracemalloc
+                assert tracemalloc.Snapshot.load(path).statistics("lineno")
+                output = logs.getvalue()
+                for expected in ("Peak traced memory", "Peak RSS", "Top allocations", "Growth up to made strings", "Growth up to end", "Wrote snapshot to {0}".format(path)):
+                    assert expected in output, "Expected {0} in {1}".format(expected, output)
+                assert not tracemalloc.is_tracing()
+            finally:
+                shutil.rmtree(directory)
+
+        it "ignores memory_snapshot without --memprofile":
+            class MyApp(App):
+                def execute(slf, args, extra_args, cli_args, handler):
+                    slf.memory_snapshot("start")
+
+            MyApp().mainline([])
+
+    describe "batch":
+        def make_app(self, called):
+            class MyApp(App):
+                cli_positional_replacements = ["--environment"]
+
+                def specify_other_args(slf, parser, defaults):
+                    called.append("specify")
+                    parser.add_argument("--environment", **defaults["--environment"])
+
+                def setup_logging(slf, args, verbose=False, silent=False, debug=False):
+                    called.append(("logging", verbose))
+
+                def execute(slf, args, extra_args, cli_args, handler):
+                    if args.environment == "bad":
+                        raise DelfickError("Bad environment", environment=args.environment)
+                    if args.environment == "stop":
+                        raise KeyboardInterrupt()
+                    called.append((args.environment, extra_args))
+            return MyApp()
+
+        it "runs each line, reusing the parser and logging":
+            called = []
+            errors = StringIO()
+            summary = StringIO()
+            lines = ["dev -- 'one two'", "", "# a comment", "stg", "bad", "prod --verbose", "--not-an-option"]
+
+            with mock.patch("sys.stderr", StringIO()):
+                results = self.make_app(called).batch(lines, print_errors_to=errors, summary_to=summary)
+
+            self.assertEqual(called, ["specify", ("logging", False), ("dev", "one two"), "specify", ("stg", ""), "specify", "specify", ("logging", True), ("prod", ""), "specify"])
+            self.assertEqual([(result.argv, result.status) for result in results]
+                , [ (["dev", "--", "one two"], "ok")
+                  , (["stg"], "ok")
+                  , (["bad"], "failed")
+                  , (["prod", "--verbose"], "ok")
+                  , (["--not-an-option"], "exit 2")
+                  ]
+                )
+
+            self.assertEqual(errors.getvalue(), dedent("""
+                !!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!!
+                Something went wrong! -- DelfickError
+                \t"Bad environment"\tenvironment=bad
+            """))
+
+            lines = summary.getvalue().strip().split("\n")
+            assert lines[1].startswith("Batch summary: 5 items, 2 failed, "), lines[1]
+            self.assertEqual(lines[3].split()[:3], ["1", "ok", lines[3].split()[2]])
+            self.assertEqual(lines[5].split()[1], "failed")
+
+        it "stops when the user quits":
+            called = []
+            results = self.make_app(called).batch(["dev", "stop", "prod"], print_errors_to=StringIO(), summary_to=StringIO())
+            self.assertEqual([result.status for result in results], ["ok", "quit"])
+
+        it "closes the logging handlers it replaces":
+            class MyApp(App):
+                logging_async = True
+                logging_handler_file = property(lambda s: StringIO())
+
+                def execute(slf, args, extra_args, cli_args, handler):
+                    pass
+
+            def logging_threads():
+                return [thread for thread in threading.enumerate() if thread.name == "delfick_app-logging"]
+
+            before = len(logging_threads())
+            MyApp().batch(["--silent", "--verbose", "--silent", "--verbose"], summary_to=StringIO())
+            self.assertEqual(len(logging_threads()), before)
+
     describe "setup_logging":
         it "works":
             fle = StringIO()
@@ -174,12 +490,10 @@ describe TestCase, "App":
             log.debug("not captured")
             log.warning("yeap")
 
-            log.removeHandler(logging_handler)
             args, _, _ = app.make_cli_parser().interpret_args(['--verbose'])
             logging_handler = app.setup_logging(args, verbose=args.verbose, logging_name="blah")
             log.debug("this one is captured")
 
-            log.removeHandler(logging_handler)
             args, _, _ = app.make_cli_parser().interpret_args(['--silent'])
             logging_handler = app.setup_logging(args, silent=args.silent, logging_name="blah")
             log.debug("not captured")